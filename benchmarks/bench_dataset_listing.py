@@ -0,0 +1,95 @@
+"""
+Benchmark for the dataset listing throughput, comparing the creation
+of metadata one dataset at a time (``make_dataset_metadata`` hook) with
+the batched version (``make_dataset_metadata_batch`` hook).
+
+Only the core and geo plugins are enabled; no database is needed,
+as dataset configurations are generated in memory (and the metadata
+hooks of these plugins don't query it). Hook handlers failing would
+make the figures meaningless: the benchmark is aborted if any does.
+
+Usage::
+
+    python benchmarks/bench_dataset_listing.py [num_datasets]
+"""
+
+import sys
+import time
+
+from datacat.core import make_flask_app, load_plugins
+from datacat.ext.core import _make_plugins_make_datasets_metadata
+
+
+PLUGINS = [
+    'datacat.ext.core:core_plugin',
+    'datacat.ext.geo:geo_plugin',
+]
+
+
+def make_datasets(count):
+    return [(i, {
+        'metadata': {'title': 'Dataset {0}'.format(i)},
+        'resources': [
+            'internal:///{0}'.format(i),
+            {'url': 'http://example.com/dataset-{0}.zip'.format(i)},
+        ],
+        'geo': {'enabled': i % 2 == 0, 'importer': 'find_shapefiles'},
+    }) for i in xrange(count)]
+
+
+def check_results(results):
+    for result in results:
+        if result.exception is not None:
+            raise AssertionError("Hook handler of {0!r} failed: {1!r}"
+                                 .format(result.plugin, result.exception))
+
+
+def list_per_item(app, datasets):
+    result = []
+    for dataset_id, config in datasets:
+        metadata = {}
+        check_results(app.plugins.call_hook(
+            'make_dataset_metadata', dataset_id, config, metadata))
+        metadata['id'] = dataset_id
+        result.append(metadata)
+    return result
+
+
+def list_batch(app, datasets):
+    return _make_plugins_make_datasets_metadata(datasets)
+
+
+def run(func, app, datasets, repeat=5):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func(app, datasets)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    app = make_flask_app({'PLUGINS': PLUGINS, 'SERVER_NAME': 'localhost'})
+    app.plugins = load_plugins(app)
+    datasets = make_datasets(count)
+
+    with app.test_request_context():
+        check_results(app.plugins.call_hook(
+            'make_dataset_metadata_batch',
+            [(dataset_id, config, {}) for dataset_id, config in datasets]))
+        assert list_per_item(app, datasets) == list_batch(app, datasets)
+
+        print("Listing {0} datasets, plugins: {1}".format(
+            count, ', '.join(PLUGINS)))
+        for name, func in [('per-item hook', list_per_item),
+                           ('batch hook', list_batch)]:
+            elapsed = run(func, app, datasets)
+            print("{0:>15}: {1:8.3f} s  {2:10.0f} datasets/s".format(
+                name, elapsed, count / elapsed))
+
+
+if __name__ == '__main__':
+    main()
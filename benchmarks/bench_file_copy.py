@@ -0,0 +1,80 @@
+"""
+Benchmark for the throughput of :py:func:`datacat.utils.files.file_copy`,
+across file sizes.
+
+Compares the original loop (``read()`` / ``write()`` of 4 KiB blocks)
+with the current implementation (``readinto()`` a reused buffer),
+copying between real files and from a file-like object.
+
+Usage::
+
+    python benchmarks/bench_file_copy.py [max_size_mb]
+"""
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+from datacat.utils.files import file_copy
+
+
+def naive_copy(src, dest, blocksize=4096):
+    while True:
+        data = src.read(blocksize)
+        if not data:
+            return
+        dest.write(data)
+
+
+def copy_files(func, src_path, dest_path):
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        func(src, dest)
+
+
+def copy_file_like(func, data, dest_path):
+    src = io.BytesIO(data)
+    with open(dest_path, 'wb') as dest:
+        func(src, dest)
+
+
+def main():
+    max_size = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    tempdir = tempfile.mkdtemp(prefix='bench-file-copy-')
+    src_path = os.path.join(tempdir, 'src')
+    dest_path = os.path.join(tempdir, 'dest')
+
+    print("{0:>8} | {1:^29} | {2:^29}".format(
+        '', 'file -> file', 'BytesIO -> file'))
+    print("{0:>8} | {1:>14}{2:>15} | {1:>14}{2:>15}".format(
+        'size', 'naive', 'file_copy'))
+
+    try:
+        size = 1024 * 1024
+        while size <= max_size * 1024 * 1024:
+            data = os.urandom(size)
+            with open(src_path, 'wb') as fp:
+                fp.write(data)
+
+            number = max(1, 64 * 1024 * 1024 // size)
+            row = []
+            for copy, src in ((copy_files, src_path),
+                              (copy_file_like, data)):
+                for func in (naive_copy, file_copy):
+                    elapsed = min(timeit.repeat(
+                        lambda: copy(func, src, dest_path),
+                        number=number, repeat=3)) / number
+                    row.append(size / elapsed / 1024 / 1024)
+
+            print("{0:>5} MB | {1[0]:>9.0f} MB/s {1[1]:>9.0f} MB/s | "
+                  "{1[2]:>9.0f} MB/s {1[3]:>9.0f} MB/s".format(
+                      size // (1024 * 1024), row))
+            size *= 4
+    finally:
+        shutil.rmtree(tempdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark for the per-request overhead of calling hooks,
+with many plugins loaded.
+
+Compares dispatching through the :py:class:`PluginManager` hooks table
+with the plain iteration over plugins (calling each plugin's own
+``call_hook_async()``), for a hook implemented by some of the plugins
+and for a hook no plugin implements.
+
+Usage::
+
+    python benchmarks/bench_hook_dispatch.py [num_plugins]
+"""
+
+import sys
+import timeit
+
+from datacat.ext.base import Plugin
+from datacat.utils.plugin_manager import PluginManager
+
+
+def make_plugins(count):
+    plugins = []
+    for i in xrange(count):
+        plugin = Plugin('bench.plugin_{0}'.format(i))
+
+        @plugin.hook(['dataset_create', 'dataset_update'])
+        def on_dataset_change(dataset_id, conf):
+            pass
+
+        if i % 4 == 0:
+            @plugin.hook('make_dataset_metadata')
+            def make_dataset_metadata(dataset_id, conf, metadata):
+                metadata['plugin'] = dataset_id
+
+        plugins.append(plugin)
+    return plugins
+
+
+def call_hook_per_plugin(plugins, hook_type, *args):
+    # Dispatching by looking up the hooks on each plugin
+    return [res for plugin in plugins
+            for res in plugin.call_hook_async(hook_type, *args)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    number = 20000
+
+    plugins = make_plugins(count)
+    manager = PluginManager(plugins)
+
+    cases = [
+        ('make_dataset_metadata', (1, {}, {})),
+        ('dataset_create', (1, {})),
+        ('no_handlers_hook', (1,)),
+    ]
+
+    print("Hook call overhead with {0} plugins (us/call)".format(count))
+    print("{0:>25} {1:>12} {2:>12}".format(
+        'hook', 'per-plugin', 'table'))
+
+    for hook_type, args in cases:
+        expected = call_hook_per_plugin(plugins, hook_type, *args)
+        assert manager.call_hook(hook_type, *args) == expected
+        before = min(timeit.repeat(
+            lambda: call_hook_per_plugin(plugins, hook_type, *args),
+            number=number, repeat=3))
+        after = min(timeit.repeat(
+            lambda: manager.call_hook(hook_type, *args),
+            number=number, repeat=3))
+        print("{0:>25} {1:12.2f} {2:12.2f}".format(
+            hook_type, before * 1e6 / number, after * 1e6 / number))
+
+
+if __name__ == '__main__':
+    main()
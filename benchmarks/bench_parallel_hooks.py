@@ -0,0 +1,63 @@
+"""
+Benchmark for the latency of hooks handled by several plugins,
+each blocking on I/O (simulated by sleeping for a while).
+
+Compares the sequential :py:meth:`PluginManager.call_hook` with
+:py:meth:`PluginManager.call_hook_parallel`, running handlers
+declared as thread-safe on a thread pool.
+
+Usage::
+
+    python benchmarks/bench_parallel_hooks.py [num_plugins] [latency_ms]
+"""
+
+import sys
+import time
+import timeit
+
+from datacat.ext.base import Plugin
+from datacat.utils.plugin_manager import PluginManager
+
+
+def make_plugins(count, latency):
+    plugins = []
+    for i in xrange(count):
+        plugin = Plugin('bench.plugin_{0}'.format(i))
+
+        @plugin.hook('dataset_delete', thread_safe=True)
+        def on_dataset_delete(dataset_id):
+            time.sleep(latency)
+            return dataset_id
+
+        plugins.append(plugin)
+    return plugins
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    latency = (float(sys.argv[2]) if len(sys.argv) > 2 else 5) / 1000.0
+    number = 20
+
+    manager = PluginManager(make_plugins(count, latency), hook_threads=count)
+
+    # Make sure the results are the same, in the same order
+    sequential = manager.call_hook('dataset_delete', 1)
+    parallel = manager.call_hook_parallel('dataset_delete', 1)
+    assert [x.result for x in sequential] == [x.result for x in parallel]
+
+    print("dataset_delete hook with {0} plugins, {1:.1f} ms latency each"
+          .format(count, latency * 1000))
+    print("{0:>12} {1:>12}".format('sequential', 'parallel'))
+
+    before = min(timeit.repeat(
+        lambda: manager.call_hook('dataset_delete', 1),
+        number=number, repeat=3))
+    after = min(timeit.repeat(
+        lambda: manager.call_hook_parallel('dataset_delete', 1),
+        number=number, repeat=3))
+    print("{0:9.2f} ms {1:9.2f} ms".format(
+        before * 1e3 / number, after * 1e3 / number))
+
+
+if __name__ == '__main__':
+    main()
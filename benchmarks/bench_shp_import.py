@@ -0,0 +1,82 @@
+"""
+Benchmark for the shapefile import throughput, comparing the execution
+of the SQL script generated by ``shp2pgsql`` (``INSERT`` statements),
+the streaming of its dump format to ``COPY`` and the in-process reader
+sending binary ``COPY`` data.
+
+Requires ``shp2pgsql`` and a PostGIS-enabled database; the table
+is created and dropped by the benchmark.
+
+Usage::
+
+    python benchmarks/bench_shp_import.py <shapefile> <dsn>
+"""
+
+import re
+import sys
+import time
+
+import psycopg2
+
+from datacat.utils.data_extraction import (
+    shp2pgsql, shp2pgsql_copy, shapefile_copy, shapefile_table_sql)
+from datacat.utils.shapefile import ShapefileReader
+
+TABLE = 'bench_shp_import'
+
+
+def load_sql(conn, shapefile):
+    sql = shp2pgsql(shapefile, table=TABLE, mode='append',
+                    geometry_column='geom')
+    with conn, conn.cursor() as cur:
+        cur.execute(sql)
+
+
+def load_copy(conn, shapefile):
+    with conn, conn.cursor() as cur:
+        shp2pgsql_copy(cur, shapefile, table=TABLE, geometry_column='geom')
+
+
+def load_native(conn, shapefile):
+    with conn, conn.cursor() as cur, ShapefileReader(shapefile) as reader:
+        shapefile_copy(cur, reader, table=TABLE, geometry_column='geom')
+
+
+def run(func, conn, shapefile, create_sql):
+    with conn, conn.cursor() as cur:
+        cur.execute(create_sql)
+    try:
+        start = time.time()
+        func(conn, shapefile)
+        return time.time() - start
+    finally:
+        with conn, conn.cursor() as cur:
+            cur.execute('DROP TABLE "{0}";'.format(TABLE))
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: bench_shp_import.py <shapefile> <dsn> (skipped)")
+        return
+
+    shapefile, dsn = sys.argv[1:3]
+    conn = psycopg2.connect(dsn)
+
+    create_sql = shp2pgsql(shapefile, table=TABLE, create_table_only=True,
+                           mode='create', geometry_column='geom')
+    create_sql = re.sub(r'varchar\([0-9]+\)', 'text', create_sql,
+                        flags=re.IGNORECASE)
+
+    # Binary COPY needs the exact column types it was encoded for
+    with ShapefileReader(shapefile) as reader:
+        native_create_sql = shapefile_table_sql(reader, TABLE)
+
+    print("{0:>12} {1:>12} {2:>12}".format('insert', 'copy', 'native'))
+    print("{0:10.2f} s {1:10.2f} s {2:10.2f} s".format(
+        run(load_sql, conn, shapefile, create_sql),
+        run(load_copy, conn, shapefile, create_sql),
+        run(load_native, conn, shapefile, native_create_sql)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Move resource data between blob stores.
+
+Usage::
+
+    python -m datacat.cli.migrate_blobs <source> <dest>
+
+Where ``source`` and ``dest`` are names of stores configured in the
+``BLOB_STORES`` setting (eg. ``lo`` and ``fs``). Configuration is
+loaded from the file pointed by the ``DATACAT_SETTINGS`` environment
+variable.
+
+Blobs are moved one at a time, each in its own transaction: the
+migration can be interrupted and resumed at any time.
+"""
+
+import argparse
+import sys
+
+from datacat.core import make_flask_app
+from datacat.storage import migrate_blobs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Move resource data between blob stores")
+    parser.add_argument('source', help="Name of the source store")
+    parser.add_argument('dest', help="Name of the destination store")
+    args = parser.parse_args(argv)
+
+    app = make_flask_app()
+    for name in (args.source, args.dest):
+        if name not in app.config['BLOB_STORES']:
+            parser.error("Unknown blob store: {0}".format(name))
+
+    with app.app_context():
+        count = 0
+        for key in migrate_blobs(args.source, args.dest):
+            count += 1
+            sys.stdout.write("Moved blob {0} ({1} so far)\n"
+                             .format(key, count))
+
+    sys.stdout.write("Done: {0} blobs moved from {1} to {2}\n"
+                     .format(count, args.source, args.dest))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,10 @@ from datacat.web.blueprints.public import public_bp
 
 
 def make_flask_app(config=None):
+    from datacat.db import release_connections
+
     app = Flask('datacat')
+    app.teardown_appcontext(release_connections)
     app.register_blueprint(admin_bp, url_prefix='/api/1/admin')
     app.register_blueprint(public_bp, url_prefix='/api/1/data')
     app.config.update(make_config())
@@ -67,7 +70,8 @@ def load_plugins(app):
         # Setup the plugin
         plugin.setup(app)
 
-    return PluginManager(plugins)
+    return PluginManager(plugins,
+                         hook_threads=app.config['PLUGINS_HOOK_THREADS'])
 
 
 def finalize_app(app):
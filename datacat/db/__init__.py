@@ -1,12 +1,16 @@
 from collections import MutableMapping
 import json
 import functools
+import os
+import threading
 
 from flask import g
 import psycopg2
 import psycopg2.extras
 from werkzeug.local import LocalProxy
 
+from datacat.db.pool import ConnectionPool
+
 
 def connect(database, user=None, password=None, host='localhost', port=5432):
     conn = psycopg2.connect(database=database, user=user, password=password,
@@ -51,10 +55,27 @@ def create_tables(conn):
             metadata JSON,
             auto_metadata JSON,
             mimetype CHARACTER VARYING (128),
-            data_oid INTEGER,
+            blob_store CHARACTER VARYING (32),
+            blob_key CHARACTER VARYING (256),
             ctime TIMESTAMP WITHOUT TIME ZONE,
             mtime TIMESTAMP WITHOUT TIME ZONE,
             hash VARCHAR(128));
+
+        -- Blobs are shared by resources with the same data
+        CREATE INDEX resource_hash ON resource (hash);
+        CREATE INDEX resource_blob ON resource (blob_store, blob_key);
+
+        CREATE TABLE hook_execution (
+            id SERIAL PRIMARY KEY,
+            hook_type CHARACTER VARYING (128),
+            plugin CHARACTER VARYING (256),
+            handler CHARACTER VARYING (256),
+            arguments JSON,
+            status CHARACTER VARYING (32),
+            result JSON,
+            exception TEXT,
+            ctime TIMESTAMP WITHOUT TIME ZONE,
+            mtime TIMESTAMP WITHOUT TIME ZONE);
         """)
 
 
@@ -67,6 +88,7 @@ def drop_tables(conn):
         DROP TABLE info;
         DROP TABLE dataset;
         DROP TABLE resource;
+        DROP TABLE hook_execution;
         """)
 
 
@@ -81,93 +103,233 @@ def _cached(key_name):
     return decorator
 
 
-# def get_db():
-#     from flask import current_app
-#     if not hasattr(g, 'database'):
-#         g.database = connect(**current_app.config['DATABASE'])
-#         g.database.autocommit = False
-#     return g.database
+# Connections from pools (and caches) left over in a forked process: we
+# must not close them, as that would terminate the parent process'
+# sessions too.
+_inherited_connections = []
 
 
-# def get_admin_db():
-#     from flask import current_app
-#     if not hasattr(g, 'admin_database'):
-#         g.admin_database = connect(**current_app.config['DATABASE'])
-#         g.admin_database.autocommit = True
-#     return g.admin_database
+def get_pool():
+    """
+    Return the connection pool for the current application,
+    creating it if needed.
+
+    A new pool is created in forked processes (eg. Celery workers),
+    as connections cannot be shared across processes.
+    """
+
+    from flask import current_app
+    pool = getattr(current_app, 'db_pool', None)
+    if pool is None or pool.pid != os.getpid():
+        if pool is not None:
+            _inherited_connections.append(pool)
+        conf = current_app.config['DATABASE']
+        pool_conf = current_app.config['DATABASE_POOL']
+        pool = ConnectionPool(
+            functools.partial(connect, **conf),
+            minconn=pool_conf['minconn'],
+            maxconn=pool_conf['maxconn'],
+            timeout=pool_conf['timeout'])
+        current_app.db_pool = pool
+    return pool
 
 
 @_cached('_database')
 def get_db():
-    from flask import current_app
-    c = connect(**current_app.config['DATABASE'])
-    c.autocommit = False
-    return c
+    return get_pool().getconn(autocommit=False)
 
 
 @_cached('_admin_database')
 def get_admin_db():
+    return get_pool().getconn(autocommit=True)
+
+
+def release_connections(exception=None):
+    """
+    Return connections used in the current application context
+    to the pool. Registered as ``teardown_appcontext`` callback.
+    """
+
+    for key_name in ('_database', '_admin_database'):
+        conn = getattr(g, key_name, None)
+        if conn is not None:
+            delattr(g, key_name)
+            get_pool().putconn(conn)
+
+
+# Channel used to notify changes to the ``info`` table
+INFO_NOTIFY_CHANNEL = 'datacat_info'
+
+
+class DbInfoCache(object):
+    """
+    In-process cache of the ``info`` table contents, loaded with
+    a single query when first needed.
+
+    If a connection (in autocommit mode) is passed, it will be used to
+    ``LISTEN`` for changes notified by :py:class:`DbInfoDict` instances
+    in other processes; the cache is dropped as soon as a notification
+    is received.
+
+    :param connect_func:
+        Callable returning a new connection (in autocommit mode), used
+        to (re)open the listening connection when missing or lost.
+        Until listening succeeds again, the cache is bypassed.
+    """
+
+    def __init__(self, listen_conn=None, connect_func=None):
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._data = None
+        self._listen_conn = listen_conn
+        self._connect_func = connect_func
+        self._listening = listen_conn is not None or connect_func is not None
+        if listen_conn is not None:
+            with listen_conn.cursor() as cur:
+                cur.execute('LISTEN "{0}";'.format(INFO_NOTIFY_CHANNEL))
+        elif connect_func is not None:
+            self._listen()
+
+    def get_data(self, db):
+        """
+        Return a dictionary with the table contents, loading
+        it from the database if needed.
+
+        The returned dictionary must not be modified.
+        """
+
+        with self._lock:
+            if self._poll() and self._data is not None:
+                return self._data
+            with db.cursor() as cur:
+                cur.execute("SELECT key, value FROM info;")
+                data = dict(
+                    (row['key'], json.loads(row['value']))
+                    for row in cur)
+            if self._listen_conn is not None or not self._listening:
+                self._data = data
+            return data
+
+    def invalidate(self):
+        with self._lock:
+            self._data = None
+
+    def _poll(self):
+        """
+        Process pending notifications; return ``False`` if changes
+        can't be tracked (the cache must not be used).
+        """
+
+        if self._listen_conn is None:
+            if not self._listening:
+                return True  # Private cache
+            return self._listen()
+        try:
+            self._listen_conn.poll()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # Notifications might have been lost along with the
+            # connection: start over with a new one.
+            self._data = None
+            self._close_listen_conn()
+            return self._listen()
+        if self._listen_conn.notifies:
+            del self._listen_conn.notifies[:]
+            self._data = None
+        return True
+
+    def _listen(self):
+        """Open the listening connection; return whether it succeeded"""
+
+        if self._connect_func is None:
+            return False
+        self._data = None
+        try:
+            self._listen_conn = self._connect_func()
+            with self._listen_conn.cursor() as cur:
+                cur.execute('LISTEN "{0}";'.format(INFO_NOTIFY_CHANNEL))
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self._close_listen_conn()
+            return False
+        return True
+
+    def _close_listen_conn(self):
+        if self._listen_conn is not None:
+            self._listen_conn.close()
+            self._listen_conn = None
+
+
+def _connect_autocommit(**conf):
+    conn = connect(**conf)
+    conn.autocommit = True
+    return conn
+
+
+def get_info_cache():
+    """
+    Return the ``info`` table cache for the current application,
+    creating it (along with its listening connection) if needed.
+    """
+
     from flask import current_app
-    c = connect(**current_app.config['DATABASE'])
-    c.autocommit = True
-    return c
+    cache = getattr(current_app, 'db_info_cache', None)
+    if cache is None or cache.pid != os.getpid():
+        if cache is not None:
+            _inherited_connections.append(cache)
+        cache = DbInfoCache(connect_func=functools.partial(
+            _connect_autocommit, **current_app.config['DATABASE']))
+        current_app.db_info_cache = cache
+    return cache
 
 
 class DbInfoDict(MutableMapping):
-    def __init__(self, db):
+    """
+    Dictionary-like access to the ``info`` table, storing
+    JSON-serializable values.
+
+    :param db: database connection
+    :param cache:
+        :py:class:`DbInfoCache` instance; if not specified, a private
+        cache (unaware of changes made through other objects) is used.
+    """
+
+    def __init__(self, db, cache=None):
         self._db = db
+        self._cache = DbInfoCache() if cache is None else cache
+
+    def _notify_change(self, cur, key):
+        cur.execute("SELECT pg_notify(%s, %s);", (INFO_NOTIFY_CHANNEL, key))
 
     def __getitem__(self, key):
-        with self._db.cursor() as cur:
-            cur.execute("""
-            SELECT * FROM info WHERE "key" = %s;
-            """, (key,))
-            row = cur.fetchone()
-            if row is None:
-                raise KeyError(key)
-        return json.loads(row['value'])
+        return self._cache.get_data(self._db)[key]
 
     def __setitem__(self, key, value):
-        # Note that the update would be void if anybody deleted
-        # the key between the two queries! -- but we can be optimistic
-        # as key deletes are quite infrequent..
         value = json.dumps(value)
-        try:
-            with self._db, self._db.cursor() as cur:
-                cur.execute("""
-                INSERT INTO info (key, value) VALUES (%s, %s)
-                """, (key, value))
-        except psycopg2.IntegrityError:
-            with self._db, self._db.cursor() as cur:
-                cur.execute("""
-                UPDATE info SET value=%s WHERE key=%s
-                """, (value, key))
+        with self._db, self._db.cursor() as cur:
+            cur.execute("""
+            INSERT INTO info (key, value) VALUES (%s, %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value;
+            """, (key, value))
+            self._notify_change(cur, key)
+        self._cache.invalidate()
 
     def __delitem__(self, key):
         with self._db, self._db.cursor() as cur:
             cur.execute("""
             DELETE FROM info WHERE key=%s
             """, (key,))
+            self._notify_change(cur, key)
+        self._cache.invalidate()
 
     def __iter__(self):
-        with self._db.cursor() as cur:
-            cur.execute("SELECT key FROM info;")
-            for row in cur:
-                yield row['key']
+        return iter(list(self._cache.get_data(self._db)))
 
     def iteritems(self):
-        with self._db.cursor() as cur:
-            cur.execute("SELECT key, value FROM info;")
-            for row in cur:
-                yield row['key'], json.loads(row['value'])
+        return iter(self._cache.get_data(self._db).items())
 
     def __len__(self):
-        with self._db.cursor() as cur:
-            cur.execute("SELECT count(*) AS count FROM info;")
-            row = cur.fetchone()
-            return row['count']
+        return len(self._cache.get_data(self._db))
 
 
 db = LocalProxy(get_db)
 admin_db = LocalProxy(get_admin_db)
-db_info = LocalProxy(lambda: DbInfoDict(get_db()))
+db_info = LocalProxy(lambda: DbInfoDict(get_db(), get_info_cache()))
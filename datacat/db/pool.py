@@ -0,0 +1,182 @@
+"""
+Thread-safe pool of database connections.
+
+Connections are handed out for the duration of an application context
+(see :py:func:`datacat.db.get_db`) and returned to the pool on teardown,
+so that requests and Celery tasks don't pay for a new connection
+(TCP + authentication handshake) each time.
+"""
+
+import os
+import threading
+import time
+
+import psycopg2.pool
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    """
+    Raised when no connection became available in the pool
+    before the configured timeout expired.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, connect, minconn=0, maxconn=10, timeout=None):
+        """
+        :param connect:
+            Callable returning a new database connection
+
+        :param minconn:
+            Number of connections to be opened right away,
+            and kept open while idle.
+
+        :param maxconn:
+            Maximum number of connections (in use + idle). Once this
+            is reached, :py:meth:`getconn` will wait for a connection
+            to be returned to the pool.
+
+        :param timeout:
+            Maximum number of seconds to wait for a connection to become
+            available, before raising :py:exc:`PoolTimeout`.
+            ``None`` means "wait forever".
+        """
+
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError("Invalid pool size: min={0} max={1}"
+                             .format(minconn, maxconn))
+
+        self._connect = connect
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.pid = os.getpid()
+
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._in_use = set()
+        self._opening = 0
+        self._waiting = 0
+        self._wait_count = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+        for i in xrange(minconn):
+            self._idle.append(self._connect())
+
+    def getconn(self, autocommit=False):
+        """
+        Get a connection from the pool, opening a new one if none
+        is idle and the pool is not full yet.
+        """
+
+        with self._cond:
+            started = None
+            while not self._idle and self._size() >= self.maxconn:
+                if started is None:
+                    started = time.time()
+                    self._waiting += 1
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.time() - started)
+                    if remaining <= 0:
+                        self._record_wait(started)
+                        raise PoolTimeout(
+                            "Timed out waiting for a database connection")
+                self._cond.wait(remaining)
+
+            if started is not None:
+                self._record_wait(started)
+
+            if self._idle:
+                conn = self._idle.pop()
+                self._in_use.add(conn)
+            else:
+                # Reserve a slot, then connect without holding the lock
+                conn = None
+                self._opening += 1
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            finally:
+                with self._cond:
+                    self._opening -= 1
+                    if conn is not None:
+                        self._in_use.add(conn)
+                    else:
+                        self._cond.notify()
+
+        conn.autocommit = autocommit
+        return conn
+
+    def putconn(self, conn, close=False):
+        """
+        Return a connection to the pool. Any pending transaction
+        will be rolled back; broken connections are discarded.
+        """
+
+        if not close and not conn.closed:
+            try:
+                conn.rollback()
+            except Exception:
+                close = True
+
+        if close or conn.closed:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if not conn.closed:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        """Close all the idle connections"""
+
+        with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+
+    def stats(self):
+        """
+        Return a dictionary of pool statistics:
+
+        ``in_use``
+            Number of connections currently handed out
+        ``idle``
+            Number of open connections waiting in the pool
+        ``waiting``
+            Number of callers currently waiting for a connection
+        ``wait_count``
+            Number of times a caller had to wait for a connection
+        ``wait_time``, ``max_wait_time``
+            Total and maximum time (in seconds) spent waiting
+        """
+
+        with self._cond:
+            return {
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'max_size': self.maxconn,
+                'waiting': self._waiting,
+                'wait_count': self._wait_count,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+            }
+
+    def _size(self):
+        # Must be called while holding the lock
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _record_wait(self, started):
+        # Must be called while holding the lock
+        elapsed = time.time() - started
+        self._waiting -= 1
+        self._wait_count += 1
+        self._wait_time += elapsed
+        self._max_wait_time = max(self._max_wait_time, elapsed)
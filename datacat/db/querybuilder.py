@@ -95,6 +95,59 @@ def select_paged(table, fields=None, order_by='id ASC', offset=0, limit=10):
                     offset=int(offset), limit=int(limit)))
 
 
+def select_keyset(table, fields=None, table_key='id', limit=10):
+    """
+    Build a SQL query for selecting a page of objects from a table,
+    using "keyset" pagination, i.e. returning at most ``limit`` objects
+    having a key greater or equal to the passed one.
+
+    Unlike :py:func:`select_paged`, the cost of fetching a page doesn't
+    depend on its position, as the index on the key is used to find
+    the first item instead of skipping over ``OFFSET`` rows.
+
+    :param table:
+        Name of the table to operate on.
+
+    :param fields:
+        List of field names to select (string or iterable).
+
+        ``None`` (default) means "all".
+
+    :param table_key:
+        The name of the (unique) key field used for ordering and
+        filtering the results.
+
+    :param limit:
+        The query LIMIT (maximum amount of returned items).
+        ``None`` means "no limit".
+
+        Defaults to 10.
+
+    :return:
+        The query, as a string
+
+    >>> querybuilder.select_keyset('mytable', limit=20)
+    'SELECT * FROM "mytable" WHERE "id">=%(id)s ORDER BY "id" ASC LIMIT 20'
+    """
+
+    if not VALID_IDENTIFIER_RE.match(table):
+        raise ValueError("Invalid table name: {0}".format(table))
+
+    if not VALID_IDENTIFIER_RE.match(table_key):
+        raise ValueError("Invalid field name: {0}".format(table_key))
+
+    fields = _make_fields(fields)
+
+    query = ('SELECT {fields} FROM "{table}" WHERE "{key}">=%({key})s '
+             'ORDER BY "{key}" ASC'
+             .format(fields=fields, table=table, key=table_key))
+
+    if limit is not None:
+        query += ' LIMIT {0}'.format(int(limit))
+
+    return query
+
+
 def insert(table, data, table_key='id'):
     """
     Build a SQL query for inserting some data in a table.
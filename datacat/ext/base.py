@@ -15,6 +15,8 @@ class Plugin(object):
         """
         self.import_name = import_name
         self._hooks = defaultdict(list)
+        self._deferred_hooks = set()
+        self._thread_safe_hooks = set()
         self._blueprint = None
 
     def setup(self, app):
@@ -88,7 +90,7 @@ class Plugin(object):
         found.sort()
         return found
 
-    def hook(self, hook_type):
+    def hook(self, hook_type, deferred=False, thread_safe=False):
         """
         Decorator function to register a "hook" function, to be used later for
         various purposes.
@@ -99,6 +101,21 @@ class Plugin(object):
 
         :type hook_type:
             str, list, tuple
+
+        :param deferred:
+            If set to ``True``, calls through the plugin manager will not
+            run the handler right away, but schedule it to be run by a
+            Celery task. Execution status and results are recorded in
+            the ``hook_execution`` table.
+
+            Arguments to deferred handlers must be JSON-serializable.
+
+        :param thread_safe:
+            Declare the handler safe to be run concurrently with handlers
+            from other plugins, in a separate thread (with its own
+            application context, hence its own database connection).
+            Such handlers are run on a thread pool by
+            ``PluginManager.call_hook_parallel()``.
         """
 
         def decorator(func):
@@ -107,9 +124,27 @@ class Plugin(object):
                 _hook_type = (_hook_type,)
             for t in _hook_type:
                 self._hooks[t].append(func)
+                if deferred:
+                    self._deferred_hooks.add((t, func))
+                if thread_safe:
+                    self._thread_safe_hooks.add((t, func))
             return func
         return decorator
 
+    def is_deferred_hook(self, hook_type, handler):
+        """
+        Check whether a handler was registered as deferred
+        for the given hook type.
+        """
+        return (hook_type, handler) in self._deferred_hooks
+
+    def is_thread_safe_hook(self, hook_type, handler):
+        """
+        Check whether a handler was declared as thread-safe
+        for the given hook type.
+        """
+        return (hook_type, handler) in self._thread_safe_hooks
+
     def call_hook(self, hook_type, *a, **kw):
         """
         Synchronous wrapper for :py:meth:`call_hook_async`, returning
@@ -1,11 +1,13 @@
 from urlparse import urlparse
+import itertools
 
 from flask import url_for, current_app
 from werkzeug.exceptions import NotFound
 
 from datacat.db import db
 from datacat.ext.base import Plugin
-from datacat.web.utils import json_view
+from datacat.web.utils import (
+    json_view, select_page, select_all, is_export_request, json_stream_array)
 
 
 core_plugin = Plugin(__name__)
@@ -22,11 +24,67 @@ def _make_plugins_make_dataset_metadata(dataset_id, config):
     calling their ``make_dataset_metadata`` hook.
     """
 
-    metadata = {}
-    current_app.plugins.call_hook(
-        'make_dataset_metadata', dataset_id, config, metadata)
-    metadata['id'] = dataset_id
-    return metadata
+    return _make_plugins_make_datasets_metadata([(dataset_id, config)])[0]
+
+
+def _make_plugins_make_datasets_metadata(datasets):
+    """
+    Create metadata for a list of datasets at once.
+
+    The ``make_dataset_metadata_batch`` hook is called once for the
+    whole list, which is passed as a list of ``(dataset_id, config,
+    metadata)`` tuples; then the ``make_dataset_metadata`` hook is
+    called for each dataset, on the plugins not implementing the
+    batch variant.
+
+    :param datasets: list of ``(dataset_id, config)`` tuples
+    :return: list of metadata dictionaries, in the same order
+    """
+
+    plugins = current_app.plugins
+    items = [(dataset_id, config, {}) for dataset_id, config in datasets]
+
+    plugins.call_hook('make_dataset_metadata_batch', items)
+
+    batch_plugins = set(
+        plugin for plugin, _
+        in plugins.get_hook_handlers('make_dataset_metadata_batch'))
+    for plugin, handler in plugins.get_hook_handlers('make_dataset_metadata'):
+        if plugin in batch_plugins:
+            continue
+        for dataset_id, config, metadata in items:
+            plugins.call_handler('make_dataset_metadata', plugin, handler,
+                                 dataset_id, config, metadata)
+
+    for dataset_id, config, metadata in items:
+        metadata['id'] = dataset_id
+    return [metadata for dataset_id, config, metadata in items]
+
+
+def _iter_datasets_metadata(rows, batch_size):
+    """
+    Generator yielding metadata for datasets from an iterable
+    of database rows, processing them in batches.
+    """
+
+    rows = iter(rows)
+    while True:
+        batch = [(x['id'], x['configuration'])
+                 for x in itertools.islice(rows, batch_size)]
+        if not batch:
+            return
+        for metadata in _make_plugins_make_datasets_metadata(batch):
+            yield metadata
+
+
+@core_plugin.hook('make_dataset_metadata_batch')
+def make_dataset_metadata_batch(items):
+    """
+    :hook: make_dataset_metadata_batch
+    """
+
+    for dataset_id, config, metadata in items:
+        make_dataset_metadata(dataset_id, config, metadata)
 
 
 @core_plugin.hook('make_dataset_metadata')
@@ -79,14 +137,21 @@ def get_dataset_index():
 
         GET /api/1/data/ HTTP/1.0
 
+    Results are paged using the dataset id as key: ``start`` is the
+    id of the first returned dataset, ``size`` the page size.
+    The URL of the next page (if any) is sent in the ``Link`` header.
+
+    Passing ``size=all`` will return all the datasets at once,
+    streaming the response as the datasets are read from the database.
+
     **Example response:**
 
     .. code-block:: http
 
         HTTP/1.0 200 OK
         Content-type: application/json
-        Link: ?start=10&size=10; rel=next, ?start=50&size=10; rel=last
-        X-page-total: 60
+        Link: </api/1/data/?start=0&size=10>; rel="first",
+              </api/1/data/?start=11&size=10>; rel="next"
         X-page-start: 0
         X-page-size: 10
 
@@ -94,14 +159,16 @@ def get_dataset_index():
 
             [{"id": 1}, {"id": 2}, {"id": 3}, ..., {"id": 10}]
     """
-    # todo: add paging support
+    if is_export_request():
+        rows = select_all('dataset', fields='id, configuration')
+        return json_stream_array(_iter_datasets_metadata(
+            rows, current_app.config['EXPORT_BATCH_SIZE']))
+
     with db.cursor() as cur:
-        cur.execute("""
-        SELECT id, configuration FROM dataset
-        ORDER BY id ASC
-        """)
-        return [_make_plugins_make_dataset_metadata(x['id'], x['configuration'])
-                for x in cur.fetchall()]
+        rows, headers = select_page(cur, 'dataset', fields='id, configuration')
+
+    return _make_plugins_make_datasets_metadata(
+        [(x['id'], x['configuration']) for x in rows]), 200, headers
 
 
 @core_plugin.route('/data/<int:dataset_id>', methods=['GET'])
@@ -5,16 +5,58 @@ Datacat Geographical Plugin
 - Exports geographical data into various formats
 """
 
+import datetime
+import hashlib
+import json
 import os
-import re
+import time
+import traceback
 
+from celery import chord
+from flask import current_app
+import psycopg2
+import psycopg2.errorcodes
 from werkzeug.exceptions import NotFound
 
-from datacat.db import db, admin_db
+from datacat.db import db, admin_db, querybuilder
 from datacat.ext.base import Plugin
-from datacat.utils.data_extraction import find_shapefiles, shp2pgsql
-from datacat.utils.resource_access import open_resource
+from datacat.storage import store_blob, release_blob, purge_blobs
+from datacat.utils.data_export import (
+    export_csv, export_gml, export_kml, export_shapefile,
+    get_attribute_columns)
+from datacat.utils.data_extraction import (
+    find_shapefiles, shapefile_table_sql, shapefile_copy)
+from datacat.utils.const import DATE_FORMAT
+from datacat.utils.http import serve_resource
+from datacat.utils.resource_access import prefetch_resources
+from datacat.utils.shapefile import ShapefileReader
 from datacat.utils.tempfile import TemporaryDir
+from datacat.web.utils import json_view, streaming_response
+
+# Formats of the cached exports: renderer and mimetype
+EXPORT_FORMATS = {
+    'shp': (export_shapefile, 'application/zip'),
+    'csv': (export_csv, 'text/csv'),
+    'kml': (export_kml, 'application/vnd.google-earth.kml+xml'),
+    'gml': (export_gml, 'application/gml+xml'),
+}
+
+# Statuses of the imports in progress: only one import of a dataset
+# is run at a time, the others are retried after this many seconds.
+IMPORT_ACTIVE_STATUSES = ('discovering', 'importing', 'merging')
+IMPORT_RETRY_AFTER = 30
+
+# Swapping in a merged table has to wait for the readers of the
+# dataset table, while blocking new ones: lock waits are bounded by
+# this timeout (in milliseconds), and retried with an exponential
+# backoff (starting from the delay, in seconds), this many times.
+SWAP_LOCK_TIMEOUT = 2000
+SWAP_RETRY_DELAY = .5
+SWAP_RETRIES = 8
+
+
+class ImportInProgress(Exception):
+    """Another import of the same dataset is in progress"""
 
 
 class GeoPlugin(Plugin):
@@ -36,14 +78,80 @@ class GeoPlugin(Plugin):
         """
         Remove all the previously created tables.
 
-        .. todo:: write this function
+        .. todo:: also drop the imported data tables
         """
-        pass
+        with admin_db, admin_db.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS geo_import;")
+            cur.execute("DROP TABLE IF EXISTS geo_export;")
+
+    def upgrade_1(self):
+        """
+        Create the table keeping track of the imports progress.
+        """
+        with admin_db, admin_db.cursor() as cur:
+            cur.execute("""
+            CREATE TABLE geo_import (
+                id SERIAL PRIMARY KEY,
+                dataset_id INTEGER,
+                status CHARACTER VARYING (32),
+                parts_total INTEGER,
+                parts_done INTEGER,
+                error TEXT,
+                ctime TIMESTAMP WITHOUT TIME ZONE,
+                mtime TIMESTAMP WITHOUT TIME ZONE);
+
+            CREATE INDEX geo_import_dataset_id ON geo_import (dataset_id);
+            """)
+
+    def upgrade_2(self):
+        """
+        Record the fingerprints of the imports, and of the shapefiles
+        they're made of, to allow incremental re-imports.
+        """
+        with admin_db, admin_db.cursor() as cur:
+            cur.execute("""
+            ALTER TABLE geo_import
+                ADD COLUMN fingerprint CHARACTER VARYING (40),
+                ADD COLUMN parts JSON,
+                ADD COLUMN parts_reused INTEGER DEFAULT 0;
+            """)
+
+    def upgrade_3(self):
+        """
+        Create the table keeping track of the exports of the imported
+        data, rendered once per import and stored as resources.
+        """
+        with admin_db, admin_db.cursor() as cur:
+            cur.execute("""
+            CREATE TABLE geo_export (
+                id SERIAL PRIMARY KEY,
+                dataset_id INTEGER,
+                import_id INTEGER,
+                format CHARACTER VARYING (16),
+                status CHARACTER VARYING (32),
+                resource_id INTEGER,
+                error TEXT,
+                ctime TIMESTAMP WITHOUT TIME ZONE,
+                mtime TIMESTAMP WITHOUT TIME ZONE);
+
+            CREATE UNIQUE INDEX geo_export_import_format
+                ON geo_export (import_id, format);
+            CREATE INDEX geo_export_dataset_id ON geo_export (dataset_id);
+            """)
 
 
 geo_plugin = GeoPlugin(__name__)
 
 
+@geo_plugin.hook('make_dataset_metadata_batch')
+def make_dataset_metadata_batch(items):
+    """
+    :hook: ``make_dataset_metadata_batch``
+    """
+    for dataset_id, config, metadata in items:
+        make_dataset_metadata(dataset_id, config, metadata)
+
+
 @geo_plugin.hook('make_dataset_metadata')
 def make_dataset_metadata(dataset_id, config, metadata):
     """
@@ -72,14 +180,33 @@ def on_dataset_create_update(dataset_id, dataset_conf):
     - use some importer to extract geographical information from the resource
     - import the data in a postgis table named after the dataset
 
-    .. todo:: We need a common library to download resources honoring caches
+    Remote resources are downloaded through the resource cache
+    (see :py:mod:`datacat.utils.resource_cache`).
+
+    Nothing is done if the resources and geo configuration are the
+    same as the ones of the latest (not failed) import, eg. if only
+    the metadata changed.
     """
 
-    if dataset_conf.get('geo', {}).get('enabled', False):
-        import_geo_dataset.delay(dataset_id)
+    if not dataset_conf.get('geo', {}).get('enabled', False):
+        return
+
+    with db, db.cursor() as cur:
+        cur.execute("""
+        SELECT fingerprint FROM geo_import
+        WHERE dataset_id = %s AND status <> 'failed'
+        ORDER BY id DESC LIMIT 1;
+        """, (dataset_id,))
+        latest = cur.fetchone()
+
+    if latest is not None and \
+            latest['fingerprint'] == _import_fingerprint(dataset_conf):
+        return
+
+    import_geo_dataset.delay(dataset_id)
 
 
-@geo_plugin.hook(['dataset_delete'])
+@geo_plugin.hook(['dataset_delete'], thread_safe=True)
 def on_dataset_delete(dataset_id):
     """
     On dataset delete, also delete geographical resources.
@@ -95,12 +222,17 @@ def on_dataset_delete(dataset_id):
     # todo: write this
 
 
-@geo_plugin.task(name=__name__ + '.import_geo_dataset')
-def import_geo_dataset(dataset_id):
+@geo_plugin.task(name=__name__ + '.import_geo_dataset', bind=True,
+                 max_retries=None)
+def import_geo_dataset(self, dataset_id):
     """
     Task to import geographical resources from a dataset
     into a PostGIS table.
 
+    If another import of the dataset is in progress, the task is
+    retried (after :py:data:`IMPORT_RETRY_AFTER` seconds) once it's
+    done, with the dataset configuration at that time.
+
     :param dataset_id: Id of the dataset to import
     """
 
@@ -120,24 +252,301 @@ def import_geo_dataset(dataset_id):
         raise ValueError("Requested import for non-geo-enabled dataset")
 
     if conf['geo']['importer'] == 'find_shapefiles':
-        return import_dataset_find_shapefiles(dataset_id, conf)
+        try:
+            return import_dataset_find_shapefiles(dataset_id, conf)
+        except ImportInProgress as e:
+            raise self.retry(exc=e, countdown=IMPORT_RETRY_AFTER)
 
     else:
         raise ValueError("Unsupported importer: {0}"
                          .format(conf['geo']['importer']))
 
 
+@geo_plugin.task(name=__name__ + '.import_geo_shapefiles')
+def import_geo_shapefiles(dataset_id, import_id, parts):
+    """
+    Task importing a chunk of the shapefiles found by
+    :py:func:`import_dataset_find_shapefiles`, each one in
+    its own staging table.
+
+    :param dataset_id: Id of the dataset being imported
+    :param import_id: Id of the ``geo_import`` record
+    :param parts:
+        List of ``(part_id, resource, basename, table)`` tuples,
+        identifying shapefiles inside the resource archives and
+        the tables in which to load them.
+    """
+
+    try:
+        with TemporaryDir() as tempdir:
+            # Resources in this chunk are downloaded once
+            archives = dict(
+                (url, _find_shapefiles(filename, tempdir)) for url, filename
+                in _download_resources(
+                    [resource for _, resource, _, _ in parts], tempdir))
+
+            for part_id, resource, basename, table in parts:
+                shp_full_path = _extract_shapefile(
+                    archives[resource['url']][basename], tempdir)
+
+                _import_shapefile(shp_full_path, table)
+
+                with db, db.cursor() as cur:
+                    cur.execute("""
+                    UPDATE geo_import
+                    SET parts_done = parts_done + 1, mtime = %s
+                    WHERE id = %s;
+                    """, (datetime.datetime.utcnow(), import_id))
+
+    except Exception:
+        _update_import_status(import_id, 'failed', traceback.format_exc())
+        raise
+
+
+@geo_plugin.task(name=__name__ + '.merge_geo_import')
+def merge_geo_import(dataset_id, import_id):
+    """
+    Task merging the shapefile tables of a completed import into the
+    dataset table, replacing it.
+
+    Data is loaded in a new table; its indexes are built after the
+    bulk load, statistics are collected, and only then it is swapped
+    with the dataset table (by renaming it), in a short transaction:
+    readers never see partially loaded data, and a failure leaves the
+    previous table untouched. The swap doesn't queue behind readers of
+    the previous table for more than :py:data:`SWAP_LOCK_TIMEOUT`
+    (which would hold back new readers), but is retried later.
+
+    Shapefile tables which are not part of this import (nor of any
+    other import in progress) are dropped, along with the exports of
+    the previous data.
+
+    :param dataset_id: Id of the dataset being imported
+    :param import_id: Id of the ``geo_import`` record
+    """
+
+    with db, db.cursor() as cur:
+        cur.execute("""
+        UPDATE geo_import SET status = 'merging', mtime = %s
+        WHERE id = %s AND status = 'importing'
+        RETURNING id;
+        """, (datetime.datetime.utcnow(), import_id))
+        if cur.fetchone() is None:
+            return  # Abandoned (eg. timed out) in the meantime
+
+    destination_table = 'geodata_{0}'.format(dataset_id)
+    new_table = _new_table_name(dataset_id)
+    part_tables = [part['table'] for part in _get_import_parts(import_id)]
+
+    try:
+        with db, db.cursor() as cur:
+            # Shapefiles are expected to share the same attributes
+            cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = %s AND column_name <> 'gid'
+            ORDER BY ordinal_position;
+            """, (part_tables[0],))
+            columns = ', '.join('"{0}"'.format(row['column_name'])
+                                for row in cur.fetchall())
+
+            cur.execute("""
+            DROP TABLE IF EXISTS "{new}";
+            CREATE TABLE "{new}" (LIKE "{first}");
+            INSERT INTO "{new}" ("gid", {columns})
+            SELECT row_number() OVER (), {columns} FROM ({parts}) AS parts;
+            ALTER TABLE "{new}"
+                ADD CONSTRAINT "{new}_pkey" PRIMARY KEY ("gid");
+            CREATE INDEX "{new}_geom" ON "{new}" USING GIST ("geom");
+            """.format(
+                new=new_table,
+                first=part_tables[0],
+                columns=columns,
+                parts=' UNION ALL '.join(
+                    'SELECT {0} FROM "{1}"'.format(columns, name)
+                    for name in part_tables)))
+
+        with db, db.cursor() as cur:
+            cur.execute('ANALYZE "{0}";'.format(new_table))
+
+        for attempt in xrange(SWAP_RETRIES + 1):
+            try:
+                _swap_merged_table(dataset_id, import_id,
+                                   new_table, destination_table)
+                break
+            except psycopg2.OperationalError as e:
+                if (e.pgcode != psycopg2.errorcodes.LOCK_NOT_AVAILABLE or
+                        attempt == SWAP_RETRIES):
+                    raise
+            time.sleep(SWAP_RETRY_DELAY * 2 ** attempt)
+
+    except Exception:
+        _update_import_status(import_id, 'failed', traceback.format_exc())
+        raise
+
+    _invalidate_geo_exports(dataset_id, import_id)
+
+
+@geo_plugin.task(name=__name__ + '.cleanup_geo_import')
+def cleanup_geo_import(dataset_id, import_id):
+    """
+    Task dropping the tables created by a failed import (shapefile
+    tables used by the current import, or by imports in progress,
+    are kept). The import is marked as failed, if it wasn't already,
+    so other imports of the dataset can start.
+
+    :param dataset_id: Id of the dataset being imported
+    :param import_id: Id of the ``geo_import`` record
+    """
+
+    with db, db.cursor() as cur:
+        _lock_dataset_imports(cur, dataset_id)
+        cur.execute("""
+        UPDATE geo_import
+        SET status = 'failed', error = COALESCE(error, 'Aborted'), mtime = %s
+        WHERE id = %s AND status = ANY(%s);
+        """, (datetime.datetime.utcnow(), import_id,
+              list(IMPORT_ACTIVE_STATUSES)))
+
+        _drop_unreferenced_tables(cur, dataset_id)
+
+        cur.execute("""
+        SELECT 1 FROM geo_import WHERE dataset_id = %s AND status = ANY(%s)
+        LIMIT 1;
+        """, (dataset_id, list(IMPORT_ACTIVE_STATUSES)))
+        if cur.fetchone() is None:
+            _drop_tables(cur, [_new_table_name(dataset_id)])
+
+
+@geo_plugin.task(name=__name__ + '.render_geo_export')
+def render_geo_export(dataset_id, import_id, export_format):
+    """
+    Task rendering the export of a dataset table to one of the
+    :py:data:`EXPORT_FORMATS`, and storing it as a resource.
+
+    The export is discarded if the import was superseded (or the
+    export rendered by another task) in the meantime.
+
+    :param dataset_id: Id of the dataset to export
+    :param import_id: Id of the ``geo_import`` record of the data
+    :param export_format: the format (eg. ``shp``)
+    """
+
+    render, mimetype = EXPORT_FORMATS[export_format]
+    options = {}
+    if export_format != 'csv':
+        options['batch_size'] = current_app.config['EXPORT_BATCH_SIZE']
+
+    try:
+        with TemporaryDir() as tempdir:
+            filename = os.path.join(tempdir, 'export.' + export_format)
+            with open(filename, 'wb') as fp, db:
+                render(db, 'geodata_{0}'.format(dataset_id), fp, **options)
+            content_hash = 'sha1:' + _file_hash(filename)
+
+            with db, db.cursor() as cur:
+                cur.execute("""
+                SELECT status FROM geo_export
+                WHERE import_id = %s AND format = %s FOR UPDATE;
+                """, (import_id, export_format))
+                record = cur.fetchone()
+                if record is None or record['status'] == 'done':
+                    return
+
+                with open(filename, 'rb') as fp:
+                    blob_store, blob_key = store_blob(
+                        cur, fp, content_hash,
+                        blocksize=current_app.config[
+                            'RESOURCE_UPLOAD_BLOCK_SIZE'])
+
+                now = datetime.datetime.utcnow()
+                data = dict(
+                    metadata='{}',
+                    auto_metadata=json.dumps({'geo_export': {
+                        'dataset_id': dataset_id,
+                        'import_id': import_id,
+                        'format': export_format}}),
+                    mimetype=mimetype,
+                    blob_store=blob_store,
+                    blob_key=blob_key,
+                    ctime=now,
+                    mtime=now,
+                    hash=content_hash)
+                cur.execute(querybuilder.insert('resource', data), data)
+                resource_id = cur.fetchone()[0]
+
+                cur.execute("""
+                UPDATE geo_export
+                SET status = 'done', resource_id = %s, error = NULL,
+                    mtime = %s
+                WHERE import_id = %s AND format = %s;
+                """, (resource_id, now, import_id, export_format))
+
+    except Exception:
+        current_app.logger.exception(
+            'Failed rendering the %s export of import %s',
+            export_format, import_id)
+        with db, db.cursor() as cur:
+            cur.execute("""
+            UPDATE geo_export SET status = 'failed', error = %s, mtime = %s
+            WHERE import_id = %s AND format = %s AND status <> 'done';
+            """, (traceback.format_exc(), datetime.datetime.utcnow(),
+                  import_id, export_format))
+        raise
+
+
+@geo_plugin.route('/data/<int:dataset_id>/geo/import')
+@json_view
+def get_geo_dataset_import_status(dataset_id):
+    """
+    Return the status of the latest import of a geographical dataset.
+
+    :HTTP URL: ``/data/<int:dataset_id>/geo/import``
+
+    **Example response:**
+
+    .. code-block:: python
+
+        {"id": 1, "status": "importing", "parts_total": 12,
+         "parts_done": 5, "parts_reused": 3, "error": null, ...}
+
+    Status is one of ``discovering``, ``importing``, ``merging``,
+    ``done`` or ``failed``; ``parts_total`` is the number of shapefiles
+    found in the dataset resources, ``parts_reused`` the number of
+    them unchanged since the previous import (not imported again).
+    """
+
+    with db, db.cursor() as cur:
+        cur.execute("""
+        SELECT * FROM geo_import WHERE dataset_id = %s
+        ORDER BY id DESC LIMIT 1;
+        """, (dataset_id,))
+        record = cur.fetchone()
+
+    if record is None:
+        raise NotFound("No import found for dataset {0}".format(dataset_id))
+
+    return {'id': record['id'],
+            'status': record['status'],
+            'parts_total': record['parts_total'],
+            'parts_done': record['parts_done'],
+            'parts_reused': record['parts_reused'],
+            'error': record['error'],
+            'ctime': record['ctime'].strftime(DATE_FORMAT),
+            'mtime': record['mtime'].strftime(DATE_FORMAT)}
+
+
 @geo_plugin.route('/data/<int:dataset_id>/export/shp')
 def export_geo_dataset_shp(dataset_id):
     """
     Export dataset to `Esri Shapefile
-    <http://en.wikipedia.org/wiki/Shapefile>`_ format.
+    <http://en.wikipedia.org/wiki/Shapefile>`_ format, as a zip archive.
 
     :HTTP URL: ``/data/<int:dataset_id>/export/shp``
 
-    .. warning:: Not implemented yet
+    See :py:func:`_serve_geo_export`.
     """
-    pass
+
+    return _serve_geo_export(dataset_id, 'shp')
 
 
 @geo_plugin.route('/data/<int:dataset_id>/export/geojson')
@@ -147,9 +556,50 @@ def export_geo_dataset_geojson(dataset_id):
 
     :HTTP URL: ``/data/<int:dataset_id>/export/geojson``
 
-    .. warning:: Not implemented yet
+    The response is a ``FeatureCollection``, streamed as features are
+    read from a server-side cursor (``EXPORT_BATCH_SIZE`` at a time);
+    features are encoded to JSON by PostgreSQL. The response is
+    gzip-compressed if the client accepts it.
     """
-    pass
+
+    table = 'geodata_{0}'.format(dataset_id)
+    with db, db.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL;",
+                    ('"{0}"'.format(table),))
+        if not cur.fetchone()[0]:
+            raise NotFound("No geographical data for dataset {0}"
+                           .format(dataset_id))
+        columns = [name for name, _ in get_attribute_columns(cur, table)]
+
+    if columns:
+        properties = '(SELECT row_to_json(p) FROM (SELECT {0}) AS p)'.format(
+            ', '.join('"{0}"'.format(name) for name in columns))
+    else:
+        properties = "'{}'"
+
+    query = """
+    SELECT '{{"type": "Feature", "id": ' || gid || ', "geometry": ' ||
+           COALESCE(ST_AsGeoJSON("geom"), 'null') || ', "properties": ' ||
+           {properties} || '}}'
+    FROM "{table}" ORDER BY gid;
+    """.format(table=table, properties=properties)
+    itersize = current_app.config['EXPORT_BATCH_SIZE']
+
+    def _generate():
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = ''
+        with db, db.cursor(name='datacat_export_geojson') as cur:
+            cur.itersize = itersize
+            cur.execute(query)
+            while True:
+                rows = cur.fetchmany(itersize)
+                if not rows:
+                    break
+                yield separator + ', '.join(row[0] for row in rows)
+                separator = ', '
+        yield ']}'
+
+    return streaming_response(_generate(), 'application/vnd.geo+json')
 
 
 @geo_plugin.route('/data/<int:dataset_id>/export/csv')
@@ -162,9 +612,10 @@ def export_geo_dataset_csv(dataset_id):
 
     :HTTP URL: ``/data/<int:dataset_id>/export/csv``
 
-    .. warning:: Not implemented yet
+    See :py:func:`_serve_geo_export`.
     """
-    pass
+
+    return _serve_geo_export(dataset_id, 'csv')
 
 
 @geo_plugin.route('/data/<int:dataset_id>/export/kml')
@@ -176,9 +627,10 @@ def export_geo_dataset_kml(dataset_id):
 
     :HTTP URL: ``/data/<int:dataset_id>/export/kml``
 
-    .. warning:: Not implemented yet
+    See :py:func:`_serve_geo_export`.
     """
-    pass
+
+    return _serve_geo_export(dataset_id, 'kml')
 
 
 @geo_plugin.route('/data/<int:dataset_id>/export/gml')
@@ -189,15 +641,119 @@ def export_geo_dataset_gml(dataset_id):
 
     :HTTP URL: ``/data/<int:dataset_id>/export/gml``
 
-    .. warning:: Not implemented yet
+    See :py:func:`_serve_geo_export`.
     """
-    pass
+
+    return _serve_geo_export(dataset_id, 'gml')
+
+
+def _serve_geo_export(dataset_id, export_format):
+    """
+    Serve the export of a dataset to one of the :py:data:`EXPORT_FORMATS`.
+
+    Exports are rendered once for each import of the data (by the
+    :py:func:`render_geo_export` task, started by the first request),
+    stored as resources and served by
+    :py:func:`~datacat.utils.http.serve_resource` (with ``ETag`` and
+    ``Last-Modified`` headers). They're deleted once a new import
+    is done.
+
+    Until the export is ready, ``202 Accepted`` is returned, along with
+    a ``Retry-After`` header; ``500`` if rendering it failed (it will be
+    retried after ``GEO_EXPORT_RETRY_FAILED`` seconds), with a generic
+    error message: the traceback is recorded in the ``geo_export``
+    table, and logged by the task (or here, if the task couldn't be
+    scheduled). Renders taking longer than ``GEO_EXPORT_RENDER_TIMEOUT``
+    seconds are considered lost.
+    """
+
+    current = _get_current_import(dataset_id)
+    if current is None:
+        raise NotFound("No geographical data for dataset {0}"
+                       .format(dataset_id))
+    import_id = current['id']
+
+    config = current_app.config
+    retry_failed = datetime.timedelta(
+        seconds=config['GEO_EXPORT_RETRY_FAILED'])
+    render_timeout = datetime.timedelta(
+        seconds=config['GEO_EXPORT_RENDER_TIMEOUT'])
+
+    now = datetime.datetime.utcnow()
+    queued = False
+    with db, db.cursor() as cur:
+        # Serialize the creation of the export records of this import
+        cur.execute("SELECT id FROM geo_import WHERE id = %s FOR UPDATE;",
+                    (import_id,))
+        cur.execute("""
+        SELECT status, resource_id, mtime FROM geo_export
+        WHERE import_id = %s AND format = %s;
+        """, (import_id, export_format))
+        export = cur.fetchone()
+
+        if export is None:
+            cur.execute("""
+            INSERT INTO geo_export
+            (dataset_id, import_id, format, status, ctime, mtime)
+            VALUES (%s, %s, %s, 'rendering', %s, %s);
+            """, (dataset_id, import_id, export_format, now, now))
+            queued = True
+
+        elif export['status'] != 'done' and export['mtime'] < now - (
+                retry_failed if export['status'] == 'failed'
+                else render_timeout):
+            # Failed, or the task got lost
+            cur.execute("""
+            UPDATE geo_export SET status = 'rendering', error = NULL,
+                mtime = %s
+            WHERE import_id = %s AND format = %s;
+            """, (now, import_id, export_format))
+            queued = True
+
+    if queued:
+        try:
+            render_geo_export.delay(dataset_id, import_id, export_format)
+        except Exception:
+            # The record was already committed: mark it as failed, or
+            # it would be reported as rendering until considered lost.
+            current_app.logger.exception(
+                'Failed scheduling %s export of import %s',
+                export_format, import_id)
+            with db, db.cursor() as cur:
+                cur.execute("""
+                UPDATE geo_export SET status = 'failed', error = %s,
+                    mtime = %s
+                WHERE import_id = %s AND format = %s
+                AND status = 'rendering';
+                """, (traceback.format_exc(), datetime.datetime.utcnow(),
+                      import_id, export_format))
+            return _json_response({'status': 'failed',
+                                   'error': 'Rendering the export failed'},
+                                  500)
+
+    elif export['status'] == 'done':
+        return serve_resource(export['resource_id'])
+
+    elif export['status'] == 'failed':
+        # Details (the traceback) are only kept in the export record
+        return _json_response({'status': 'failed',
+                               'error': 'Rendering the export failed'}, 500)
+
+    retry_after = config['GEO_EXPORT_RETRY_AFTER']
+    return _json_response({'status': 'rendering'}, 202,
+                          {'Retry-After': str(retry_after)})
 
 
 # ----------------------------------------------------------------------
 # Utility functions
 # ----------------------------------------------------------------------
 
+def _json_response(data, status, headers=None):
+    return current_app.response_class(
+        json.dumps(data), status=status, headers=headers,
+        mimetype='application/json')
+
+
 def _random_file_name(ext=None):
     name = os.urandom(20).encode('hex')
     if ext is not None:
@@ -205,112 +761,389 @@ def _random_file_name(ext=None):
     return name
 
 
-def _copy_resource_to_file(resource, filename):
-    res_object = open_resource(resource['url'])
-    with open(filename, 'wb') as fp:
-        res_object.save_to_file(fp)
+def import_dataset_find_shapefiles(dataset_id, dataset_conf):
+    """
+    Find all the Shapefiles from archives listed as dataset resources,
+    and start importing them.
+
+    Each shapefile is loaded in its own table, named after a fingerprint
+    of its inputs (see :py:func:`_shapefile_fingerprint`): tables of the
+    shapefiles that didn't change since the latest successful import
+    are reused as they are.
 
+    The other shapefiles are split in (at most) ``GEO_IMPORT_CONCURRENCY``
+    chunks, imported in parallel by :py:func:`import_geo_shapefiles`
+    tasks; once they're all done, :py:func:`merge_geo_import` is run to
+    create the dataset table. Progress is recorded in the ``geo_import``
+    table.
 
-def _get_internal_resource_data(resource_id):
-    """Get all data form an internally-stored resource"""
+    Imports of the same dataset are serialized, as they share tables:
+    imports in progress for longer than ``GEO_IMPORT_TIMEOUT`` (without
+    making any progress) are considered lost, and marked as failed.
 
-    # todo: improve this function to avoid keeping the whole thing in memory
-    # todo: also, make this more generic (and move from here)
+    :param dataset_id: The dataset id
+    :param dataset_conf: The dataset configuration
+    :return: the id of the ``geo_import`` record
+    :raises ImportInProgress:
+        if another import of the dataset is in progress
+    """
 
+    now = datetime.datetime.utcnow()
+    timeout = datetime.timedelta(
+        seconds=current_app.config['GEO_IMPORT_TIMEOUT'])
     with db, db.cursor() as cur:
+        _lock_dataset_imports(cur, dataset_id)
+
         cur.execute("""
-        SELECT id, mimetype, data_oid FROM "resource" WHERE id = %(id)s;
-        """, dict(id=resource_id))
-        resource = cur.fetchone()
+        UPDATE geo_import SET status = 'failed', error = 'Timed out',
+            mtime = %s
+        WHERE dataset_id = %s AND status = ANY(%s) AND mtime < %s;
+        """, (now, dataset_id, list(IMPORT_ACTIVE_STATUSES), now - timeout))
 
-    if resource is None:
-        raise NotFound()
+        cur.execute("""
+        SELECT 1 FROM geo_import WHERE dataset_id = %s AND status = ANY(%s)
+        LIMIT 1;
+        """, (dataset_id, list(IMPORT_ACTIVE_STATUSES)))
+        import_id = None
+        if cur.fetchone() is None:
+            cur.execute("""
+            INSERT INTO geo_import
+            (dataset_id, status, parts_total, parts_done, fingerprint,
+             ctime, mtime)
+            VALUES (%s, 'discovering', 0, 0, %s, %s, %s)
+            RETURNING id;
+            """, (dataset_id, _import_fingerprint(dataset_conf), now, now))
+            import_id = cur.fetchone()[0]
+
+    if import_id is None:
+        raise ImportInProgress(dataset_id)
+
+    parts = []
+    try:
+        resources = [{'url': resource}
+                     if isinstance(resource, basestring) else resource
+                     for resource in dataset_conf['resources']]
+
+        with TemporaryDir() as tempdir:
+            downloaded = dict(_download_resources(resources, tempdir))
+
+            for resource in resources:
+                # Let's look for shapefiles inside that thing..
+                filename = downloaded[resource['url']]
+                found = _find_shapefiles(filename, tempdir)
+
+                # Tar archives don't store checksums of their members
+                resource_hash = None
+                if any(item.crc is None for files in found.itervalues()
+                       for item in files.itervalues()):
+                    resource_hash = _file_hash(filename)
+
+                for basename, files in sorted(found.iteritems()):
+                    if 'shp' not in files:
+                        continue  # Bad match..
+                    table = _part_table_name(
+                        dataset_id, _shapefile_fingerprint(
+                            resource['url'], basename, files, resource_hash))
+                    if any(part[3] == table for part in parts):
+                        continue  # Same resource listed twice
+                    parts.append((len(parts), resource, basename, table))
+
+        if not parts:
+            raise ValueError("No shapefiles found in dataset {0}"
+                             .format(dataset_id))
+
+    except Exception:
+        _update_import_status(import_id, 'failed', traceback.format_exc())
+        raise
+
+    previous = _get_current_tables(dataset_id)
+    tables = [table for _, _, _, table in parts]
+    changed = [part for part in parts if part[3] not in previous]
 
-    with db:
-        lobject = db.lobject(oid=resource['data_oid'], mode='rb')
-        data = lobject.read()
-        lobject.close()
+    with db, db.cursor() as cur:
+        cur.execute("""
+        UPDATE geo_import
+        SET status='importing', parts=%s, parts_total=%s, parts_done=%s,
+            parts_reused=%s, mtime=%s
+        WHERE id=%s;
+        """, (json.dumps([{'table': table, 'reused': table in previous}
+                          for table in tables]),
+              len(parts), len(parts) - len(changed),
+              len(parts) - len(changed), datetime.datetime.utcnow(),
+              import_id))
+
+    if tables == previous:
+        # Nothing changed: the dataset table (and exports of its
+        # data) are already up to date
+        previous_id = _get_current_import(dataset_id)['id']
+        _update_import_status(import_id, 'done')
+        _invalidate_geo_exports(dataset_id, import_id, previous_id)
+        return import_id
+
+    # Failed imports are cleaned up, whether any shapefile was imported
+    merge = merge_geo_import.si(dataset_id, import_id)
+    merge.link_error(cleanup_geo_import.si(dataset_id, import_id))
+    if not changed:
+        merge.delay()
+        return import_id
+
+    # Contiguous chunks, so shapefiles from the same resource
+    # are likely to be handled by the same task
+    chunks_count = min(len(changed),
+                       current_app.config['GEO_IMPORT_CONCURRENCY'])
+    chunks = [changed[len(changed) * i // chunks_count:
+                      len(changed) * (i + 1) // chunks_count]
+              for i in xrange(chunks_count)]
+
+    chord([import_geo_shapefiles.si(dataset_id, import_id, chunk)
+           for chunk in chunks])(merge)
+
+    return import_id
+
+
+def _download_resources(resources, tempdir):
+    """
+    Download resources (concurrently) to a temporary directory.
 
-    return data
+    :return: list of ``(url, filename)`` tuples, one per distinct URL
+    """
 
+    urls = sorted(set(resource['url'] for resource in resources))
+    return zip(urls, prefetch_resources(urls, tempdir))
 
-def import_dataset_find_shapefiles_DUMMY(dataset_id, dataset_conf):
-    with admin_db, admin_db.cursor() as cur:
-        cur.execute("""
-        CREATE TABLE geodata_{0} (
-            key CHARACTER VARYING (256) PRIMARY KEY,
-            value TEXT);
-        """.format(dataset_id))
 
+def _find_shapefiles(filename, tempdir):
+    """
+    Find shapefiles in a downloaded resource, extracting nested
+    archives to ``tempdir`` within the ``GEO_NESTED_ARCHIVES`` limits.
+    """
 
-def import_dataset_find_shapefiles(dataset_id, dataset_conf):
+    return find_shapefiles(filename, tempdir=tempdir,
+                           **current_app.config['GEO_NESTED_ARCHIVES'])
+
+
+def _extract_shapefile(files, tempdir):
     """
-    Find all the Shapefiles from archives listed as dataset resources.
+    Extract a shapefile (along with the related files) from an
+    archive, returning the path to the ``.shp`` file.
 
-    :param dataset_id: The dataset id
-    :param dataset_conf: The dataset configuration
+    :param files: dict mapping extensions to archived files
     """
 
-    destination_table = 'geodata_{0}'.format(dataset_id)
+    base_name = _random_file_name()
+    for ext, item in files.iteritems():
+        item.extract_to(os.path.join(tempdir, base_name + '.' + ext))
+    return os.path.join(tempdir, base_name + '.shp')
 
-    create_table_sqls = []
-    import_data_sqls = []
 
-    with TemporaryDir() as tempdir:
-        # First, copy zip files to temporary directory
+def _import_shapefile(shp_full_path, table):
+    """Create a table and load the shapefile data into it"""
 
-        for resource in dataset_conf['resources']:
-            # We assume the file is a zip, but we should double-check that!
-            dest_file = os.path.join(tempdir, _random_file_name('zip'))
+    with ShapefileReader(shp_full_path) as reader:
+        with admin_db, admin_db.cursor() as cur:
+            # Left over by an interrupted import?
+            _drop_tables(cur, [table])
+            # Indexes are only built on the merged table
+            cur.execute(shapefile_table_sql(
+                reader, table, geometry_column='geom', primary_key=False))
 
-            if isinstance(resource, basestring):
-                resource = {'url': resource}
+        # Records are decoded in-process and sent via binary COPY
+        with db, db.cursor() as cur:
+            shapefile_copy(cur, reader, table, geometry_column='geom')
 
-            # Copy the resource to disk
-            _copy_resource_to_file(resource, dest_file)
 
-            # Let's look for shapefiles inside that thing..
-            found = find_shapefiles(dest_file)
-            for basename, files in found.iteritems():
-                if 'shp' not in files:
-                    continue  # Bad match..
+def _import_fingerprint(dataset_conf):
+    """
+    Fingerprint of the parts of a dataset configuration
+    affecting the geographical import.
+    """
 
-                # Export shapefiles to temporary files
-                base_name = _random_file_name()
-                for ext, item in files.iteritems():
-                    dest = os.path.join(tempdir, base_name + '.' + ext)
+    data = json.dumps([dataset_conf.get('resources'),
+                       dataset_conf.get('geo')], sort_keys=True)
+    return hashlib.sha1(data).hexdigest()
 
-                    with open(dest, 'wb') as fp:
-                        # todo: copy file in chunks, not as a whole
-                        fp.write(item.open().read())
 
-                shp_full_path = os.path.join(tempdir, base_name + '.shp')
+def _shapefile_fingerprint(url, basename, files, resource_hash=None):
+    """
+    Fingerprint of the inputs of a shapefile: resource URL, name
+    and size of the archive members, plus their CRC if stored in
+    the archive, or else the hash of the whole resource.
+
+    :param files: dict mapping extensions to archived files
+    """
+
+    members = [(ext, item.name, item.size,
+                resource_hash if item.crc is None else item.crc)
+               for ext, item in sorted(files.iteritems())]
+    data = json.dumps([url, basename, members])
+    return hashlib.sha1(data).hexdigest()
+
+
+def _file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(64 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
 
-                create_table_sql = shp2pgsql(
-                    shp_full_path,
-                    table=destination_table,
-                    create_table_only=True, mode='create',
-                    geometry_column='geom', create_gist_index=True)
 
-                # Use TEXT fields instead of varchar(XX)
-                # todo: use a less-hackish way!!
-                create_table_sql = re.sub(
-                    r'varchar\([0-9]+\)', 'text', create_table_sql,
-                    flags=re.IGNORECASE)
+def _part_table_name(dataset_id, fingerprint):
+    return 'geodata_{0}_part_{1}'.format(dataset_id, fingerprint[:16])
 
-                import_data_sql = shp2pgsql(
-                    shp_full_path,
-                    table=destination_table,
-                    mode='append',
-                    geometry_column='geom',
-                    create_gist_index=False)
 
-                create_table_sqls.append(create_table_sql)
-                import_data_sqls.append(import_data_sql)
+def _new_table_name(dataset_id):
+    """Name of the table being loaded, replacing the dataset one"""
+    return 'geodata_{0}_new'.format(dataset_id)
 
-    with admin_db, admin_db.cursor() as cur:
-        cur.execute(create_table_sqls[0])
+
+def _get_import_parts(import_id):
+    """
+    Return the shapefile tables of an import, as a list of
+    ``{"table": ..., "reused": ...}`` dicts.
+    """
 
     with db, db.cursor() as cur:
-        for sql in import_data_sqls:
-            cur.execute(sql)
+        cur.execute("SELECT parts FROM geo_import WHERE id = %s;",
+                    (import_id,))
+        return cur.fetchone()['parts'] or []
+
+
+def _get_current_import(dataset_id):
+    """
+    Return the ``geo_import`` record (``id`` and ``parts``) of the
+    latest successful import of a dataset, or ``None``.
+    """
+
+    with db, db.cursor() as cur:
+        cur.execute("""
+        SELECT id, parts FROM geo_import
+        WHERE dataset_id = %s AND status = 'done'
+        ORDER BY id DESC LIMIT 1;
+        """, (dataset_id,))
+        return cur.fetchone()
+
+
+def _get_current_tables(dataset_id):
+    """
+    Return the names of the shapefile tables making up
+    the current dataset table.
+    """
+
+    record = _get_current_import(dataset_id)
+    if record is None or record['parts'] is None:
+        return []
+    return [part['table'] for part in record['parts']]
+
+
+def _drop_tables(cur, tables):
+    for name in tables:
+        cur.execute('DROP TABLE IF EXISTS "{0}";'.format(name))
+
+
+def _swap_merged_table(dataset_id, import_id, new_table, destination_table):
+    """
+    Replace the dataset table with the merged one, completing the
+    import, unless it was abandoned in the meantime.
+
+    :raises psycopg2.OperationalError:
+        if a lock couldn't be acquired within :py:data:`SWAP_LOCK_TIMEOUT`
+    """
+
+    with db, db.cursor() as cur:
+        cur.execute("SET LOCAL lock_timeout = %s;", (SWAP_LOCK_TIMEOUT,))
+
+        _lock_dataset_imports(cur, dataset_id)
+        cur.execute("SELECT status FROM geo_import WHERE id = %s;",
+                    (import_id,))
+        if cur.fetchone()['status'] != 'merging':
+            raise ValueError("Import {0} was abandoned".format(import_id))
+
+        cur.execute("""
+        DROP TABLE IF EXISTS "{dest}";
+        ALTER TABLE "{new}" RENAME TO "{dest}";
+        ALTER INDEX "{new}_pkey" RENAME TO "{dest}_pkey";
+        ALTER INDEX "{new}_geom" RENAME TO "{dest}_geom";
+        UPDATE geo_import SET status = 'done', mtime = %s
+        WHERE id = %s;
+        """.format(dest=destination_table, new=new_table),
+            (datetime.datetime.utcnow(), import_id))
+
+        _drop_unreferenced_tables(cur, dataset_id)
+
+
+def _lock_dataset_imports(cur, dataset_id):
+    """
+    Acquire a (transaction-level) lock serializing changes to the
+    imports of a dataset, and to their tables.
+    """
+
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s);",
+                ('geo_import', dataset_id))
+
+
+def _drop_unreferenced_tables(cur, dataset_id):
+    """
+    Drop the shapefile tables of a dataset which are neither part of
+    its current import, nor of an import in progress.
+    """
+
+    pattern = _part_table_name(dataset_id, '').replace('_', '\\_') + '%'
+    cur.execute("""
+    SELECT table_name::text FROM information_schema.tables
+    WHERE table_name LIKE %(pattern)s
+    EXCEPT
+    SELECT part->>'table' FROM geo_import, json_array_elements(parts) part
+    WHERE dataset_id = %(dataset_id)s AND (
+        status = ANY(%(active)s) OR id = (
+            SELECT max(id) FROM geo_import
+            WHERE dataset_id = %(dataset_id)s AND status = 'done'));
+    """, dict(pattern=pattern, dataset_id=dataset_id,
+              active=list(IMPORT_ACTIVE_STATUSES)))
+    _drop_tables(cur, [row[0] for row in cur.fetchall()])
+
+
+def _invalidate_geo_exports(dataset_id, import_id, previous_id=None):
+    """
+    Delete the exports of the data of a dataset, along with their
+    resources, once a new import is done.
+
+    :param import_id: Id of the new import
+    :param previous_id:
+        Id of the previous import, if the data didn't change:
+        its (completed) exports are kept, for the new import.
+    """
+
+    released = []
+    with db, db.cursor() as cur:
+        if previous_id is not None:
+            cur.execute("""
+            UPDATE geo_export SET import_id = %s
+            WHERE import_id = %s AND status = 'done';
+            """, (import_id, previous_id))
+
+        cur.execute("""
+        DELETE FROM geo_export WHERE dataset_id = %s AND import_id <> %s
+        RETURNING resource_id;
+        """, (dataset_id, import_id))
+        resource_ids = [row['resource_id'] for row in cur.fetchall()
+                        if row['resource_id'] is not None]
+
+        if resource_ids:
+            cur.execute("""
+            DELETE FROM "resource" WHERE id = ANY(%s)
+            RETURNING blob_store, blob_key, hash;
+            """, (resource_ids,))
+            for resource in cur.fetchall():
+                released.append(release_blob(
+                    cur, resource['blob_store'], resource['blob_key'],
+                    resource['hash']))
+
+    purge_blobs(blob for blob in released if blob is not None)
+
+
+def _update_import_status(import_id, status, error=None):
+    with db, db.cursor() as cur:
+        cur.execute("""
+        UPDATE geo_import SET status=%s, error=%s, mtime=%s
+        WHERE id=%s;
+        """, (status, error, datetime.datetime.utcnow(), import_id))
@@ -21,17 +21,117 @@ DATABASE = {
     'port': 5432,
 }
 
+# Connections are pooled (per process) and handed out to each
+# application context (request, task, ...) that needs one.
+# ``timeout`` is the maximum number of seconds to wait for a
+# connection when the pool is full.
+DATABASE_POOL = {
+    'minconn': 1,
+    'maxconn': 20,
+    'timeout': 30,
+}
+
 PLUGINS = [
     'datacat.ext.core:core_plugin',
     'datacat.ext.geo:geo_plugin',
 ]
 
+# Stores for resource data: names (recorded along with each resource)
+# map to the store class and its options. New data is written to the
+# ``BLOB_STORE_DEFAULT`` store; use ``python -m datacat.cli.migrate_blobs``
+# to move existing data between stores.
+BLOB_STORES = {
+    'lo': {
+        'class': 'datacat.storage:LargeObjectBlobStore',
+    },
+    'fs': {
+        'class': 'datacat.storage:FilesystemBlobStore',
+        'path': None,
+    },
+}
+BLOB_STORE_DEFAULT = 'lo'
+
+# Serve blobs stored as local files by setting the ``X-Sendfile``
+# header, leaving the transfer to the front-end web server.
+USE_X_SENDFILE = False
+
+# Size of the chunks in which uploaded resource data is read from the
+# request body and written to the storage.
+RESOURCE_UPLOAD_BLOCK_SIZE = 64 * 1024
+
+# Uploaded data is spooled (in memory up to this size, then to a
+# temporary file) to compute its hash before it is stored, so that
+# resources with the same data can share the same large object.
+RESOURCE_UPLOAD_SPOOL_SIZE = 10 * 1024 * 1024
+
+# Default and maximum number of items returned by paged listings
+# (eg. ``GET /api/1/data/?start=0&size=100``)
+PAGE_SIZE_DEFAULT = 100
+PAGE_SIZE_MAX = 1000
+
+# Listings can also be exported at once (passing ``size=all``):
+# records are then fetched from a server-side cursor in batches
+# of this size, and streamed to the client. Exports of geographical
+# data read features in batches of the same size.
+EXPORT_BATCH_SIZE = 1000
+
+# Size of the thread pool used to run thread-safe hook handlers
+# concurrently (see ``PluginManager.call_hook_parallel()``)
+PLUGINS_HOOK_THREADS = 4
+
+# Maximum number of tasks importing shapefiles of the same
+# geographical dataset in parallel
+GEO_IMPORT_CONCURRENCY = 4
+
+# Seconds after which an import making no progress is considered
+# lost, letting other imports of the same dataset run
+GEO_IMPORT_TIMEOUT = 6 * 3600
+
+# Seconds after which clients should check again for an export being
+# rendered; failed renders are retried after GEO_EXPORT_RETRY_FAILED
+# seconds, and renders still going on after GEO_EXPORT_RENDER_TIMEOUT
+# seconds are considered lost (and retried).
+GEO_EXPORT_RETRY_AFTER = 5
+GEO_EXPORT_RETRY_FAILED = 10 * 60
+GEO_EXPORT_RENDER_TIMEOUT = 6 * 3600
+
+# Limits on the archives nested inside geographical resources:
+# maximum nesting level, maximum total size extracted to temporary
+# storage (for each resource) and number of threads scanning them.
+GEO_NESTED_ARCHIVES = {
+    'max_depth': 3,
+    'max_size': 1024 ** 3,
+    'threads': 4,
+}
+
 RESOURCE_ACCESSORS = {
     'http': 'datacat.utils.resource_access:HttpResourceAccessor',
     'https': 'datacat.utils.resource_access:HttpResourceAccessor',
     'internal': 'datacat.utils.resource_access:InternalResourceAccessor',
 }
 
+# HTTP(S) connections used to download resources are pooled (per
+# process); failed requests (connection errors, 5xx responses) are
+# retried up to ``retries`` times, with exponential backoff.
+# ``timeout`` is in seconds.
+HTTP_SESSION = {
+    'pool_maxsize': 10,
+    'retries': 3,
+    'backoff_factor': 0.5,
+    'timeout': 60,
+}
+
+# Number of resources downloaded concurrently by prefetch_resources()
+RESOURCE_PREFETCH_THREADS = 4
+
+# On-disk cache for resources downloaded via HTTP(S): ``path`` defaults
+# to a directory inside the system temporary directory, ``max_size``
+# is in bytes. Set to ``None`` to disable caching.
+RESOURCE_CACHE = {
+    'path': None,
+    'max_size': 1024 ** 3,
+}
+
 
 # ============================================================
 #     Celery configuration
@@ -44,3 +144,6 @@ CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
 # CELERY_ACCEPT_CONTENT = ['pickle', 'json', 'msgpack', 'yaml']
 CELERY_ACCEPT_CONTENT = ['json', 'msgpack', 'yaml']
+
+# Modules containing tasks provided by the core
+CELERY_IMPORTS = ['datacat.tasks']
@@ -0,0 +1,308 @@
+"""
+Blob stores, holding the resource data.
+
+Each resource records the name of the store holding its data
+(``blob_store`` column) and the key identifying the data inside the
+store (``blob_key`` column). Stores are configured by the
+``BLOB_STORES`` setting; new data is written to ``BLOB_STORE_DEFAULT``.
+
+The stores distributed with the core are:
+
++---------------------------------+--------------------------------------+
+| Class                           | Storage                              |
++=================================+======================================+
+| :py:class:`LargeObjectBlobStore`| PostgreSQL large objects             |
++---------------------------------+--------------------------------------+
+| :py:class:`FilesystemBlobStore` | Local directory, addressed by hash   |
++---------------------------------+--------------------------------------+
+"""
+
+from __future__ import absolute_import
+
+import abc
+import errno
+import os
+import tempfile
+
+from flask import current_app
+
+from datacat.db import db
+from datacat.utils.files import file_copy
+from datacat.utils.plugin_loading import import_object
+
+
+def get_blob_store(name=None):
+    """
+    Return an instance of the blob store configured as ``name``
+    in ``BLOB_STORES`` (defaults to ``BLOB_STORE_DEFAULT``).
+
+    :raises KeyError: if no such store is configured
+    """
+
+    if name is None:
+        name = current_app.config['BLOB_STORE_DEFAULT']
+    options = dict(current_app.config['BLOB_STORES'][name])
+    store_class = options.pop('class')
+    if isinstance(store_class, basestring):
+        store_class = import_object(store_class)
+    return store_class(**options)
+
+
+def lock_blob(cur, content_hash):
+    """
+    Acquire a (transaction-level) lock on the blobs with the given
+    content hash, to serialize their creation and deletion.
+    """
+
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));",
+                (content_hash,))
+
+
+def store_blob(cur, src, content_hash, blocksize=64 * 1024):
+    """
+    Store data in a blob, returning a ``(blob_store, blob_key)`` tuple:
+    if a resource with the same hash exists, its blob is shared,
+    otherwise a new one is created in the default store.
+
+    Blobs are reference-counted by the resource records pointing
+    to them (see :py:func:`release_blob`).
+
+    :param cur: cursor, in the transaction creating the resource
+    :param src: an object with a ``.read(size)`` method
+    :param content_hash: hash of the data, as ``sha1:<hexdigest>``
+    """
+
+    lock_blob(cur, content_hash)
+
+    cur.execute("""
+    SELECT blob_store, blob_key FROM "resource" WHERE hash = %(hash)s
+    LIMIT 1;
+    """, dict(hash=content_hash))
+    row = cur.fetchone()
+    if row is not None:
+        return row['blob_store'], row['blob_key']
+
+    store_name = current_app.config['BLOB_STORE_DEFAULT']
+    blob_key = get_blob_store(store_name).create(
+        db, src, content_hash, blocksize=blocksize)
+    return store_name, blob_key
+
+
+def release_blob(cur, blob_store, blob_key, content_hash):
+    """
+    Delete a blob, unless other resources still reference it.
+    To be called once the reference has been removed.
+
+    Only blobs from transactional stores are deleted right away: the
+    others would be lost if the transaction was rolled back. They are
+    returned instead, as a ``(blob_store, blob_key, content_hash)``
+    tuple, to be passed to :py:func:`purge_blobs` after committing.
+
+    :return: the blob to purge, or ``None``
+    """
+
+    lock_blob(cur, content_hash)
+    if _is_blob_referenced(cur, blob_store, blob_key):
+        return None
+
+    store = get_blob_store(blob_store)
+    if store.transactional:
+        store.delete(db, blob_key)
+        return None
+    return blob_store, blob_key, content_hash
+
+
+def purge_blobs(blobs):
+    """
+    Delete blobs returned by :py:func:`release_blob`, once the
+    transaction removing their references has been committed.
+
+    References are checked again (with the blob locked), as the same
+    data might have been stored again in the meantime.
+
+    :param blobs: iterable of ``(blob_store, blob_key, content_hash)``
+    """
+
+    for blob_store, blob_key, content_hash in blobs:
+        with db, db.cursor() as cur:
+            lock_blob(cur, content_hash)
+            if not _is_blob_referenced(cur, blob_store, blob_key):
+                get_blob_store(blob_store).delete(db, blob_key)
+
+
+def _is_blob_referenced(cur, blob_store, blob_key):
+    cur.execute("""
+    SELECT 1 FROM "resource"
+    WHERE blob_store = %(store)s AND blob_key = %(key)s LIMIT 1;
+    """, dict(store=blob_store, key=blob_key))
+    return cur.fetchone() is not None
+
+
+def migrate_blobs(source, dest, blocksize=64 * 1024):
+    """
+    Generator moving all the blobs from the ``source`` store to the
+    ``dest`` one, updating the resources pointing to them.
+
+    Each blob is moved in its own transaction, so the migration can
+    safely be interrupted, and run while the application is serving
+    requests.
+
+    :param source: name of the source store
+    :param dest: name of the destination store
+    :return: yields the keys of the moved blobs (in the source store)
+    """
+
+    source_store = get_blob_store(source)
+    dest_store = get_blob_store(dest)
+
+    while True:
+        with db, db.cursor() as cur:
+            cur.execute("""
+            SELECT blob_key, hash FROM "resource" WHERE blob_store = %s
+            LIMIT 1;
+            """, (source,))
+            row = cur.fetchone()
+            if row is None:
+                return
+
+            lock_blob(cur, row['hash'])
+
+            src = source_store.open(db, row['blob_key'])
+            try:
+                dest_key = dest_store.create(db, src, row['hash'],
+                                             blocksize=blocksize)
+            finally:
+                src.close()
+
+            cur.execute("""
+            UPDATE "resource" SET blob_store = %s, blob_key = %s
+            WHERE blob_store = %s AND blob_key = %s;
+            """, (dest, dest_key, source, row['blob_key']))
+
+            if source_store.transactional:
+                source_store.delete(db, row['blob_key'])
+
+        if not source_store.transactional:
+            purge_blobs([(source, row['blob_key'], row['hash'])])
+
+        yield row['blob_key']
+
+
+class BaseBlobStore(object):
+    __metaclass__ = abc.ABCMeta
+
+    #: Whether changes to the blobs are part of the database
+    #: transaction (i.e. undone on rollback)
+    transactional = False
+
+    @abc.abstractmethod
+    def create(self, conn, src, content_hash, blocksize=64 * 1024):
+        """
+        Store data read from a file-like object.
+
+        :param conn: database connection (in the current transaction)
+        :param src: an object with a ``.read(size)`` method
+        :param content_hash: hash of the data, as ``sha1:<hexdigest>``
+        :return: the key of the new blob
+        """
+        pass
+
+    @abc.abstractmethod
+    def open(self, conn, key):
+        """
+        Return a file-like object (supporting ``read()``, ``seek()``,
+        ``tell()`` and ``close()``) to read a blob.
+        """
+        pass
+
+    @abc.abstractmethod
+    def delete(self, conn, key):
+        """Delete a blob"""
+        pass
+
+    def get_filename(self, key):
+        """
+        Return the path to a local file containing the blob (so it can
+        be served without copying data), or ``None`` if not supported.
+        """
+        return None
+
+
+class LargeObjectBlobStore(BaseBlobStore):
+    """
+    Store blobs as PostgreSQL large objects; keys are the object ids.
+    """
+
+    transactional = True
+
+    def create(self, conn, src, content_hash, blocksize=64 * 1024):
+        lobj = conn.lobject(oid=0, mode='wb')
+        oid = lobj.oid
+        file_copy(src, lobj, blocksize=blocksize)
+        lobj.close()
+        return str(oid)
+
+    def open(self, conn, key):
+        return conn.lobject(oid=int(key), mode='rb')
+
+    def delete(self, conn, key):
+        conn.lobject(oid=int(key), mode='rb').unlink()
+
+
+class FilesystemBlobStore(BaseBlobStore):
+    """
+    Store blobs as files in a local directory, addressed by the
+    content hash (so the same data is stored only once).
+
+    Files are written atomically, by renaming temporary files.
+
+    :param path: the directory in which to store files
+    """
+
+    def __init__(self, path=None):
+        if path is None:
+            raise ValueError("A path is required for the filesystem store")
+        self.path = path
+
+    def create(self, conn, src, content_hash, blocksize=64 * 1024):
+        algorithm, digest = content_hash.split(':', 1)
+        key = '/'.join((algorithm, digest[:2], digest))
+        filename = self.get_filename(key)
+        if os.path.exists(filename):
+            return key
+
+        tmp_dir = os.path.join(self.path, 'tmp')
+        _makedirs(tmp_dir)
+        _makedirs(os.path.dirname(filename))
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                file_copy(src, fp, blocksize=blocksize)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp_path, filename)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return key
+
+    def open(self, conn, key):
+        return open(self.get_filename(key), 'rb')
+
+    def delete(self, conn, key):
+        try:
+            os.unlink(self.get_filename(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def get_filename(self, key):
+        return os.path.join(self.path, *key.split('/'))
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
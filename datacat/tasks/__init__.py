@@ -1 +1,56 @@
+"""
+Celery tasks provided by the core.
+"""
 
+import datetime
+import json
+import traceback
+
+from flask import current_app
+
+from datacat.core import celery_placeholder_app
+from datacat.db import db
+
+
+@celery_placeholder_app.task(name='datacat.tasks.run_deferred_hook')
+def run_deferred_hook(execution_id):
+    """
+    Run a deferred hook handler, as recorded in the ``hook_execution``
+    table, storing its result (or exception) back in the record.
+
+    :param execution_id: Id of the ``hook_execution`` record
+    """
+
+    with db, db.cursor() as cur:
+        cur.execute("""
+        UPDATE hook_execution SET status='running', mtime=%s
+        WHERE id=%s AND status='pending'
+        RETURNING hook_type, plugin, handler, arguments;
+        """, (datetime.datetime.utcnow(), execution_id))
+        record = cur.fetchone()
+
+    if record is None:
+        # Missing, or already run by someone else
+        return
+
+    status, result, exception = 'success', None, None
+    try:
+        plugin, handler = current_app.plugins.find_hook_handler(
+            record['hook_type'], record['plugin'], record['handler'])
+        arguments = record['arguments']
+        result = handler(*arguments['args'], **arguments['kwargs'])
+    except Exception:
+        status, exception = 'failure', traceback.format_exc()
+
+    try:
+        result = json.dumps(result)
+    except (TypeError, ValueError):
+        result = json.dumps(repr(result))
+
+    with db, db.cursor() as cur:
+        cur.execute("""
+        UPDATE hook_execution
+        SET status=%s, result=%s, exception=%s, mtime=%s
+        WHERE id=%s;
+        """, (status, result, exception, datetime.datetime.utcnow(),
+              execution_id))
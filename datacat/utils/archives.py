@@ -12,10 +12,13 @@ using a common interface.
     and more functionality added (eg. write support, ...).
 """
 
+from collections import OrderedDict
 import abc
+import os
 import zipfile
 import tarfile
 
+from datacat.utils.files import COPY_BLOCKSIZE, file_copy
 from datacat.utils.tempfile import TemporaryDir
 
 # Default extensions for archive files
@@ -102,12 +105,24 @@ class BaseArchive(object):
         """
         pass
 
-    # @abc.abstractmethod
-    # def extract(self, path):
-    #     """
-    #     Extract all the archive contents to a given path.
-    #     """
-    #     pass
+    def extract(self, path):
+        """
+        Extract all the archive contents to a given path.
+
+        Only regular files are extracted; members with absolute names,
+        or names pointing outside ``path``, are skipped.
+        """
+
+        for member in self:
+            if not member.is_file:
+                continue
+            name = os.path.normpath(member.name)
+            if os.path.isabs(name) or name.split(os.sep)[0] == os.pardir:
+                continue
+            dest = os.path.join(path, name)
+            if not os.path.isdir(os.path.dirname(dest)):
+                os.makedirs(os.path.dirname(dest))
+            member.extract_to(dest)
 
 
 class BaseArchivedFile(object):
@@ -122,12 +137,16 @@ class BaseArchivedFile(object):
             The member name inside the archive.
 
         :param **attrs:
-            Keyword arguments will be exposed as attributes
+            Keyword arguments will be exposed as attributes. ``size``,
+            ``is_file`` and ``crc`` (CRC32 of the data, if stored in
+            the archive) are always defined.
         """
         self.archive = archive
         self.name = name
         self._attrs = {
             'size': None,
+            'is_file': True,
+            'crc': None,
         }
         self._attrs.update(attrs)
 
@@ -139,6 +158,22 @@ class BaseArchivedFile(object):
         """
         pass
 
+    def extract_to(self, path, blocksize=COPY_BLOCKSIZE):
+        """
+        Extract this file to the given path (overwriting it),
+        copying data in blocks, so large members are never held
+        in memory as a whole.
+
+        :param path: the destination file name
+        :param blocksize: size of blocks in which data is copied
+        """
+        src = self.open()
+        try:
+            with open(path, 'wb') as dest:
+                file_copy(src, dest, blocksize=blocksize)
+        finally:
+            src.close()
+
     def __getattr__(self, name):
         """
         Used to access attributes set via keyword arguments
@@ -151,11 +186,57 @@ class BaseArchivedFile(object):
 
 
 class TarArchive(BaseArchive):
-    pass
+    """
+    Tar archives, optionally compressed (the compression method is
+    detected automatically).
+
+    Members are listed with a single sequential pass over the archive
+    (streaming mode), which also builds an index of members by name;
+    the archive is only accessed randomly to read the members data.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._index = None
+        try:
+            # Only reads the first member header
+            self._archive = tarfile.open(filename, mode='r:*')
+        except (tarfile.TarError, IOError) as e:
+            raise ArchiveOpenFailure("Bad archive: {0!r}".format(e))
+
+    def __iter__(self):
+        if self._index is not None:
+            for item in self._index.itervalues():
+                yield self._wrap_tarinfo(item)
+            return
+
+        index = OrderedDict()
+        stream = tarfile.open(self._filename, mode='r|*')
+        try:
+            for item in stream:
+                index[item.name] = item
+                yield self._wrap_tarinfo(item)
+        finally:
+            stream.close()
+        self._index = index
+
+    def get(self, name):
+        if self._index is None:
+            for _ in self:
+                pass
+        return self._wrap_tarinfo(self._index[name])
+
+    def _wrap_tarinfo(self, item):
+        return TarArchivedFile(self, name=item.name, size=item.size,
+                               is_file=item.isreg(), tarinfo=item)
 
 
 class TarArchivedFile(BaseArchivedFile):
-    pass
+    def open(self):
+        fp = self.archive._archive.extractfile(self.tarinfo)
+        if fp is None:
+            raise IOError("Not a regular file: {0}".format(self.name))
+        return fp
 
 
 class ZipArchive(BaseArchive):
@@ -174,7 +255,9 @@ class ZipArchive(BaseArchive):
         return self._wrap_zipinfo(zipinfo)
 
     def _wrap_zipinfo(self, item):
-        return ZipArchivedFile(self, name=item.filename, size=item.file_size)
+        return ZipArchivedFile(self, name=item.filename, size=item.file_size,
+                               is_file=not item.filename.endswith('/'),
+                               crc=item.CRC)
 
 
 class ZipArchivedFile(BaseArchivedFile):
@@ -200,6 +283,7 @@ class ExtractedArchiveFiles(object):
         self._tempdir = TemporaryDir()
         path = self._tempdir.__enter__()
         self.archive.extract(path)
+        return path
 
     def __exit__(self, exc_type, exc_value, traceback):
         self._tempdir.__exit__(exc_type, exc_value, traceback)
@@ -0,0 +1,300 @@
+"""
+Export geographical data from PostGIS tables to other formats.
+
+Tables are expected to be laid out as the ones created by
+:py:func:`~datacat.utils.data_extraction.shapefile_table_sql`: a
+``gid`` primary key, attribute columns and a geometry column.
+
+Rows are read from server-side cursors, in batches, and written to a
+file as they are encoded: the exporters have to be called inside a
+transaction, and memory usage doesn't depend on the size of the table.
+
++----------------------------+---------------------------------------+
+| Function                   | Format                                |
++============================+=======================================+
+| :py:func:`export_csv`      | CSV (as output by ``COPY``)           |
++----------------------------+---------------------------------------+
+| :py:func:`export_kml`      | Keyhole Markup Language               |
++----------------------------+---------------------------------------+
+| :py:func:`export_gml`      | Geography Markup Language (3.1)       |
++----------------------------+---------------------------------------+
+| :py:func:`export_shapefile`| Zip archive containing a shapefile    |
++----------------------------+---------------------------------------+
+"""
+
+from __future__ import absolute_import
+
+import datetime
+import os
+import re
+from xml.sax.saxutils import escape, quoteattr
+import zipfile
+
+import psycopg2.extensions
+
+from datacat.utils.data_extraction import COPY_BUFFER_SIZE, _quote_ident
+from datacat.utils.shapefile import Field, ShapefileWriter
+from datacat.utils.tempfile import TemporaryDir
+
+# Namespace of the feature elements in GML exports
+GML_NAMESPACE = 'urn:datacat:geo'
+
+# PostgreSQL type -> DBF field type, length and decimals
+# (other types are exported as strings)
+_DBF_FIELDS = {
+    'smallint': (b'N', 6, 0),
+    'integer': (b'N', 11, 0),
+    'bigint': (b'N', 20, 0),
+    'real': (b'N', 24, 15),
+    'double precision': (b'N', 24, 15),
+    'numeric': (b'N', 24, 15),
+    'boolean': (b'L', 1, 0),
+    'date': (b'D', 8, 0),
+}
+
+_XML_NAME_INVALID = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def get_attribute_columns(cursor, table, geometry_column='geom'):
+    """
+    Return the attribute columns of a table (all but ``gid`` and the
+    geometry column), as ``(name, data_type)`` tuples; an empty list
+    if the table doesn't exist. Names are unicode strings.
+    """
+
+    encoding = _client_encoding(cursor.connection)
+    cursor.execute("""
+    SELECT column_name, data_type FROM information_schema.columns
+    WHERE table_name = %s AND column_name NOT IN ('gid', %s)
+    ORDER BY ordinal_position;
+    """, (table, geometry_column))
+    return [(row[0].decode(encoding), row[1]) for row in cursor.fetchall()]
+
+
+def export_csv(conn, table, fp):
+    """
+    Export a table to CSV (with a header line), in a format suitable
+    for loading with ``COPY``: geometries are hex-encoded EWKB.
+
+    Data is copied as PostgreSQL sends it, without being decoded.
+    """
+
+    with conn.cursor() as cur:
+        cur.copy_expert(
+            'COPY {0} TO STDOUT (FORMAT csv, HEADER true)'.format(
+                _quote_ident(table)), fp, size=COPY_BUFFER_SIZE)
+
+
+def export_kml(conn, table, fp, geometry_column='geom', name=None,
+               batch_size=1000):
+    """
+    Export a table to KML: a document with a placemark for each row,
+    attributes as extended data.
+
+    KML coordinates are always WGS 84 (longitude / latitude):
+    geometries without a SRID are assumed to be in it already.
+
+    :param name: name of the KML document (defaults to the table name)
+    """
+
+    with conn.cursor() as cur:
+        columns = [column for column, _
+                   in get_attribute_columns(cur, table, geometry_column)]
+
+    query = """
+    SELECT ST_AsKML(CASE ST_SRID({geom}) WHEN 0
+                    THEN ST_SetSRID({geom}, 4326) ELSE {geom} END),
+           gid {columns}
+    FROM {table} ORDER BY gid;
+    """.format(geom=_quote_ident(geometry_column),
+               columns=''.join(', ' + _quote_ident(column)
+                               for column in columns),
+               table=_quote_ident(table))
+
+    encoding = _client_encoding(conn)
+    fp.write(b'<?xml version="1.0" encoding="UTF-8"?>\n'
+             b'<kml xmlns="http://www.opengis.net/kml/2.2"><Document>')
+    fp.write(u'<name>{0}</name>\n'.format(
+        escape(name or table)).encode('utf-8'))
+
+    for rows in _fetch_batches(conn, query, batch_size):
+        chunks = []
+        for row in rows:
+            chunks.append(u'<Placemark id="f{0}"><ExtendedData>'
+                          .format(row[1]))
+            for column, value in zip(columns, row[2:]):
+                if value is not None:
+                    chunks.append(u'<Data name={0}><value>{1}</value>'
+                                  u'</Data>'.format(
+                                      quoteattr(column),
+                                      _xml_text(value, encoding)))
+            chunks.append(u'</ExtendedData>')
+            if row[0] is not None:
+                chunks.append(row[0].decode(encoding))
+            chunks.append(u'</Placemark>\n')
+        fp.write(u''.join(chunks).encode('utf-8'))
+
+    fp.write(b'</Document></kml>\n')
+
+
+def export_gml(conn, table, fp, geometry_column='geom', batch_size=1000):
+    """
+    Export a table to GML 3.1: a ``FeatureCollection`` of features
+    named after the table, with an element for the geometry and for
+    each (non-null) attribute, in the :py:data:`GML_NAMESPACE`.
+    """
+
+    with conn.cursor() as cur:
+        columns = [column for column, _
+                   in get_attribute_columns(cur, table, geometry_column)]
+
+    query = """
+    SELECT ST_AsGML(3, {geom}), gid {columns} FROM {table} ORDER BY gid;
+    """.format(geom=_quote_ident(geometry_column),
+               columns=''.join(', ' + _quote_ident(column)
+                               for column in columns),
+               table=_quote_ident(table))
+
+    encoding = _client_encoding(conn)
+    feature = 'dc:' + _xml_name(table)
+    geometry = 'dc:' + _xml_name(geometry_column)
+    elements = ['dc:' + _xml_name(column) for column in columns]
+
+    fp.write(u'<?xml version="1.0" encoding="UTF-8"?>\n'
+             u'<gml:FeatureCollection xmlns:gml="http://www.opengis.net/gml"'
+             u' xmlns:dc={0}>\n'.format(quoteattr(GML_NAMESPACE))
+             .encode('utf-8'))
+
+    for rows in _fetch_batches(conn, query, batch_size):
+        chunks = []
+        for row in rows:
+            chunks.append(u'<gml:featureMember><{0} gml:id="{1}.{2}">'
+                          .format(feature, feature[3:], row[1]))
+            if row[0] is not None:
+                chunks.append(u'<{0}>{1}</{0}>'.format(
+                    geometry, row[0].decode(encoding)))
+            for element, value in zip(elements, row[2:]):
+                if value is not None:
+                    chunks.append(u'<{0}>{1}</{0}>'.format(
+                        element, _xml_text(value, encoding)))
+            chunks.append(u'</{0}></gml:featureMember>\n'.format(feature))
+        fp.write(u''.join(chunks).encode('utf-8'))
+
+    fp.write(b'</gml:FeatureCollection>\n')
+
+
+def export_shapefile(conn, table, fp, geometry_column='geom',
+                     name=None, batch_size=1000):
+    """
+    Export a table to a shapefile (see
+    :py:class:`~datacat.utils.shapefile.ShapefileWriter`), written as
+    a zip archive to ``fp`` (which needs to be seekable).
+
+    Attribute strings are UTF-8 encoded, in fields as long as the
+    longest value (up to 254 bytes); the ``.prj`` file is written if
+    the SRID of the geometries is known to PostGIS.
+
+    :param name:
+        base name of the files inside the archive (defaults
+        to the table name)
+    """
+
+    with conn.cursor() as cur:
+        columns = get_attribute_columns(cur, table, geometry_column)
+        fields = _get_dbf_fields(cur, table, columns)
+
+        cur.execute("""
+        SELECT srtext FROM spatial_ref_sys WHERE srid = (
+            SELECT ST_SRID({geom}) FROM {table}
+            WHERE {geom} IS NOT NULL LIMIT 1);
+        """.format(geom=_quote_ident(geometry_column),
+                   table=_quote_ident(table)))
+        row = cur.fetchone()
+        prj = None if row is None else row[0]
+
+    query = """
+    SELECT ST_AsEWKB({geom}) {columns} FROM {table} ORDER BY gid;
+    """.format(geom=_quote_ident(geometry_column),
+               columns=''.join(', ' + _quote_ident(column)
+                               for column, _ in columns),
+               table=_quote_ident(table))
+
+    encoding = _client_encoding(conn)
+    with TemporaryDir() as tempdir:
+        path = os.path.join(tempdir, (name or table) + '.shp')
+        with ShapefileWriter(path, fields, prj=prj) as writer:
+            for rows in _fetch_batches(conn, query, batch_size):
+                for row in rows:
+                    writer.write(row[0], [
+                        value.decode(encoding) if isinstance(value, str)
+                        else value for value in row[1:]])
+
+        archive = zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED,
+                                  allowZip64=True)
+        with archive:
+            for path in writer.paths:
+                archive.write(path, os.path.basename(path))
+
+
+def _fetch_batches(conn, query, batch_size):
+    """Yield lists of rows of a query, read from a server-side cursor"""
+
+    with conn.cursor(name='datacat_export') as cur:
+        cur.itersize = batch_size
+        cur.execute(query)
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            yield rows
+
+
+def _get_dbf_fields(cursor, table, columns):
+    """
+    Return the :py:class:`~datacat.utils.shapefile.Field` definitions
+    for the attribute columns of a table; strings are sized after
+    the longest value.
+    """
+
+    strings = [column for column, data_type in columns
+               if data_type not in _DBF_FIELDS]
+    lengths = {}
+    if strings:
+        cursor.execute('SELECT {0} FROM {1};'.format(
+            ', '.join('max(octet_length({0}::text))'.format(
+                _quote_ident(column)) for column in strings),
+            _quote_ident(table)))
+        lengths = dict(zip(strings, cursor.fetchone()))
+
+    fields = []
+    for column, data_type in columns:
+        if data_type in _DBF_FIELDS:
+            fields.append(Field(column, *_DBF_FIELDS[data_type]))
+        else:
+            fields.append(Field(column, b'C', lengths[column] or 1, 0))
+    return fields
+
+
+def _xml_name(name):
+    """Turn a column name into a valid XML element name"""
+
+    name = _XML_NAME_INVALID.sub('_', name)
+    if not re.match(r'[A-Za-z_]', name):
+        name = '_' + name
+    return name
+
+
+def _xml_text(value, encoding):
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, str):
+        value = value.decode(encoding)
+    return escape(unicode(value))
+
+
+def _client_encoding(conn):
+    """Python codec of the connection encoding (of text values)"""
+
+    return psycopg2.extensions.encodings[conn.encoding]
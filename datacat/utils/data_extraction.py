@@ -15,9 +15,19 @@ to define hints about the data to be imported..
 """
 
 
+from __future__ import absolute_import
+
 from collections import defaultdict
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import datetime
 import os
+import struct
 import subprocess
+import tempfile
+import threading
+
+import psycopg2.extensions
 
 from datacat.utils.archives import open_archive
 
@@ -26,38 +36,352 @@ SHP_REL_EXT = set(['shx', 'dbf', 'prj'])
 ARCHIVE_EXT = set(['zip', 'tar', 'tar.gz', 'tar.bz2',
                    'tar.xz', 'tar.lzma', 'rar', '7z'])
 
+# Size of chunks read from shp2pgsql output and sent to PostgreSQL
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Dates are sent to PostgreSQL as days since this one
+PG_EPOCH = datetime.date(2000, 1, 1)
+
+
+class ArchiveBudgetExceeded(Exception):
+    """
+    Raised when nested archives would take more temporary
+    disk space than allowed.
+    """
+    pass
 
-def find_shapefiles(archive_filename):
-    # ------------------------------------------------------------
-    # Note: to find stuff recursively in an archive, we need
-    #       to extract the sub-archives first. For that, we need
-    #       a temporary directory and to make sure we delete it
-    #       once we're done..
-    # ------------------------------------------------------------
 
+def find_shapefiles(archive_filename, tempdir=None, max_depth=3,
+                    max_size=1024 ** 3, threads=4):
+    """
+    Find shapefiles inside an archive, looking recursively into
+    the archives it contains (eg. zip in zip, tar.gz in zip).
+
+    Nested archives need to be extracted first: they are streamed to
+    ``tempdir`` (only members looking like archives are extracted).
+    The archives found at the same nesting level are then scanned in
+    parallel, each in its own thread.
+
+    :param archive_filename: path to the archive to be searched
+    :param tempdir:
+        directory in which to extract nested archives; they are
+        not searched if ``None``. Returned members of nested archives
+        can only be used as long as it exists.
+    :param max_depth: maximum nesting level of searched archives
+    :param max_size:
+        maximum total size of the nested archives extracted to
+        ``tempdir``, in bytes
+    :param threads: number of threads scanning nested archives
+    :return:
+        dict mapping shapefile base names to ``{ext: member}``
+        dicts. Base names of shapefiles inside nested archives
+        are prefixed by the archive member name (eg.
+        ``'inner.zip/roads/roads'``).
+    :raises ArchiveBudgetExceeded:
+        if nested archives are bigger than ``max_size``
+    """
+
+    if tempdir is None:
+        max_depth = 0
+    budget = _DiskBudget(max_size)
     found = defaultdict(dict)  # {basename: {ext: ArchivedFile()}}
 
+    # The top-level archive must be readable; nested ones
+    # that fail to open are just ignored.
     archive = open_archive(archive_filename)
+    pending = _scan_archive(
+        archive, '', 0 < max_depth, tempdir, budget, found)
+
+    depth = 1
+    pool = None
+    try:
+        while pending:
+            if pool is None:
+                pool = ThreadPool(max(1, threads))
+            results = pool.map(
+                partial(_scan_nested_archive, scan_nested=depth < max_depth,
+                        tempdir=tempdir, budget=budget),
+                pending)
+            pending = []
+            for nested_found, nested_pending in results:
+                found.update(nested_found)
+                pending.extend(nested_pending)
+            depth += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    return dict(found)
+
+
+def _scan_nested_archive(item, scan_nested, tempdir, budget):
+    filename, prefix = item
+    found = defaultdict(dict)
+    try:
+        archive = open_archive(filename)
+    except ValueError:
+        return found, []  # Not an archive, or unsupported type
+    pending = _scan_archive(
+        archive, prefix, scan_nested, tempdir, budget, found)
+    return found, pending
+
+
+def _scan_archive(archive, prefix, scan_nested, tempdir, budget, found):
+    """
+    Add the shapefiles in an archive to ``found``, extracting
+    nested archives to ``tempdir`` if ``scan_nested`` is true.
+
+    :return: list of ``(filename, prefix)`` of the extracted archives
+    """
+
+    pending = []
     for member in archive:
+        if not member.is_file:
+            continue
+
+        if scan_nested and _is_archive_name(member.name):
+            budget.reserve(member.size or 0)
+            fd, filename = tempfile.mkstemp(
+                dir=tempdir, suffix='-' + os.path.basename(member.name))
+            os.close(fd)
+            member.extract_to(filename)
+            if member.size is None:
+                budget.reserve(os.path.getsize(filename))
+            pending.append((filename, prefix + member.name + '/'))
+            continue
+
         basename, ext = os.path.splitext(member.name)
         ext = ext[1:]  # Strip leading dot
         ext_low = ext.lower()
 
         if ext_low in SHP_EXT or ext_low in SHP_REL_EXT:
-            found[basename][ext] = member
+            found[prefix + basename][ext] = member
+
+    return pending
+
+
+def _is_archive_name(name):
+    name = name.lower()
+    return any(name.endswith('.' + ext) for ext in ARCHIVE_EXT)
+
+
+class _DiskBudget(object):
+    """Thread-safe accounting of the temporary disk space used"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def reserve(self, size):
+        with self._lock:
+            if self.used + size > self.max_size:
+                raise ArchiveBudgetExceeded(
+                    "Nested archives exceed the maximum size of {0} bytes"
+                    .format(self.max_size))
+            self.used += size
+
+
+def shapefile_table_sql(reader, table, schema=None, geometry_column='geom',
+                        primary_key=True):
+    """
+    Return the SQL creating a table suitable to load data from
+    a shapefile, as :py:func:`shapefile_copy` does.
+
+    Like for ``shp2pgsql``, the table has a ``gid`` serial primary key,
+    one column per attribute (with lower-case names) and a geometry
+    column; strings are stored as ``text``.
+
+    :param reader: a :py:class:`~datacat.utils.shapefile.ShapefileReader`
+    :param primary_key:
+        set to ``False`` not to declare ``gid`` as primary key (so no
+        index needs to be maintained while loading data).
+    """
+
+    columns = ['gid serial PRIMARY KEY' if primary_key else 'gid serial']
+    for name, field in zip(_attribute_columns(reader, geometry_column),
+                           reader.fields):
+        columns.append('{0} {1}'.format(
+            _quote_ident(name), _get_pg_type(field)[0]))
+    columns.append('{0} geometry({1}, {2:d})'.format(
+        _quote_ident(geometry_column), reader.geometry_type, reader.srid))
+
+    return 'CREATE TABLE {0} ({1});'.format(
+        _qualified_name(table, schema), ', '.join(columns))
+
+
+def shapefile_copy(cursor, reader, table, schema=None,
+                   geometry_column='geom'):
+    """
+    Load data from a shapefile into an existing table (see
+    :py:func:`shapefile_table_sql`), via ``COPY ... (FORMAT binary)``.
+
+    Records are encoded as they are read from the (memory-mapped)
+    shapefile: no external process or text conversion is involved.
+
+    :param reader: a :py:class:`~datacat.utils.shapefile.ShapefileReader`
+    :return: the number of loaded rows
+    """
+
+    columns = _attribute_columns(reader, geometry_column)
+    columns.append(geometry_column)
+    encoders = [_get_pg_type(field)[1] for field in reader.fields]
+    encoders.append(_encode_bytes)
+
+    statement = 'COPY {0} ({1}) FROM STDIN (FORMAT binary)'.format(
+        _qualified_name(table, schema),
+        ', '.join(_quote_ident(name) for name in columns))
+
+    encoding = psycopg2.extensions.encodings[cursor.connection.encoding]
+    rows = (values + [wkb] for wkb, values in reader)
+    cursor.copy_expert(statement, BinaryCopyReader(rows, encoders, encoding),
+                       size=COPY_BUFFER_SIZE)
+    return cursor.rowcount
+
+
+class BinaryCopyReader(object):
+    """
+    File-like object returning rows encoded in the PostgreSQL binary
+    ``COPY`` format, to be passed to ``cursor.copy_expert()``.
+
+    Rows are encoded in batches, only as data is requested.
+
+    :param rows: iterable of rows (sequences of values)
+    :param encoders:
+        functions converting the (non-null) values of each column
+        to the binary representation of their type; they're called
+        with the value and the client encoding.
+    :param encoding: the client encoding (for text values)
+    """
+
+    def __init__(self, rows, encoders, encoding='utf-8'):
+        self._rows = iter(rows)
+        self._encoders = encoders
+        self._encoding = encoding
+        self._row_header = struct.pack('>h', len(encoders))
+        self._buffer = [b'PGCOPY\n\xff\r\n\x00', struct.pack('>ii', 0, 0)]
+        self._done = False
+
+    def read(self, size=-1):
+        chunks = self._buffer
+        length = sum(len(chunk) for chunk in chunks)
+        encoders, encoding = self._encoders, self._encoding
+        null = struct.pack('>i', -1)
+
+        while not self._done and (size < 0 or length < size):
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                chunks.append(struct.pack('>h', -1))  # Trailer
+                self._done = True
+                break
+
+            chunks.append(self._row_header)
+            length += 2
+            for value, encode in zip(row, encoders):
+                if value is None:
+                    chunks.append(null)
+                    length += 4
+                    continue
+                data = encode(value, encoding)
+                chunks.append(struct.pack('>i', len(data)))
+                chunks.append(data)
+                length += 4 + len(data)
+
+        self._buffer = []
+        return b''.join(chunks)
+
+
+def _attribute_columns(reader, geometry_column):
+    """
+    Column names for the shapefile attributes: lower-case, and
+    renamed if clashing with the ``gid`` / geometry columns, or
+    with each other.
+    """
+
+    reserved = ('gid', geometry_column)
+    used = set(reserved)
+    names = []
+    for field in reader.fields:
+        name = field.name.lower() or 'field'
+        if name in reserved:
+            name = '__' + name
+        base, i = name, 1
+        while name in used:
+            name = '{0}_{1}'.format(base, i)
+            i += 1
+        used.add(name)
+        names.append(name)
+    return names
+
+
+def _get_pg_type(field):
+    """Return the PostgreSQL type for a DBF field, and its encoder"""
+
+    if field.type in (b'N', b'F'):
+        if field.type == b'N' and field.decimals == 0:
+            if field.length < 10:
+                return 'integer', _encode_int4
+            if field.length < 19:
+                return 'bigint', _encode_int8
+        return 'double precision', _encode_float8
+    if field.type == b'L':
+        return 'boolean', _encode_bool
+    if field.type == b'D':
+        return 'date', _encode_date
+    return 'text', _encode_text
+
+
+def _encode_text(value, encoding):
+    return value.encode(encoding)
+
+
+def _encode_int4(value, encoding):
+    return struct.pack('>i', value)
+
+
+def _encode_int8(value, encoding):
+    return struct.pack('>q', value)
 
-    return dict(found)
 
+def _encode_float8(value, encoding):
+    return struct.pack('>d', value)
 
-def shp2pgsql(shapefile, schema=None, table=None,
-              drop=False, mode='create', create_table_only=False,
-              use_dump_format=False, use_wkt=False, no_transaction=False,
-              from_srid=None, srid=None, use_geography=False,
-              geometry_column=None, keep_case=False, force_32bit=False,
-              simple_geometries=False, encoding=None, create_gist_index=False,
-              null_policy='insert', tablespace=None, index_tablespace=None):
+
+def _encode_bool(value, encoding):
+    return b'\x01' if value else b'\x00'
+
+
+def _encode_date(value, encoding):
+    return struct.pack('>i', (value - PG_EPOCH).days)
+
+
+def _encode_bytes(value, encoding):
+    return value
+
+
+def _quote_ident(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def _qualified_name(table, schema=None):
+    if schema is None:
+        return _quote_ident(table)
+    return '{0}.{1}'.format(_quote_ident(schema), _quote_ident(table))
+
+
+def shp2pgsql_args(shapefile, schema=None, table=None,
+                   drop=False, mode='create', create_table_only=False,
+                   use_dump_format=False, use_wkt=False,
+                   no_transaction=False, from_srid=None, srid=None,
+                   use_geography=False, geometry_column=None,
+                   keep_case=False, force_32bit=False,
+                   simple_geometries=False, encoding=None,
+                   create_gist_index=False, null_policy='insert',
+                   tablespace=None, index_tablespace=None):
     """
-    Wrapper around shp2pgsql command.
+    Build the command line to run shp2pgsql.
 
     :param shapefile:
         Path to a shapefile to be converted
@@ -159,16 +483,7 @@ def shp2pgsql(shapefile, schema=None, table=None,
         applies to the primary key index, and the GIST spatial index
         if -I is also used.
 
-    .. todo:: We should find some smarter way to return "chunked" output
-              as soon as it is available, instead of keeping all of it
-              in memory. But then we need some way to pass it to
-              PostgreSQL..
-
-    .. todo:: It would also be nice to be able to export the whole table
-              as a CSV file, (Like using the dump format -D) and then passing
-              it to postgres using ``cursor.copy_from()`` -> if we use
-              the dump format, we need to strip content up to the "COPY ..."
-              line.
+    :return: a list of command line arguments
     """
 
     args = ['shp2pgsql']
@@ -236,6 +551,109 @@ def shp2pgsql(shapefile, schema=None, table=None,
         args.append(table)
 
     # Make sure all arguments are converted to string
-    args = [str(x) for x in args]
+    return [str(x) for x in args]
+
+
+def shp2pgsql(shapefile, **kwargs):
+    """
+    Wrapper around shp2pgsql command, returning the generated SQL
+    as a string.
+
+    Keyword arguments are the same as for :py:func:`shp2pgsql_args`.
+
+    .. note:: The whole output is kept in memory: use
+              :py:func:`shp2pgsql_copy` to load data.
+    """
+
+    return subprocess.check_output(shp2pgsql_args(shapefile, **kwargs))
+
+
+def shp2pgsql_copy(cursor, shapefile, table, schema=None, **kwargs):
+    """
+    Load data from a shapefile into an existing table, streaming the
+    output of ``shp2pgsql -D`` (dump format) to ``cursor.copy_expert()``.
+
+    The output is never kept in memory as a whole, and loading data
+    via ``COPY`` is much faster than running ``INSERT`` statements.
+
+    Statements around the ``COPY`` data (transaction control, etc.)
+    are ignored: data is loaded in the cursor's current transaction.
+    The table must have been created beforehand, eg. by running the
+    output of :py:func:`shp2pgsql` with ``create_table_only=True``.
+
+    Other keyword arguments are passed to :py:func:`shp2pgsql_args`.
+
+    :return: the number of loaded rows
+    """
+
+    args = shp2pgsql_args(shapefile, schema=schema, table=table,
+                          mode='append', use_dump_format=True, **kwargs)
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                            bufsize=COPY_BUFFER_SIZE)
+    rowcount = 0
+
+    try:
+        reader = DumpCopyReader(proc.stdout)
+        if reader.copy_statement is not None:
+            cursor.copy_expert(reader.copy_statement, reader,
+                               size=COPY_BUFFER_SIZE)
+            rowcount = cursor.rowcount
+
+        # Discard the trailing statements
+        while proc.stdout.read(COPY_BUFFER_SIZE):
+            pass
+
+    except Exception:
+        proc.kill()
+        proc.wait()
+        raise
+
+    finally:
+        proc.stdout.close()
+
+    retcode = proc.wait()
+    if retcode:
+        raise subprocess.CalledProcessError(retcode, args)
+    return rowcount
+
+
+class DumpCopyReader(object):
+    """
+    File-like object returning the data of the first ``COPY`` statement
+    in a PostgreSQL dump (such as the one generated by ``shp2pgsql -D``),
+    to be passed to ``cursor.copy_expert()``.
+
+    Input is read line by line, only as data is requested.
+
+    :param fp: file object from which to read the dump
+    """
 
-    return subprocess.check_output(args)
+    def __init__(self, fp):
+        self._fp = fp
+        self._done = False
+
+        #: The ``COPY ... FROM stdin;`` statement, or ``None`` if the
+        #: dump contained no data.
+        self.copy_statement = None
+
+        for line in iter(fp.readline, b''):
+            if line.startswith(b'COPY '):
+                self.copy_statement = line.strip()
+                break
+        else:
+            self._done = True
+
+    def read(self, size=-1):
+        if self._done:
+            return b''
+
+        chunks, length = [], 0
+        while size < 0 or length < size:
+            line = self._fp.readline()
+            if not line or line.rstrip(b'\r\n') == b'\\.':
+                # End of data marker
+                self._done = True
+                break
+            chunks.append(line)
+            length += len(line)
+        return b''.join(chunks)
@@ -1,6 +1,15 @@
-def file_copy(src, dest, blocksize=4096):
+import io
+
+# Default size of blocks copied by file_copy()
+COPY_BLOCKSIZE = 256 * 1024
+
+
+def file_copy(src, dest, blocksize=COPY_BLOCKSIZE):
     """
-    Copy data between two file descriptors or file-like objects.
+    Copy data between two file-like objects.
+
+    When writing to a file, data is read into a reused buffer (if
+    ``src`` supports ``.readinto()``); otherwise, it is read in blocks.
 
     :param src:
         An object with a ``.read(size)`` method
@@ -9,8 +18,26 @@ def file_copy(src, dest, blocksize=4096):
     :param blocksize:
         The size of blocks read from src and written to dest.
     """
+
+    if isinstance(dest, (file, io.IOBase)) and hasattr(src, 'readinto'):
+        _readinto_copy(src, dest, blocksize)
+        return
+
     while True:
         data = src.read(blocksize)
         if not data:
             return
         dest.write(data)
+
+
+def _readinto_copy(src, dest, blocksize):
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    while True:
+        size = src.readinto(buf)
+        if not size:
+            return
+        if size == blocksize:
+            dest.write(buf)
+        else:
+            dest.write(view[:size])
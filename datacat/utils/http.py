@@ -1,13 +1,15 @@
 from datetime import datetime
 
-from flask import request, Response
+from flask import request, Response, current_app
 from werkzeug.exceptions import NotFound, BadRequest
+from werkzeug.wsgi import wrap_file
 
-from datacat.db import db, querybuilder
+from datacat.db import db, querybuilder, get_pool
+from datacat.storage import get_blob_store
 from datacat.utils.const import HTTP_DATE_FORMAT
 
 
-def serve_resource(resource_id, transfer_block_size=4096):
+def serve_resource(resource_id, transfer_block_size=64 * 1024):
     """
     Serve resource data via HTTP, setting ETag and Last-Modified headers
     and honoring ``If-None-Match`` and ``If-modified-since`` headers.
@@ -18,20 +20,31 @@ def serve_resource(resource_id, transfer_block_size=4096):
     - Set ``Last-Modified`` header (to the last modification date)
     - Honor the ``If-modified-since`` header (if the resource was not
       modified, return 304)
+    - Return response as a stream, to avoid loading everything in memory.
+    - Support (single) ``Range`` requests + 206 partial response,
+      honoring the ``If-Range`` header.
+    - Properly support HEAD requests.
 
     Planned features:
 
-    - Return response as a stream, to avoid loading everything in memory.
     - Honor the ``If-Match`` / ``If-None-Match`` headers
-    - Support ``Range`` requests + 206 partial response
     - Set ``Cache-control`` and ``Expire`` headers (?)
-    - Properly support HEAD requests.
+
+    Data is streamed using a dedicated connection from the pool, as the
+    response body is consumed after the view has returned (and the
+    request connection has been released).
+
+    Blobs available as local files (see
+    :py:meth:`~datacat.storage.BaseBlobStore.get_filename`) are served
+    without copying data through Python: using the ``X-Sendfile`` header
+    if ``USE_X_SENDFILE`` is enabled, otherwise via the WSGI server's
+    ``wsgi.file_wrapper`` (usually implemented with ``sendfile()``).
 
     :param resource_id:
         Id of the resource to be served
 
     :param transfer_block_size:
-        Size of the streaming response size. Defaults to 4096 bytes.
+        Size of the streaming response size. Defaults to 64 KiB.
 
     :return:
         A valid return value for a Flask view.
@@ -39,7 +52,8 @@ def serve_resource(resource_id, transfer_block_size=4096):
 
     with db, db.cursor() as cur:
         query = querybuilder.select_pk(
-            'resource', fields='id, mimetype, data_oid, mtime, hash')
+            'resource',
+            fields='id, mimetype, blob_store, blob_key, mtime, hash')
         cur.execute(query, dict(id=resource_id))
         resource = cur.fetchone()
 
@@ -51,6 +65,7 @@ def serve_resource(resource_id, transfer_block_size=4096):
         'Content-type': mimetype,
         'Last-modified': resource['mtime'].strftime(HTTP_DATE_FORMAT),
         'ETag': resource['hash'],
+        'Accept-Ranges': 'bytes',
     }
 
     # ------------------------------------------------------------
@@ -68,24 +83,120 @@ def serve_resource(resource_id, transfer_block_size=4096):
             # The resource was not modified -> return ``304 NOT MODIFIED``
             return Response('', status=304, headers=headers)
 
+    # ------------------------------------------------------------
+    # Open the blob: local files are read directly, other stores
+    # use their own connection, that will be returned to the pool
+    # once the response has been streamed.
+
+    store = get_blob_store(resource['blob_store'])
+    filename = store.get_filename(resource['blob_key'])
+
+    pool, conn = None, None
+    try:
+        if filename is not None:
+            blob = open(filename, 'rb')
+        else:
+            pool = get_pool()
+            conn = pool.getconn()
+            blob = store.open(conn, resource['blob_key'])
+        blob.seek(0, 2)
+        length = blob.tell()
+    except:
+        if conn is not None:
+            pool.putconn(conn)
+        raise
+
+    _released = []
+
+    def _cleanup():
+        # Might be called twice: when the stream is exhausted, and
+        # when the response is closed by the WSGI server.
+        if _released:
+            return
+        _released.append(True)
+        try:
+            blob.close()
+        finally:
+            if conn is not None:
+                pool.putconn(conn)
+
+    # ------------------------------------------------------------
+    # Check the Range header (we only support single byte ranges,
+    # others are ignored and the full body is returned).
+
+    status, start, stop = 200, 0, length
+
+    if _should_serve_range(resource['hash']):
+        _range = request.range.range_for_length(length)
+        if _range is None:
+            _cleanup()
+            headers['Content-Range'] = 'bytes */{0}'.format(length)
+            return Response(status=416, headers=headers)
+
+        status = 206
+        start, stop = _range
+        headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+            start, stop - 1, length)
+
+    headers['Content-Length'] = str(stop - start)
+
+    if request.method == 'HEAD':
+        _cleanup()
+        return Response(status=status, headers=headers)
+
+    # ------------------------------------------------------------
+    # Serve whole local files without copying data
+
+    if filename is not None and status == 200:
+        if current_app.use_x_sendfile:
+            _cleanup()
+            headers['X-Sendfile'] = filename
+            return Response(status=status, headers=headers)
+
+        blob.seek(0)
+        response = Response(
+            wrap_file(request.environ, blob, transfer_block_size),
+            status=status, headers=headers, direct_passthrough=True)
+        response.call_on_close(_cleanup)
+        return response
+
     # ------------------------------------------------------------
     # Stream the response data
 
-    with db:
-        lobject = db.lobject(oid=resource['data_oid'], mode='rb')
-        data = lobject.read()
-        lobject.close()
+    def generate_data():
+        try:
+            blob.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = blob.read(min(transfer_block_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+        finally:
+            _cleanup()
+
+    response = Response(generate_data(), status=status, headers=headers,
+                        direct_passthrough=True)
+    response.call_on_close(_cleanup)
+    return response
+
+
+def _should_serve_range(etag):
+    """
+    Check whether the current request is asking for a (single) byte
+    range that we should honor, taking ``If-Range`` into account.
+    """
+
+    if request.range is None:
+        return False
 
-    return Response(data, status=200, headers=headers)
+    if request.range.units != 'bytes' or len(request.range.ranges) != 1:
+        return False
 
-    # def generate_data():
-    #     with db:
-    #         lobject = db.lobject(oid=resource['data_oid'], mode='rb')
-    #         while True:
-    #             data = lobject.read(transfer_block_size)
-    #             if not data:
-    #                 break
-    #             yield data
-    #         lobject.close()
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and if_range != etag:
+        # The client has an outdated copy -> send the whole thing
+        return False
 
-    # return Response(generate_data(), status=200, headers=headers)
+    return True
@@ -1,4 +1,12 @@
 from collections import Sequence, namedtuple
+from multiprocessing.pool import ThreadPool
+import datetime
+import json
+import os
+import traceback
+
+from flask import (current_app, has_app_context, has_request_context,
+                   _request_ctx_stack)
 
 
 class HookExecutionResult(namedtuple('HookExecutionResult',
@@ -8,25 +16,159 @@ class HookExecutionResult(namedtuple('HookExecutionResult',
     __slots__ = []
 
     def __repr__(self):
-        return ("HookExecutionResult(plugin={0!r}, "
-                "result={1!r}, exception={2!r})").format(
+        return ("HookExecutionResult(plugin={plugin!r}, "
+                "result={result!r}, exception={exception!r})").format(
                     plugin=self.plugin,
                     result=self.result,
                     exception=self.exception)
 
 
 class PluginManager(Sequence):
-    def __init__(self, iterable):
+    def __init__(self, iterable, hook_threads=4):
+        """
+        :param iterable:
+            The plugin objects, in order
+
+        :param hook_threads:
+            Size of the thread pool used by :py:meth:`call_hook_parallel`
+        """
+
         self._plugins = []
         self._plugins.extend(iterable)
+        self._hook_threads = hook_threads
+        self._thread_pool = None
+        self._thread_pool_pid = None
+        self.build_hooks_table()
+
+    def build_hooks_table(self):
+        """
+        Build the table mapping hook types to a tuple of
+        ``(plugin, handler)`` pairs, in plugin order, used to
+        dispatch hook calls.
+
+        The table is built once, when plugins are loaded: this needs to
+        be called again if handlers are registered / changed afterwards.
+        """
+
+        table = {}
+        deferred = set()
+        thread_safe = set()
+        for plugin in self._plugins:
+            for hook_type, handlers in plugin._hooks.iteritems():
+                table.setdefault(hook_type, []).extend(
+                    (plugin, handler) for handler in handlers)
+                deferred.update(
+                    (hook_type, handler) for handler in handlers
+                    if plugin.is_deferred_hook(hook_type, handler))
+                thread_safe.update(
+                    (hook_type, handler) for handler in handlers
+                    if plugin.is_thread_safe_hook(hook_type, handler))
+        self._hooks_table = dict(
+            (hook_type, tuple(handlers))
+            for hook_type, handlers in table.iteritems()
+            if handlers)
+        self._deferred_handlers = frozenset(deferred)
+        self._thread_safe_handlers = frozenset(thread_safe)
+
+    def get_hook_handlers(self, hook_type):
+        """
+        Return a tuple of ``(plugin, handler)`` pairs for all
+        the handlers registered for a hook.
+        """
+        return self._hooks_table.get(hook_type, ())
 
     def call_hook(self, hook_type, *args, **kwargs):
+        """
+        Call all the handlers for a hook, returning a list of
+        :py:class:`HookExecutionResult`.
+
+        Handlers registered as *deferred* are scheduled for execution
+        by the :py:func:`datacat.tasks.run_deferred_hook` task instead;
+        their result will be the id of the ``hook_execution`` record.
+        """
+
+        handlers = self._hooks_table.get(hook_type)
+        if not handlers:
+            # Fast path for hooks nobody is interested in
+            return []
         return list(self.call_hook_async(hook_type, *args, **kwargs))
 
     def call_hook_async(self, hook_type, *args, **kwargs):
-        for plugin in self._plugins:
-            for res in plugin.call_hook_async(hook_type, *args, **kwargs):
-                yield res
+        for plugin, handler in self._hooks_table.get(hook_type, ()):
+            yield self._run_handler(hook_type, plugin, handler, args, kwargs)
+
+    def call_hook_parallel(self, hook_type, *args, **kwargs):
+        """
+        Like :py:meth:`call_hook`, but handlers declared as thread-safe
+        are run concurrently on a thread pool (of ``hook_threads``
+        threads), each in a copy of the current request / application
+        context. The other handlers are run in the calling thread, while
+        the thread-safe ones are executing; *deferred* handlers are
+        always scheduled from the calling thread, thread-safe or not.
+
+        Results are returned in plugin order, as for :py:meth:`call_hook`.
+        """
+
+        handlers = self._hooks_table.get(hook_type)
+        if not handlers:
+            return []
+
+        pending = []
+        for plugin, handler in handlers:
+            key = (hook_type, handler)
+            if (key in self._thread_safe_handlers and
+                    key not in self._deferred_handlers):
+                pending.append(self._get_thread_pool().apply_async(
+                    _call_handler_in_context,
+                    (_copy_context(), plugin, handler, args, kwargs)))
+            else:
+                pending.append(None)
+
+        results = [None] * len(handlers)
+        for i, (plugin, handler) in enumerate(handlers):
+            if pending[i] is None:
+                results[i] = self._run_handler(
+                    hook_type, plugin, handler, args, kwargs)
+        for i, async_result in enumerate(pending):
+            if async_result is not None:
+                results[i] = async_result.get()
+        return results
+
+    def call_handler(self, hook_type, plugin, handler, *args, **kwargs):
+        """
+        Call a single handler, as returned by :py:meth:`get_hook_handlers`,
+        honoring its *deferred* flag as :py:meth:`call_hook` would.
+        """
+        return self._run_handler(hook_type, plugin, handler, args, kwargs)
+
+    def _run_handler(self, hook_type, plugin, handler, args, kwargs):
+        if (hook_type, handler) in self._deferred_handlers:
+            return _defer_handler(plugin, handler, hook_type, args, kwargs)
+        return _call_handler(plugin, handler, args, kwargs)
+
+    def _get_thread_pool(self):
+        # Threads don't survive fork(), so we need a new pool
+        # in child processes.
+        if self._thread_pool is None or self._thread_pool_pid != os.getpid():
+            self._thread_pool = ThreadPool(self._hook_threads)
+            self._thread_pool_pid = os.getpid()
+        return self._thread_pool
+
+    def find_hook_handler(self, hook_type, plugin_name, handler_name):
+        """
+        Find a ``(plugin, handler)`` pair, given the plugin import name
+        and the handler name (as returned by :py:func:`get_handler_name`).
+
+        :raises LookupError: if the handler was not found
+        """
+
+        for plugin, handler in self._hooks_table.get(hook_type, ()):
+            if plugin.import_name != plugin_name:
+                continue
+            if get_handler_name(handler) == handler_name:
+                return plugin, handler
+        raise LookupError("Handler {0} for hook {1} not found in {2}"
+                          .format(handler_name, hook_type, plugin_name))
 
     def __getitem__(self, item):
         return self._plugins[item]
@@ -39,3 +181,82 @@ class PluginManager(Sequence):
 
     def __contains__(self, item):
         return item in self._plugins
+
+
+def _call_handler(plugin, handler, args, kwargs):
+    exception = result = None
+    try:
+        result = handler(*args, **kwargs)
+    except Exception as e:
+        exception = e
+    return HookExecutionResult(plugin, result, exception)
+
+
+def _copy_context():
+    """
+    Return a copy of the current request context (or a new application
+    context), to be pushed in a different thread.
+    """
+
+    if has_request_context():
+        return _request_ctx_stack.top.copy()
+    if has_app_context():
+        return current_app._get_current_object().app_context()
+    return None
+
+
+def _call_handler_in_context(context, plugin, handler, args, kwargs):
+    if context is None:
+        return _call_handler(plugin, handler, args, kwargs)
+    with context:
+        return _call_handler(plugin, handler, args, kwargs)
+
+
+def _defer_handler(plugin, handler, hook_type, args, kwargs):
+    """
+    Record a deferred hook execution and schedule a Celery task to run
+    it. The calling code is expected to have already committed any
+    transaction the handler depends upon.
+
+    If the task can't be scheduled (eg. the broker is unreachable),
+    the record is marked as failed and the exception is returned
+    in the result, as for handlers run synchronously.
+    """
+
+    from datacat.db import db
+    from datacat.tasks import run_deferred_hook
+
+    arguments = json.dumps({'args': args, 'kwargs': kwargs})
+    now = datetime.datetime.utcnow()
+
+    with db, db.cursor() as cur:
+        cur.execute("""
+        INSERT INTO hook_execution
+        (hook_type, plugin, handler, arguments, status, ctime, mtime)
+        VALUES (%s, %s, %s, %s, 'pending', %s, %s)
+        RETURNING id;
+        """, (hook_type, plugin.import_name, get_handler_name(handler),
+              arguments, now, now))
+        execution_id = cur.fetchone()[0]
+
+    try:
+        run_deferred_hook.delay(execution_id)
+    except Exception as e:
+        # The calling transaction was already committed: report the
+        # failure in the execution record, instead of to the client.
+        current_app.logger.exception(
+            'Failed scheduling hook execution %s', execution_id)
+        with db, db.cursor() as cur:
+            cur.execute("""
+            UPDATE hook_execution SET status='failure', exception=%s, mtime=%s
+            WHERE id=%s AND status='pending';
+            """, (traceback.format_exc(), datetime.datetime.utcnow(),
+                  execution_id))
+        return HookExecutionResult(plugin, execution_id, e)
+
+    return HookExecutionResult(plugin, execution_id, None)
+
+
+def get_handler_name(handler):
+    """Return the name used to identify a hook handler"""
+    return '{0}.{1}'.format(handler.__module__, handler.__name__)
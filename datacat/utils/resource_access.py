@@ -21,19 +21,29 @@ The accessors distributed with the core provide support for the following urls:
           resource accessors.
 """
 
+from __future__ import absolute_import
+
+from multiprocessing.pool import ThreadPool
 from urlparse import urlparse
 import abc
 import cgi
 import datetime
+import os
+import tempfile
 
 from flask import current_app
 from werkzeug.utils import cached_property
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from requests.structures import CaseInsensitiveDict
 import requests
 
 from datacat.db import db
+from datacat.storage import get_blob_store
 from datacat.utils.const import HTTP_DATE_FORMAT
-from datacat.utils.files import file_copy
+from datacat.utils.files import COPY_BLOCKSIZE, file_copy
 from datacat.utils.plugin_loading import import_object
+from datacat.utils.resource_cache import get_resource_cache
 
 
 def open_resource(url):
@@ -73,6 +83,71 @@ def get_resource_accessors():
     return _accessors
 
 
+def prefetch_resources(urls, dest_dir, threads=None):
+    """
+    Download resources concurrently (on a pool of ``threads`` threads,
+    defaulting to the ``RESOURCE_PREFETCH_THREADS`` setting) to
+    files in a directory.
+
+    Each download is run in its own application context.
+
+    :param urls: list of resource URLs
+    :param dest_dir: directory in which to create the files
+    :return: list of file names, in the same order as ``urls``
+    :raises ResourceAccessError: if any download failed
+    """
+
+    if threads is None:
+        threads = current_app.config['RESOURCE_PREFETCH_THREADS']
+    app = current_app._get_current_object()
+
+    def _download(url):
+        fd, filename = tempfile.mkstemp(dir=dest_dir, prefix='resource-')
+        with app.app_context(), os.fdopen(fd, 'wb') as fp:
+            open_resource(url).save_to_file(fp)
+        return filename
+
+    pool = ThreadPool(max(1, min(threads, len(urls))))
+    try:
+        return pool.map(_download, urls)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_http_session():
+    """
+    Return the ``requests.Session`` used to access HTTP(S) resources.
+
+    A single session is shared by all the threads in a process (a new
+    one is created in forked processes), so connections are reused.
+    Connection pools and retries are configured by the ``HTTP_SESSION``
+    setting.
+    """
+
+    session = getattr(current_app, 'http_session', None)
+    if session is None or session.pid != os.getpid():
+        conf = current_app.config['HTTP_SESSION']
+        retry = Retry(total=conf['retries'],
+                      backoff_factor=conf['backoff_factor'],
+                      status_forcelist=(500, 502, 503, 504),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=conf['pool_maxsize'],
+                              pool_maxsize=conf['pool_maxsize'],
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.pid = os.getpid()
+        current_app.http_session = session
+    return session
+
+
+def _http_request(method, url, **kwargs):
+    kwargs.setdefault('timeout', current_app.config['HTTP_SESSION']['timeout'])
+    return get_http_session().request(method, url, **kwargs)
+
+
 class ResourceAccessError(Exception):
     pass
 
@@ -127,7 +202,7 @@ class BaseResourceAccessor(object):
         """
         pass
 
-    def save_to_file(self, dest, blocksize=4096):
+    def save_to_file(self, dest, blocksize=COPY_BLOCKSIZE):
         """Save the resource to file"""
 
         src = self.open_resource()
@@ -151,8 +226,9 @@ class BaseResourceAccessor(object):
 
 class InternalResourceAccessor(BaseResourceAccessor):
     def open_resource(self):
-        oid = self._resource_record['data_oid']
-        return db.lobject(oid=oid, mode='rb')
+        record = self._resource_record
+        store = get_blob_store(record['blob_store'])
+        return store.open(db, record['blob_key'])
 
     @property
     def last_modified(self):
@@ -188,7 +264,7 @@ class InternalResourceAccessor(BaseResourceAccessor):
     def _resource_record(self):
         with db, db.cursor() as cur:
             cur.execute("""
-            SELECT id, mimetype, mtime, data_oid
+            SELECT id, mimetype, mtime, blob_store, blob_key
             FROM "resource" WHERE id = %(id)s;
             """, dict(id=self._resource_id))
             resource = cur.fetchone()
@@ -203,18 +279,60 @@ class InternalResourceAccessor(BaseResourceAccessor):
 class HttpResourceAccessor(BaseResourceAccessor):
     """
     Allow accessing an HTTP resource
+
+    If the resource cache is enabled (see ``RESOURCE_CACHE``), downloaded
+    resources are stored on disk, and conditional requests are used to
+    check whether they changed: unchanged resources are then read from
+    the cache.
     """
 
     def open_resource(self):
+        cache = get_resource_cache()
+        entry = None if cache is None else cache.get_entry(self.url)
+
+        headers = {}
+        if entry is not None:
+            if 'etag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['etag']
+            if 'last-modified' in entry['headers']:
+                headers['If-Modified-Since'] = \
+                    entry['headers']['last-modified']
+
+        resp = _http_request('GET', self.url, headers=headers, stream=True)
+
+        if resp.status_code == 304 and entry is not None:
+            resp.close()
+            cache.update_headers(entry, resp.headers)
+            self.__dict__['_headers'] = CaseInsensitiveDict(entry['headers'])
+            try:
+                return cache.open(entry)
+            except KeyError:
+                # Evicted in the meantime
+                resp = _http_request('GET', self.url, stream=True)
+
+        _check_response(resp)
+        self.__dict__['_headers'] = resp.headers  # Cache them!
+
+        if cache is not None and _is_cacheable(resp, cache.max_size):
+            entry = cache.store(self.url, resp.raw, resp.headers)
+            if entry is not None:
+                try:
+                    return cache.open(entry)
+                except KeyError:
+                    pass  # Evicted by someone else
+            # Too large, or evicted: the body was consumed, start over
+            resp.close()
+            resp = _http_request('GET', self.url, stream=True)
+            _check_response(resp)
+
         # Note: we cannot cache response as the body will
         #       be consumed the first time it is iterater
-        resp = requests.get(self.url, stream=True)
-        self.__dict__['_headers'] = resp.headers  # Cache them!
         return resp.raw
 
     @cached_property
     def _headers(self):
-        resp = requests.get(self.url, stream=True)
+        resp = _http_request('HEAD', self.url, allow_redirects=True)
+        _check_response(resp)
         return resp.headers
 
     @property
@@ -231,3 +349,33 @@ class HttpResourceAccessor(BaseResourceAccessor):
     @property
     def content_type(self):
         return cgi.parse_header(self._headers['content-type'])[0]
+
+
+def _check_response(resp):
+    """Raise the appropriate exception for HTTP error responses"""
+
+    if resp.status_code == 404:
+        raise ResourceNotFound("Resource not found: {0}".format(resp.url))
+    if resp.status_code in (401, 403):
+        raise ResourceAccessDenied("Access denied to resource: {0}"
+                                   .format(resp.url))
+    if resp.status_code >= 400:
+        raise ResourceAccessFailure("HTTP error {0} retrieving {1}"
+                                    .format(resp.status_code, resp.url))
+
+
+def _is_cacheable(resp, max_size):
+    """
+    Whether it makes sense to store a response in the cache,
+    i.e. we will be able to check whether it changed, and it's
+    not known to be larger than the cache.
+    """
+
+    if 'no-store' in resp.headers.get('cache-control', ''):
+        return False
+    try:
+        if int(resp.headers.get('content-length', 0)) > max_size:
+            return False
+    except ValueError:
+        pass
+    return 'etag' in resp.headers or 'last-modified' in resp.headers
@@ -0,0 +1,256 @@
+"""
+On-disk cache for resources downloaded from remote locations.
+
+Contents are stored by hash (so the same data, downloaded from several
+URLs, is stored only once) under ``objects/``, while ``index/`` maps
+each URL to its content hash, along with the headers needed to perform
+conditional requests (``ETag``, ``Last-Modified``).
+
+The total size of the stored objects is bounded: least recently used
+ones are deleted first. Files are written atomically (by renaming
+temporary files), so the cache can be shared by several processes.
+
+Example usage:
+
+.. code-block:: python
+
+    cache = ResourceCache('/var/cache/datacat', max_size=2 * 1024 ** 3)
+
+    entry = cache.get_entry(url)
+    if entry is None:
+        entry = cache.store(url, response.raw, response.headers)
+    if entry is not None:  # Not too large
+        with cache.open(entry) as fp:
+            data = fp.read()
+"""
+
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import json
+import os
+import tempfile
+
+from flask import current_app
+
+# Headers stored along with the cached objects
+CACHED_HEADERS = ('etag', 'last-modified', 'content-type')
+
+
+def get_resource_cache():
+    """
+    Return the :py:class:`ResourceCache` configured by the
+    ``RESOURCE_CACHE`` setting, or ``None`` if caching is disabled.
+    """
+
+    conf = current_app.config['RESOURCE_CACHE']
+    if conf is None:
+        return None
+    path = conf.get('path')
+    if path is None:
+        path = os.path.join(tempfile.gettempdir(), 'datacat-resource-cache')
+    return ResourceCache(path, max_size=conf['max_size'])
+
+
+class ResourceCache(object):
+    def __init__(self, path, max_size, blocksize=64 * 1024):
+        """
+        :param path: directory in which to store the cache
+        :param max_size: maximum total size of the stored objects, in bytes
+        :param blocksize: size of blocks in which data is copied
+        """
+
+        self.path = path
+        self.max_size = max_size
+        self.blocksize = blocksize
+        for name in ('index', 'objects', 'tmp'):
+            _makedirs(os.path.join(path, name))
+
+    def get_entry(self, url):
+        """
+        Get the cache entry for a URL, or ``None`` if the URL
+        (or its content) is not in the cache.
+
+        Entries are dictionaries with the ``url``, ``hash``, ``size``
+        and ``headers`` keys.
+        """
+
+        try:
+            with open(self._index_path(url), 'rb') as fp:
+                entry = json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+        if entry.get('url') != url:
+            return None  # Hash collision?!
+        if not os.path.exists(self._object_path(entry['hash'])):
+            return None  # Evicted
+        return entry
+
+    def open(self, entry):
+        """
+        Open the file containing data for a cache entry,
+        marking it as recently used.
+
+        :raises KeyError: if the data has been evicted in the meantime
+        """
+
+        path = self._object_path(entry['hash'])
+        try:
+            fp = open(path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(entry['url'])
+            raise
+        _touch(path)
+        return fp
+
+    def store(self, url, src, headers):
+        """
+        Store data for a URL in the cache, reading it from a file-like
+        object, then evict old objects (but not the new one) if needed.
+
+        Data larger than ``max_size`` is not stored: reading stops as
+        soon as that size is exceeded.
+
+        :param url: the URL from which data was retrieved
+        :param src: file-like object from which to read data
+        :param headers: the response headers (a case-insensitive mapping)
+        :return: the new cache entry, or ``None`` if data was too large
+        """
+
+        digest = hashlib.sha1()
+        size = 0
+
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.path, 'tmp'))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                while True:
+                    data = src.read(self.blocksize)
+                    if not data:
+                        break
+                    digest.update(data)
+                    size += len(data)
+                    if size > self.max_size:
+                        break
+                    fp.write(data)
+
+            if size > self.max_size:
+                os.unlink(tmp_path)
+                return None
+
+            content_hash = digest.hexdigest()
+            object_path = self._object_path(content_hash)
+            _makedirs(os.path.dirname(object_path))
+            os.rename(tmp_path, object_path)
+
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+        entry = {
+            'url': url,
+            'hash': content_hash,
+            'size': size,
+            'headers': dict((key, headers[key]) for key in CACHED_HEADERS
+                            if headers.get(key) is not None),
+        }
+        self._write_index(url, entry)
+        self.evict(keep=content_hash)
+        return entry
+
+    def update_headers(self, entry, headers):
+        """
+        Update the headers of a cache entry, eg. after a
+        ``304 Not Modified`` response.
+        """
+
+        entry['headers'].update(
+            (key, headers[key]) for key in CACHED_HEADERS
+            if headers.get(key) is not None)
+        self._write_index(entry['url'], entry)
+
+    def evict(self, keep=None):
+        """
+        Delete least recently used objects (along with their index
+        entries) until the total size is below ``max_size``.
+
+        :param keep: hash of an object that must not be deleted
+        """
+
+        keep_path = None if keep is None else self._object_path(keep)
+        objects = []
+        for dirpath, dirnames, filenames in os.walk(
+                os.path.join(self.path, 'objects')):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # Deleted by someone else
+                objects.append((st.st_mtime, st.st_size, path))
+
+        total_size = sum(size for _, size, _ in objects)
+        if total_size <= self.max_size:
+            return
+
+        objects.sort()
+        for mtime, size, path in objects:
+            if total_size <= self.max_size:
+                break
+            if path == keep_path:
+                continue
+            _unlink(path)
+            total_size -= size
+
+        # Drop index entries pointing to deleted objects
+        index_dir = os.path.join(self.path, 'index')
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            try:
+                with open(path, 'rb') as fp:
+                    entry = json.load(fp)
+            except (IOError, ValueError):
+                continue
+            if not os.path.exists(self._object_path(entry['hash'])):
+                _unlink(path)
+
+    def _write_index(self, url, entry):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.path, 'tmp'))
+        with os.fdopen(fd, 'wb') as fp:
+            json.dump(entry, fp)
+        os.rename(tmp_path, self._index_path(url))
+
+    def _index_path(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return os.path.join(self.path, 'index',
+                            hashlib.sha1(url).hexdigest() + '.json')
+
+    def _object_path(self, content_hash):
+        return os.path.join(self.path, 'objects',
+                            content_hash[:2], content_hash)
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _touch(path):
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
@@ -0,0 +1,935 @@
+"""
+Reader and writer for ESRI Shapefiles (``.shp`` / ``.shx`` / ``.dbf`` /
+``.prj``), decoding geometries to (E)WKB and attributes to Python values,
+and back.
+
+Files are memory-mapped, so records are decoded directly from the
+page cache, one at a time.
+
+Geometries are converted the same way ``shp2pgsql`` does:
+
++-------------------------+-------------------------+
+| Shape type              | Geometry type           |
++=========================+=========================+
+| Point                   | ``POINT``               |
++-------------------------+-------------------------+
+| MultiPoint              | ``MULTIPOINT``          |
++-------------------------+-------------------------+
+| PolyLine                | ``MULTILINESTRING``     |
++-------------------------+-------------------------+
+| Polygon                 | ``MULTIPOLYGON``        |
++-------------------------+-------------------------+
+
+``*Z`` shape types have four dimensions (``ZM``), ``*M`` ones three
+(``M``). Null shapes are returned as ``None``.
+
+Example usage:
+
+.. code-block:: python
+
+    with ShapefileReader('roads.shp') as reader:
+        names = [field.name for field in reader.fields]
+        for wkb, values in reader:
+            print(dict(zip(names, values)))
+
+    with ShapefileWriter('copy.shp', reader.fields) as writer:
+        for wkb, values in reader:
+            writer.write(wkb, values)
+"""
+
+from __future__ import absolute_import
+
+from array import array
+from collections import namedtuple
+import codecs
+import datetime
+import mmap
+import os
+import struct
+import sys
+
+# Shape types
+NULL_SHAPE = 0
+POINT, POLYLINE, POLYGON, MULTIPOINT = 1, 3, 5, 8
+POINT_Z, POLYLINE_Z, POLYGON_Z, MULTIPOINT_Z = 11, 13, 15, 18
+POINT_M, POLYLINE_M, POLYGON_M, MULTIPOINT_M = 21, 23, 25, 28
+
+# WKB geometry types and EWKB flags
+WKB_POINT, WKB_LINESTRING, WKB_POLYGON = 1, 2, 3
+WKB_MULTIPOINT, WKB_MULTILINESTRING, WKB_MULTIPOLYGON = 4, 5, 6
+EWKB_Z, EWKB_M, EWKB_SRID = 0x80000000, 0x40000000, 0x20000000
+
+# Base shape type -> (WKB type, geometry type name)
+_GEOMETRY_TYPES = {
+    POINT: (WKB_POINT, 'POINT'),
+    MULTIPOINT: (WKB_MULTIPOINT, 'MULTIPOINT'),
+    POLYLINE: (WKB_MULTILINESTRING, 'MULTILINESTRING'),
+    POLYGON: (WKB_MULTIPOLYGON, 'MULTIPOLYGON'),
+}
+
+_BIG_ENDIAN = sys.byteorder == 'big'
+
+
+class ShapefileError(Exception):
+    pass
+
+
+class Field(namedtuple('Field', 'name,type,length,decimals')):
+    """
+    A DBF field (attribute).
+
+    ``type`` is the DBF type character: ``C`` (string), ``N`` / ``F``
+    (number), ``L`` (logical), ``D`` (date); others are read as strings.
+    """
+
+    __slots__ = []
+
+
+class ShapefileReader(object):
+    """
+    Read a shapefile, iterating over ``(wkb, values)`` pairs; records
+    marked as deleted in the ``.dbf`` are skipped.
+
+    The ``.dbf`` file is required; the ``.shx`` index is used to locate
+    records if present. Related files are looked up with the same base
+    name as the ``.shp`` (and lower- or upper-case extension).
+
+    :param shp_path: path to the ``.shp`` file
+    :param encoding:
+        encoding of the attribute strings; by default, the one
+        named in the ``.cpg`` file, or UTF-8.
+    :param srid:
+        SRID embedded in the geometries (as EWKB), unless zero
+    """
+
+    def __init__(self, shp_path, encoding=None, srid=0):
+        self._files = []
+        self._maps = []
+        try:
+            self._open(shp_path, encoding, srid)
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self, shp_path, encoding, srid):
+        base = os.path.splitext(shp_path)[0]
+
+        self._shp = self._map_file(shp_path)
+        if len(self._shp) < 100:
+            raise ShapefileError("Truncated shapefile: {0}".format(shp_path))
+        file_code, = struct.unpack_from('>i', self._shp, 0)
+        if file_code != 9994:
+            raise ShapefileError("Not a shapefile: {0}".format(shp_path))
+        self._shp_length = min(
+            len(self._shp), struct.unpack_from('>i', self._shp, 24)[0] * 2)
+
+        #: The shape type of the file (eg. :py:data:`POLYLINE`)
+        self.shape_type, = struct.unpack_from('<i', self._shp, 32)
+
+        #: Bounding box, as ``(xmin, ymin, xmax, ymax)``
+        self.bbox = struct.unpack_from('<4d', self._shp, 36)
+
+        base_type = self.shape_type % 10
+        if self.shape_type not in (
+                NULL_SHAPE, base_type, base_type + 10, base_type + 20) or \
+                base_type not in _GEOMETRY_TYPES:
+            raise ShapefileError("Unsupported shape type: {0}"
+                                 .format(self.shape_type))
+        self._base_type = base_type
+        self._has_z = 10 < self.shape_type < 20
+        self._has_m = self.shape_type > 10
+
+        self._wkb_flags = ((EWKB_Z if self._has_z else 0) |
+                           (EWKB_M if self._has_m else 0))
+
+        #: SRID of the geometries (0 if unknown)
+        self.srid = srid
+
+        #: Number of coordinates per point (2, 3 or 4)
+        self.dimensions = 2 + self._has_z + self._has_m
+
+        shx_path = _find_related(base, 'shx')
+        self._shx = None if shx_path is None else self._map_file(shx_path)
+
+        self.prj = None
+        prj_path = _find_related(base, 'prj')
+        if prj_path is not None:
+            with open(prj_path, 'rb') as fp:
+                self.prj = fp.read().strip() or None
+
+        if encoding is None:
+            encoding = _read_cpg(_find_related(base, 'cpg'))
+        self.encoding = encoding
+
+        dbf_path = _find_related(base, 'dbf')
+        if dbf_path is None:
+            raise ShapefileError("Missing .dbf file for {0}"
+                                 .format(shp_path))
+        self._dbf = self._map_file(dbf_path)
+        self._read_dbf_header()
+
+    @property
+    def geometry_type(self):
+        """
+        Name of the geometry type, as used by PostGIS
+        (eg. ``MULTILINESTRINGZM``).
+        """
+
+        name = _GEOMETRY_TYPES[self._base_type][1]
+        if self._has_z:
+            return name + 'ZM'
+        if self._has_m:
+            return name + 'M'
+        return name
+
+    def _map_file(self, path):
+        fp = open(path, 'rb')
+        self._files.append(fp)
+        if os.fstat(fp.fileno()).st_size == 0:
+            return b''
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(data)
+        return data
+
+    def _read_dbf_header(self):
+        dbf = self._dbf
+        if len(dbf) < 32:
+            raise ShapefileError("Truncated .dbf file")
+
+        self.num_records, header_length, record_length = \
+            struct.unpack_from('<IHH', dbf, 4)
+        self._dbf_header_length = header_length
+        self._dbf_record_length = record_length
+
+        fields = []
+        offset = 32
+        while offset + 32 <= header_length and dbf[offset] != b'\r':
+            descriptor = dbf[offset:offset + 32]
+            name = descriptor[:11].split(b'\x00', 1)[0].strip()
+            field_type = descriptor[11:12].upper()
+            length, decimals = ord(descriptor[16]), ord(descriptor[17])
+            if field_type == b'C':
+                # Strings longer than 255 use "decimals" as the high byte
+                length, decimals = length + decimals * 256, 0
+            fields.append(Field(name.decode(self.encoding, 'replace'),
+                                field_type, length, decimals))
+            offset += 32
+
+        #: The :py:class:`Field` definitions of the attributes
+        self.fields = fields
+
+        self._decoders = []
+        position = 1  # After the "deleted" flag
+        for field in fields:
+            self._decoders.append((position, position + field.length,
+                                   self._get_decoder(field)))
+            position += field.length
+
+    def _get_decoder(self, field):
+        if field.type in (b'N', b'F'):
+            if field.type == b'N' and field.decimals == 0:
+                return _decode_integer
+            return _decode_float
+        if field.type == b'L':
+            return _decode_logical
+        if field.type == b'D':
+            return _decode_date
+        encoding = self.encoding
+        return lambda value: _decode_string(value, encoding)
+
+    def __iter__(self):
+        dbf = self._dbf
+        record_length = self._dbf_record_length
+        decoders = self._decoders
+        offset = self._dbf_header_length
+
+        for index, shp_offset in enumerate(self._iter_shp_offsets()):
+            if index >= self.num_records:
+                break
+            record = dbf[offset:offset + record_length]
+            offset += record_length
+            if record[:1] == b'*':
+                continue  # Deleted
+            if len(record) < record_length:
+                raise ShapefileError("Truncated .dbf file")
+
+            values = [decode(record[start:end])
+                      for start, end, decode in decoders]
+            yield self._read_geometry(shp_offset), values
+
+    def _iter_shp_offsets(self):
+        """Yield the offsets of the shape records contents"""
+
+        if self._shx is not None:
+            count = (len(self._shx) - 100) // 8
+            for i in xrange(count):
+                offset, = struct.unpack_from('>i', self._shx, 100 + i * 8)
+                yield offset * 2 + 8
+            return
+
+        offset = 100
+        while offset + 8 <= self._shp_length:
+            length, = struct.unpack_from('>i', self._shp, offset + 4)
+            yield offset + 8
+            offset += 8 + length * 2
+
+    # ------------------------------------------------------------
+    # Geometries
+
+    def _read_geometry(self, offset):
+        shp = self._shp
+        length, = struct.unpack_from('>i', shp, offset - 4)
+        shape_type, = struct.unpack_from('<i', shp, offset)
+        if shape_type == NULL_SHAPE:
+            return None
+        if shape_type != self.shape_type:
+            raise ShapefileError("Unexpected shape type {0} at offset {1}"
+                                 .format(shape_type, offset))
+        end = offset + length * 2
+        offset += 4
+        size = 8 * self.dimensions  # Of a point
+
+        if self._base_type == POINT:
+            coords = shp[offset:offset + size]
+            if len(coords) < size or offset + size > end:
+                # PointZ without the (optional) M value
+                coords = coords[:size - 8] + b'\x00' * 8
+            return self._header(WKB_POINT) + coords
+
+        if self._base_type == MULTIPOINT:
+            num_points, = struct.unpack_from('<i', shp, offset + 32)
+            coords = self._coords(offset + 36, num_points, end)
+            point_header = self._header(WKB_POINT, srid=False)
+            return b''.join(
+                [self._header(WKB_MULTIPOINT), struct.pack('<I', num_points)] +
+                [point_header + coords[i * size:(i + 1) * size]
+                 for i in xrange(num_points)])
+
+        num_parts, num_points = struct.unpack_from('<ii', shp, offset + 32)
+        parts = struct.unpack_from('<{0}i'.format(num_parts), shp, offset + 40)
+        points_offset = offset + 40 + 4 * num_parts
+        coords = self._coords(points_offset, num_points, end)
+        bounds = zip(parts, parts[1:] + (num_points,))
+
+        if self._base_type == POLYLINE:
+            line_header = self._header(WKB_LINESTRING, srid=False)
+            return b''.join(
+                [self._header(WKB_MULTILINESTRING),
+                 struct.pack('<I', num_parts)] +
+                [line_header + struct.pack('<I', stop - start) +
+                 coords[start * size:stop * size] for start, stop in bounds])
+
+        polygons = _group_rings(
+            _read_doubles(shp, points_offset, 2 * num_points), bounds)
+        polygon_header = self._header(WKB_POLYGON, srid=False)
+        chunks = [self._header(WKB_MULTIPOLYGON),
+                  struct.pack('<I', len(polygons))]
+        for rings in polygons:
+            chunks.append(polygon_header + struct.pack('<I', len(rings)))
+            for start, stop in rings:
+                chunks.append(struct.pack('<I', stop - start))
+                chunks.append(coords[start * size:stop * size])
+        return b''.join(chunks)
+
+    def _header(self, wkb_type, srid=True):
+        if srid and self.srid:
+            return struct.pack('<BII', 1, wkb_type | self._wkb_flags |
+                               EWKB_SRID, self.srid)
+        return struct.pack('<BI', 1, wkb_type | self._wkb_flags)
+
+    def _coords(self, offset, num_points, end):
+        """
+        Return the coordinates of ``num_points`` points, interleaved
+        as in WKB (little-endian doubles).
+
+        :param offset: offset of the X/Y array
+        :param end: end of the record
+        """
+
+        shp = self._shp
+        if self.dimensions == 2:
+            # Same layout as WKB: no need to decode anything
+            return shp[offset:offset + 16 * num_points]
+
+        xy = _read_doubles(shp, offset, 2 * num_points)
+        values = array('d', [0.0]) * (self.dimensions * num_points)
+        values[0::self.dimensions] = xy[0::2]
+        values[1::self.dimensions] = xy[1::2]
+
+        # Z values, then M values; each array preceded by its range
+        position = offset + 16 * num_points
+        for axis in xrange(2, self.dimensions):
+            position += 16
+            if position + 8 * num_points > end:
+                break  # M values are optional
+            values[axis::self.dimensions] = _read_doubles(
+                shp, position, num_points)
+            position += 8 * num_points
+
+        if _BIG_ENDIAN:
+            values.byteswap()
+        return values.tostring()
+
+    def close(self):
+        for data in self._maps:
+            data.close()
+        for fp in self._files:
+            fp.close()
+        self._maps, self._files = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ShapefileWriter(object):
+    """
+    Write a shapefile from ``(wkb, values)`` pairs, along with its
+    ``.shx`` index, ``.dbf`` attributes, ``.cpg`` encoding and (if
+    known) ``.prj`` projection.
+
+    Geometries are (E)WKB, as returned by :py:class:`ShapefileReader`
+    or PostGIS ``ST_AsEWKB()``: points, lines and polygons (single or
+    multi) with optional Z / M coordinates. Unless ``shape_type`` is
+    given, it is chosen from the first non-null geometry; missing Z / M
+    values are written as zero. Polygon rings are reoriented as
+    required (outer rings clockwise, holes counter-clockwise).
+
+    Field names are truncated to 10 characters (and made unique); the
+    file headers are written on :py:meth:`close`.
+
+    :param shp_path: path to the ``.shp`` file to create
+    :param fields: the :py:class:`Field` definitions of the attributes
+    :param shape_type: the shape type (eg. :py:data:`POLYLINE_Z`)
+    :param encoding: encoding of the attribute strings
+    :param prj: WKT of the projection, for the ``.prj`` file
+    """
+
+    def __init__(self, shp_path, fields, shape_type=None, encoding='utf-8',
+                 prj=None):
+        base = os.path.splitext(shp_path)[0]
+        self.fields = _dbf_fields(fields, encoding)
+        self.shape_type = shape_type
+        self.encoding = encoding
+        self.num_records = 0
+
+        #: Paths of the written files
+        self.paths = [base + '.shp', base + '.shx', base + '.dbf',
+                      base + '.cpg']
+        if prj is not None:
+            self.paths.append(base + '.prj')
+
+        self._files = []
+        try:
+            self._shp = self._create_file(self.paths[0], b'\x00' * 100)
+            self._shx = self._create_file(self.paths[1], b'\x00' * 100)
+            self._dbf = self._create_file(
+                self.paths[2], b'\x00' * (33 + 32 * len(self.fields)))
+            with open(self.paths[3], 'wb') as fp:
+                fp.write(codecs.lookup(encoding).name.upper().encode('ascii'))
+            if prj is not None:
+                with open(self.paths[4], 'wb') as fp:
+                    fp.write(prj)
+        except Exception:
+            self._close_files()
+            raise
+
+        self._shp_offset = 100
+
+        # xmin, ymin, xmax, ymax, zmin, zmax, mmin, mmax
+        self._bbox = None
+
+        self._encoders = [_get_encoder(field, encoding)
+                          for field in self.fields]
+
+    def _create_file(self, path, header):
+        fp = open(path, 'wb')
+        self._files.append(fp)
+        fp.write(header)
+        return fp
+
+    def write(self, wkb, values):
+        """
+        Append a record.
+
+        :param wkb: the geometry, or ``None`` for a null shape
+        :param values: the attribute values, in the order of the fields
+        """
+
+        geometry = None if wkb is None else _parse_wkb(wkb)
+        if geometry is None or not any(
+                len(part) for group in geometry[3] for part in group):
+            # Empty geometries are written as null shapes
+            content = struct.pack('<i', NULL_SHAPE)
+        else:
+            content = self._encode_geometry(*geometry)
+
+        self.num_records += 1
+        self._shx.write(struct.pack('>ii', self._shp_offset // 2,
+                                    len(content) // 2))
+        self._shp.write(struct.pack('>ii', self.num_records,
+                                    len(content) // 2))
+        self._shp.write(content)
+        self._shp_offset += 8 + len(content)
+
+        self._dbf.write(b' ' + b''.join(
+            encode(value) for encode, value in zip(self._encoders, values)))
+
+    def _encode_geometry(self, wkb_type, has_z, has_m, groups):
+        shape_type = _SHAPE_TYPES[wkb_type]
+        if self.shape_type is None:
+            self.shape_type = shape_type + (10 if has_z else 20 if has_m
+                                            else 0)
+        elif shape_type != self.shape_type % 10:
+            raise ShapefileError("Cannot write a {0} geometry to a shapefile"
+                                 " of type {1}".format(wkb_type,
+                                                       self.shape_type))
+
+        dims = 2 + has_z + has_m
+        if shape_type == POLYGON:
+            parts = []
+            for rings in groups:
+                for i, ring in enumerate(rings):
+                    # Outer rings clockwise, holes counter-clockwise
+                    area = _signed_area(_axis_values(ring, dims, 0, 2),
+                                        (0, len(ring) // dims))
+                    if (area > 0) == (i == 0):
+                        ring = _reverse_points(ring, dims)
+                    parts.append(ring)
+        else:
+            parts = [part for group in groups for part in group]
+
+        axes = [array('d'), array('d'), array('d'), array('d')]
+        for part in parts:
+            axes[0].extend(_axis_values(part, dims, 0))
+            axes[1].extend(_axis_values(part, dims, 1))
+            for axis, present in ((2, has_z), (3, has_m)):
+                if present:
+                    axes[axis].extend(
+                        _axis_values(part, dims, 2 + (axis == 3 and has_z)))
+                else:
+                    axes[axis].extend([0.0] * (len(part) // dims))
+
+        bounds = [(min(values), max(values)) if values else (0.0, 0.0)
+                  for values in axes]
+        self._update_bbox(bounds)
+
+        has_z = 10 < self.shape_type < 20
+        has_m = self.shape_type > 10
+        content = [struct.pack('<i', self.shape_type)]
+
+        if shape_type == POINT:
+            content.append(struct.pack('<2d', axes[0][0], axes[1][0]))
+            if has_z:
+                content.append(struct.pack('<d', axes[2][0]))
+            if has_m:
+                content.append(struct.pack('<d', axes[3][0]))
+            return b''.join(content)
+
+        num_points = len(axes[0])
+        content.append(struct.pack('<4d', bounds[0][0], bounds[1][0],
+                                   bounds[0][1], bounds[1][1]))
+        if shape_type == MULTIPOINT:
+            content.append(struct.pack('<i', num_points))
+        else:
+            starts, start = [], 0
+            for part in parts:
+                starts.append(start)
+                start += len(part) // dims
+            content.append(struct.pack('<ii', len(parts), num_points))
+            content.append(struct.pack('<{0}i'.format(len(parts)), *starts))
+
+        xy = array('d', [0.0]) * (2 * num_points)
+        xy[0::2], xy[1::2] = axes[0], axes[1]
+        content.append(_pack_doubles(xy))
+        for axis, present in ((2, has_z), (3, has_m)):
+            if present:
+                content.append(struct.pack('<2d', *bounds[axis]))
+                content.append(_pack_doubles(axes[axis]))
+        return b''.join(content)
+
+    def _update_bbox(self, bounds):
+        bbox = [value for pair in bounds for value in pair]
+        if self._bbox is None:
+            self._bbox = bbox
+            return
+        for i in xrange(0, 8, 2):
+            self._bbox[i] = min(self._bbox[i], bbox[i])
+            self._bbox[i + 1] = max(self._bbox[i + 1], bbox[i + 1])
+
+    def close(self):
+        """Write the file headers and close the files"""
+
+        if not self._files:
+            return
+        try:
+            self._write_headers()
+        finally:
+            self._close_files()
+
+    def _write_headers(self):
+        shape_type = self.shape_type or NULL_SHAPE
+        xmin, xmax, ymin, ymax, zmin, zmax, mmin, mmax = \
+            self._bbox or [0.0] * 8
+
+        for fp, length in ((self._shp, self._shp_offset),
+                           (self._shx, 100 + 8 * self.num_records)):
+            fp.seek(0)
+            fp.write(struct.pack('>i20xi', 9994, length // 2) +
+                     struct.pack('<ii', 1000, shape_type) +
+                     struct.pack('<8d', xmin, ymin, xmax, ymax,
+                                 zmin, zmax, mmin, mmax))
+
+        record_length = 1 + sum(field.length for field in self.fields)
+        header_length = 33 + 32 * len(self.fields)
+        today = datetime.date.today()
+        self._dbf.write(b'\x1a')  # End of file
+        self._dbf.seek(0)
+        self._dbf.write(struct.pack(
+            '<4BIHH20x', 3, today.year - 1900, today.month, today.day,
+            self.num_records, header_length, record_length))
+        for field in self.fields:
+            self._dbf.write(struct.pack(
+                '<11sc4xBB14x', field.name.encode(self.encoding),
+                field.type, field.length, field.decimals))
+        self._dbf.write(b'\r')
+
+    def _close_files(self):
+        for fp in self._files:
+            fp.close()
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _find_related(base, ext):
+    for name in (base + '.' + ext, base + '.' + ext.upper()):
+        if os.path.exists(name):
+            return name
+    return None
+
+
+def _read_cpg(path):
+    """Return the Python codec named in a ``.cpg`` file"""
+
+    if path is None:
+        return 'utf-8'
+    with open(path, 'rb') as fp:
+        name = fp.read().strip()
+    if name.isdigit():
+        name = 'cp' + name
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return 'utf-8'
+
+
+def _read_doubles(data, offset, count, big_endian=False):
+    values = array('d', data[offset:offset + 8 * count])
+    if _BIG_ENDIAN != big_endian:
+        values.byteswap()
+    return values
+
+
+def _pack_doubles(values):
+    """Encode an array of doubles as little-endian"""
+
+    if _BIG_ENDIAN:
+        values = array('d', values)
+        values.byteswap()
+    return values.tostring()
+
+
+def _group_rings(xy, bounds):
+    """
+    Group the rings of a shapefile polygon into polygons (outer ring
+    first, then holes): outer rings are clockwise, holes are assigned
+    to the outer ring containing them.
+
+    :param xy: X/Y coordinates of all the points
+    :param bounds: ``(start, end)`` point indices of each ring
+    :return: list of polygons, as lists of ``(start, end)``
+    """
+
+    if len(bounds) == 1:
+        return [bounds]
+
+    outer, holes = [], []
+    for ring in bounds:
+        if _signed_area(xy, ring) <= 0:
+            outer.append([ring])
+        else:
+            holes.append(ring)
+
+    if not outer:
+        # No clockwise ring: take them all as outer rings
+        return [[ring] for ring in holes]
+
+    for hole in holes:
+        polygon = outer[-1]
+        if len(outer) > 1:
+            x, y = xy[2 * hole[0]], xy[2 * hole[0] + 1]
+            for candidate in outer:
+                if _contains(xy, candidate[0], x, y):
+                    polygon = candidate
+                    break
+        polygon.append(hole)
+    return outer
+
+
+def _signed_area(xy, ring):
+    """Twice the signed area of a ring (negative if clockwise)"""
+
+    start, end = ring
+    xs, ys = xy[2 * start:2 * end:2], xy[2 * start + 1:2 * end:2]
+    return sum(xs[i] * ys[i + 1] - xs[i + 1] * ys[i]
+               for i in xrange(len(xs) - 1))
+
+
+def _contains(xy, ring, x, y):
+    """Whether a point is inside a ring (ray casting)"""
+
+    start, end = ring
+    xs, ys = xy[2 * start:2 * end:2], xy[2 * start + 1:2 * end:2]
+    inside = False
+    for i in xrange(len(xs) - 1):
+        x1, y1, x2, y2 = xs[i], ys[i], xs[i + 1], ys[i + 1]
+        if (y1 > y) != (y2 > y) and \
+                x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+
+# ------------------------------------------------------------
+# WKB parsing
+
+# WKB geometry type -> base shape type
+_SHAPE_TYPES = {
+    WKB_POINT: POINT,
+    WKB_MULTIPOINT: MULTIPOINT,
+    WKB_LINESTRING: POLYLINE,
+    WKB_MULTILINESTRING: POLYLINE,
+    WKB_POLYGON: POLYGON,
+    WKB_MULTIPOLYGON: POLYGON,
+}
+
+
+def _parse_wkb(data):
+    """
+    Parse a (E)WKB or ISO WKB geometry.
+
+    :return:
+        a ``(wkb_type, has_z, has_m, groups)`` tuple; ``groups`` has
+        an item for each point, line or polygon: the list of its point
+        sequences (arrays of interleaved coordinates), ie. the rings
+        of polygons.
+    """
+
+    wkb_type, has_z, has_m, groups, offset = _read_wkb(bytes(data), 0)
+    return wkb_type, has_z, has_m, groups
+
+
+def _read_wkb(data, offset):
+    big_endian = data[offset:offset + 1] == b'\x00'
+    endian = '>' if big_endian else '<'
+    wkb_type, = struct.unpack_from(endian + 'I', data, offset + 1)
+    offset += 5
+    if wkb_type & EWKB_SRID:
+        offset += 4
+    has_z = bool(wkb_type & EWKB_Z)
+    has_m = bool(wkb_type & EWKB_M)
+    wkb_type &= 0xfffffff
+    if wkb_type > 1000:
+        # ISO WKB: Z types are 1001..., M 2001..., ZM 3001...
+        has_z = has_z or wkb_type // 1000 in (1, 3)
+        has_m = has_m or wkb_type // 1000 in (2, 3)
+        wkb_type %= 1000
+    dims = 2 + has_z + has_m
+
+    if wkb_type == WKB_POINT:
+        coords = _read_doubles(data, offset, dims, big_endian)
+        return wkb_type, has_z, has_m, [[coords]], offset + 8 * dims
+
+    count, = struct.unpack_from(endian + 'I', data, offset)
+    offset += 4
+
+    if wkb_type == WKB_LINESTRING:
+        coords = _read_doubles(data, offset, dims * count, big_endian)
+        return (wkb_type, has_z, has_m, [[coords]],
+                offset + 8 * dims * count)
+
+    if wkb_type == WKB_POLYGON:
+        rings = []
+        for i in xrange(count):
+            num_points, = struct.unpack_from(endian + 'I', data, offset)
+            offset += 4
+            rings.append(_read_doubles(data, offset, dims * num_points,
+                                       big_endian))
+            offset += 8 * dims * num_points
+        return wkb_type, has_z, has_m, [rings], offset
+
+    if wkb_type in (WKB_MULTIPOINT, WKB_MULTILINESTRING, WKB_MULTIPOLYGON):
+        groups = []
+        for i in xrange(count):
+            _, _, _, members, offset = _read_wkb(data, offset)
+            groups.extend(members)
+        return wkb_type, has_z, has_m, groups, offset
+
+    raise ShapefileError("Unsupported WKB geometry type: {0}"
+                         .format(wkb_type))
+
+
+def _axis_values(coords, dims, axis, count=1):
+    """
+    Return the values of ``count`` consecutive axes (from ``axis``)
+    of interleaved coordinates, as an array.
+    """
+
+    if count == dims:
+        return coords
+    values = array('d', [0.0]) * (count * (len(coords) // dims))
+    for i in xrange(count):
+        values[i::count] = coords[axis + i::dims]
+    return values
+
+
+def _reverse_points(coords, dims):
+    reversed_coords = array('d')
+    for start in xrange(len(coords) - dims, -1, -dims):
+        reversed_coords.extend(coords[start:start + dims])
+    return reversed_coords
+
+
+# ------------------------------------------------------------
+# DBF values decoding
+
+def _decode_string(value, encoding):
+    value = value.rstrip(b' \x00')
+    if not value:
+        return None
+    return value.decode(encoding)
+
+
+def _decode_integer(value):
+    value = value.strip(b' \x00')
+    if not value or value.startswith(b'*'):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return int(float(value))
+
+
+def _decode_float(value):
+    value = value.strip(b' \x00')
+    if not value or value.startswith(b'*'):
+        return None
+    return float(value)
+
+
+def _decode_logical(value):
+    if value in (b'Y', b'y', b'T', b't'):
+        return True
+    if value in (b'N', b'n', b'F', b'f'):
+        return False
+    return None
+
+
+def _decode_date(value):
+    value = value.strip(b' \x00')
+    try:
+        return datetime.date(int(value[:4]), int(value[4:6]),
+                             int(value[6:8]))
+    except ValueError:
+        return None
+
+
+# ------------------------------------------------------------
+# DBF values encoding
+
+def _dbf_fields(fields, encoding):
+    """
+    Return the fields to be written to a ``.dbf`` file: names
+    truncated to 10 characters (bytes) and made unique, strings
+    limited to 254 characters.
+    """
+
+    result, names = [], set()
+    for field in fields:
+        name = field.name.encode(encoding)[:10].decode(encoding, 'ignore')
+        suffix = 1
+        while name.upper() in names:
+            tail = '_{0}'.format(suffix)
+            name = field.name.encode(encoding)[:10 - len(tail)].decode(
+                encoding, 'ignore') + tail
+            suffix += 1
+        names.add(name.upper())
+
+        length = field.length
+        if field.type == b'C':
+            length = max(1, min(254, length))
+        result.append(Field(name, field.type, length, field.decimals))
+    return result
+
+
+def _get_encoder(field, encoding):
+    """Return a function encoding values to fixed-width DBF fields"""
+
+    length, decimals = field.length, field.decimals
+    if field.type in (b'N', b'F'):
+        return lambda value: _encode_number(value, length, decimals)
+    if field.type == b'L':
+        return _encode_logical
+    if field.type == b'D':
+        return _encode_date
+    return lambda value: _encode_string(value, length, encoding)
+
+
+def _encode_string(value, length, encoding):
+    if value is None:
+        return b' ' * length
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    data = value.encode(encoding)
+    if len(data) > length:
+        # Don't leave truncated multi-byte characters around
+        data = data[:length].decode(encoding, 'ignore').encode(encoding)
+    return data.ljust(length)
+
+
+def _encode_number(value, length, decimals):
+    if value is None:
+        return b' ' * length
+    if decimals == 0 and isinstance(value, (int, long)):
+        text = str(value)
+    else:
+        text = '{0:.{1}f}'.format(value, decimals)
+        if len(text) > length:
+            # Fewer decimals, or else exponent notation (sign, point
+            # and exponent take up to 7 characters)
+            integral = len('{0:.0f}'.format(value))
+            if integral < length:
+                text = '{0:.{1}f}'.format(value, length - integral - 1)
+            else:
+                text = '{0:.{1}g}'.format(value, max(1, length - 7))
+    if len(text) > length:
+        return b'*' * length  # Overflow
+    return text.rjust(length)
+
+
+def _encode_logical(value):
+    if value is None:
+        return b'?'
+    return b'T' if value else b'F'
+
+
+def _encode_date(value):
+    if value is None:
+        return b' ' * 8
+    return '{0:04d}{1:02d}{2:02d}'.format(value.year, value.month, value.day)
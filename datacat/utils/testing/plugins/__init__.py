@@ -34,7 +34,9 @@ class DummyPlugin(Plugin):
 dummy_plugin = DummyPlugin(__name__ + ':dummy_plugin')
 
 
-@dummy_plugin.hook(['dataset_create'])
+# Handlers writing to the database are run asynchronously
+
+@dummy_plugin.hook(['dataset_create'], deferred=True)
 def on_dataset_create(dataset_id, dataset_conf):
     with db, db.cursor() as cur:
         cur.execute("""
@@ -44,7 +46,7 @@ def on_dataset_create(dataset_id, dataset_conf):
         """, (dataset_id, 'FOO data', 'BAR data'))
 
 
-@dummy_plugin.hook(['dataset_update'])
+@dummy_plugin.hook(['dataset_update'], deferred=True)
 def on_dataset_update(dataset_id, dataset_conf):
     with db, db.cursor() as cur:
         cur.execute("""
@@ -54,7 +56,7 @@ def on_dataset_update(dataset_id, dataset_conf):
         """, (dataset_id,))
 
 
-@dummy_plugin.hook(['dataset_delete'])
+@dummy_plugin.hook(['dataset_delete'], thread_safe=True)
 def on_dataset_delete(dataset_id):
     with db, db.cursor() as cur:
         cur.execute("""
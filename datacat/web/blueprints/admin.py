@@ -6,14 +6,18 @@ from cgi import parse_header
 import datetime
 import json
 import hashlib
+import tempfile
 
 from flask import Blueprint, request, url_for, current_app
 from werkzeug.exceptions import NotFound
 
-from datacat.db import db
+from datacat.db import db, get_pool
 from datacat.db import querybuilder
 from datacat.utils.const import DATE_FORMAT, HTTP_DATE_FORMAT
-from datacat.web.utils import json_view, _get_json_from_request
+from datacat.storage import store_blob, release_blob, purge_blobs
+from datacat.web.utils import (
+    json_view, _get_json_from_request, select_page, select_all,
+    is_export_request, json_stream_array)
 
 admin_bp = Blueprint('admin', __name__)
 
@@ -21,18 +25,23 @@ admin_bp = Blueprint('admin', __name__)
 @admin_bp.route('/resource/', methods=['GET'])
 @json_view
 def get_resource_index():
-    # todo: add paging support
+    fields = 'id, metadata, mimetype, mtime, ctime'
+
+    def _serialize(x):
+        return {'id': x['id'],
+                'metadata': x['metadata'],
+                'mimetype': x['mimetype'],
+                'ctime': x['ctime'].strftime(DATE_FORMAT),
+                'mtime': x['mtime'].strftime(DATE_FORMAT)}
+
+    if is_export_request():
+        rows = select_all('resource', fields=fields)
+        return json_stream_array(_serialize(x) for x in rows)
+
     with db, db.cursor() as cur:
-        cur.execute("""
-        SELECT id, metadata, mimetype, mtime, ctime FROM resource
-        ORDER BY id ASC
-        """)
-        return list({'id': x['id'],
-                     'metadata': x['metadata'],
-                     'mimetype': x['mimetype'],
-                     'ctime': x['ctime'].strftime(DATE_FORMAT),
-                     'mtime': x['mtime'].strftime(DATE_FORMAT)}
-                    for x in cur.fetchall())
+        rows, headers = select_page(cur, 'resource', fields=fields)
+
+    return [_serialize(x) for x in rows], 200, headers
 
 
 @admin_bp.route('/resource/', methods=['POST'])
@@ -48,20 +57,21 @@ def post_resource_index():
     if request.headers.get('Content-type'):
         content_type, _ = parse_header(request.headers['Content-type'])
 
-    # First, store the data in a PostgreSQL large object
-    with db, db.cursor() as cur:
-        lobj = db.lobject(oid=0, mode='wb')
-        oid = lobj.oid
-        lobj.write(request.data)
-        lobj.close()
+    data_file, resource_hash = _spool_request_data()
 
-        resource_hash = 'sha1:' + hashlib.sha1(request.data).hexdigest()
+    # First, store the data in a blob
+    # (unless we already have the same data)
+    with db, db.cursor() as cur:
+        blob_store, blob_key = store_blob(
+            cur, data_file, resource_hash,
+            blocksize=current_app.config['RESOURCE_UPLOAD_BLOCK_SIZE'])
 
         data = dict(
             metadata='{}',
             auto_metadata='{}',
             mimetype=content_type,
-            data_oid=oid,
+            blob_store=blob_store,
+            blob_key=blob_key,
             ctime=datetime.datetime.utcnow(),
             mtime=datetime.datetime.utcnow(),
             hash=resource_hash)
@@ -76,6 +86,46 @@ def post_resource_index():
     return '', 201, {'Location': location}
 
 
+def _write_request_data(dest):
+    """
+    Copy the request body to ``dest``, in blocks of
+    ``RESOURCE_UPLOAD_BLOCK_SIZE`` bytes, so that the whole upload is
+    never kept in memory.
+
+    :param dest:
+        An object with a ``.write(data)`` method: the spooled temporary
+        file from which the data is then stored in a blob, by whichever
+        blob store is configured (see :py:mod:`datacat.storage`)
+    :return:
+        The hash of the written data, as ``sha1:<hexdigest>``
+    """
+
+    blocksize = current_app.config['RESOURCE_UPLOAD_BLOCK_SIZE']
+    hasher = hashlib.sha1()
+    while True:
+        data = request.stream.read(blocksize)
+        if not data:
+            break
+        hasher.update(data)
+        dest.write(data)
+    return 'sha1:' + hasher.hexdigest()
+
+
+def _spool_request_data():
+    """
+    Read the request body to a temporary file (kept in memory up to
+    ``RESOURCE_UPLOAD_SPOOL_SIZE`` bytes), computing its hash.
+
+    :return: a ``(file, hash)`` tuple; the file is rewound
+    """
+
+    data_file = tempfile.SpooledTemporaryFile(
+        max_size=current_app.config['RESOURCE_UPLOAD_SPOOL_SIZE'])
+    resource_hash = _write_request_data(data_file)
+    data_file.seek(0)
+    return data_file, resource_hash
+
+
 @admin_bp.route('/resource/<int:resource_id>', methods=['GET'])
 def get_resource_data(resource_id):
     """
@@ -97,54 +147,65 @@ def put_resource_data(resource_id):
 
     with db.cursor() as cur:
         cur.execute("""
-        SELECT id, data_oid FROM "resource" WHERE id = %(id)s;
+        SELECT id, blob_store, blob_key, hash FROM "resource"
+        WHERE id = %(id)s;
         """, dict(id=resource_id))
         resource = cur.fetchone()
 
     if resource is None:
         raise NotFound()
 
-    # todo: better use a streaming response here..?
-    with db, db.cursor() as cur:
-        lobj = db.lobject(oid=resource['data_oid'], mode='wb')
-        lobj.seek(0)
-        lobj.truncate()
-        lobj.write(request.data)
-        lobj.close()
+    data_file, resource_hash = _spool_request_data()
 
-        resource_hash = 'sha1:' + hashlib.sha1(request.data).hexdigest()
+    # Blobs may be shared: never overwrite them, but point to
+    # a new one (or an existing one, with the same data) instead.
+    with db, db.cursor() as cur:
+        blob_store, blob_key = store_blob(
+            cur, data_file, resource_hash,
+            blocksize=current_app.config['RESOURCE_UPLOAD_BLOCK_SIZE'])
 
         data = dict(
             id=resource_id,
             mimetype=content_type,
+            blob_store=blob_store,
+            blob_key=blob_key,
             mtime=datetime.datetime.utcnow(),
             hash=resource_hash)
 
         query = querybuilder.update('resource', data)
         cur.execute(query, data)
 
+        released = None
+        if (blob_store, blob_key) != (resource['blob_store'],
+                                      resource['blob_key']):
+            released = release_blob(cur, resource['blob_store'],
+                                    resource['blob_key'], resource['hash'])
+
+    if released is not None:
+        purge_blobs([released])
+
     return '', 200
 
 
 @admin_bp.route('/resource/<int:resource_id>', methods=['DELETE'])
 def delete_resource_data(resource_id):
-    with db.cursor() as cur:
+    with db, db.cursor() as cur:
         cur.execute("""
-        SELECT id, data_oid FROM "resource" WHERE id = %(id)s;
+        DELETE FROM "resource" WHERE id = %(id)s
+        RETURNING blob_store, blob_key, hash;
         """, dict(id=resource_id))
         resource = cur.fetchone()
 
-    # todo: better use a streaming response here..?
-    with db:
-        lobj = db.lobject(oid=resource['data_oid'], mode='wb')
-        lobj.unlink()
+        if resource is None:
+            raise NotFound()
 
-    # Then, create a record for the metadata
-    with db, db.cursor() as cur:
-        query = querybuilder.delete('resource')
-        cur.execute(query, dict(id=resource_id))
+        # Data is only deleted along with its last reference
+        released = release_blob(cur, resource['blob_store'],
+                                resource['blob_key'], resource['hash'])
+
+    if released is not None:
+        purge_blobs([released])
 
-    db.commit()
     return '', 200
 
 
@@ -217,18 +278,22 @@ def patch_resource_metadata(resource_id):
 @admin_bp.route('/dataset/', methods=['GET'])
 @json_view
 def get_dataset_index():
-    # todo: add paging support
+    fields = 'id, configuration, ctime, mtime'
+
+    def _serialize(x):
+        return {'id': x['id'],
+                'configuration': x['configuration'],
+                'ctime': x['ctime'].strftime(DATE_FORMAT),
+                'mtime': x['mtime'].strftime(DATE_FORMAT)}
+
+    if is_export_request():
+        rows = select_all('dataset', fields=fields)
+        return json_stream_array(_serialize(x) for x in rows)
 
     with db.cursor() as cur:
-        cur.execute("""
-        SELECT id, configuration, ctime, mtime FROM dataset
-        ORDER BY id ASC
-        """)
-        return list({'id': x['id'],
-                     'configuration': x['configuration'],
-                     'ctime': x['ctime'].strftime(DATE_FORMAT),
-                     'mtime': x['mtime'].strftime(DATE_FORMAT)}
-                    for x in cur.fetchall())
+        rows, headers = select_page(cur, 'dataset', fields=fields)
+
+    return [_serialize(x) for x in rows], 200, headers
 
 
 @admin_bp.route('/dataset/', methods=['POST'])
@@ -313,6 +378,74 @@ def delete_dataset_configuration(dataset_id):
         query = querybuilder.delete('dataset')
         cur.execute(query, dict(id=dataset_id))
 
-    current_app.plugins.call_hook('dataset_delete', dataset_id)
+    # Cleanup handlers are usually independent from each other
+    current_app.plugins.call_hook_parallel('dataset_delete', dataset_id)
 
     return '', 200
+
+
+# ======================================================================
+# Deferred hook executions
+# ======================================================================
+
+
+def _serialize_hook_execution(x):
+    return {'id': x['id'],
+            'hook_type': x['hook_type'],
+            'plugin': x['plugin'],
+            'handler': x['handler'],
+            'arguments': x['arguments'],
+            'status': x['status'],
+            'result': x['result'],
+            'exception': x['exception'],
+            'ctime': x['ctime'].strftime(DATE_FORMAT),
+            'mtime': x['mtime'].strftime(DATE_FORMAT)}
+
+
+@admin_bp.route('/hook-execution/', methods=['GET'])
+@json_view
+def get_hook_execution_index():
+    """
+    List the executions of deferred hook handlers, along with
+    their status (``pending``, ``running``, ``success`` or
+    ``failure``) and result / exception traceback.
+    """
+
+    if is_export_request():
+        rows = select_all('hook_execution')
+        return json_stream_array(_serialize_hook_execution(x) for x in rows)
+
+    with db, db.cursor() as cur:
+        rows, headers = select_page(cur, 'hook_execution')
+
+    return [_serialize_hook_execution(x) for x in rows], 200, headers
+
+
+@admin_bp.route('/hook-execution/<int:execution_id>', methods=['GET'])
+@json_view
+def get_hook_execution(execution_id):
+    with db, db.cursor() as cur:
+        query = querybuilder.select_pk('hook_execution')
+        cur.execute(query, dict(id=execution_id))
+        execution = cur.fetchone()
+
+    if execution is None:
+        raise NotFound()
+
+    return _serialize_hook_execution(execution)
+
+
+# ======================================================================
+# Statistics
+# ======================================================================
+
+
+@admin_bp.route('/stats/db-pool', methods=['GET'])
+@json_view
+def get_db_pool_stats():
+    """
+    Return statistics about the database connection pool of
+    the process serving the request.
+    """
+
+    return get_pool().stats()
@@ -4,25 +4,93 @@ Utilities for the RESTful API
 
 from functools import wraps
 import json
+import types
+import zlib
 
-from flask import request, make_response
+from flask import (request, make_response, current_app, url_for,
+                   stream_with_context)
 from werkzeug.exceptions import BadRequest
 
+from datacat.db import db, querybuilder
+
 
 def json_view(func):
+    """
+    Decorator for views returning JSON-serializable objects
+    (optionally in a ``(body, status, headers)`` tuple).
+
+    Views can also return a generator yielding fragments of an
+    already-encoded JSON document (see :py:func:`json_stream_array`):
+    they will be streamed to the client as they are generated,
+    keeping the request context alive in the meantime.
+    """
+
     @wraps(func)
     def wrapper(*a, **kw):
         # todo: catch exceptions and rewrap + make sure they're all JSON
         rv = func(*a, **kw)
         if isinstance(rv, tuple):
-            resp = make_response(json.dumps(rv[0]), *rv[1:])
+            body, args = rv[0], rv[1:]
         else:
-            resp = make_response(json.dumps(rv))
+            body, args = rv, ()
+        if isinstance(body, types.GeneratorType):
+            body = current_app.response_class(stream_with_context(body))
+        else:
+            body = json.dumps(body)
+        resp = make_response(body, *args)
         resp.headers['Content-type'] = 'application/json'
         return resp
     return wrapper
 
 
+def json_stream_array(items):
+    """
+    Generator encoding items from an iterable as a JSON array,
+    one item at a time.
+    """
+
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item)
+        separator = ', '
+    yield ']'
+
+
+def streaming_response(chunks, mimetype, compress_level=6):
+    """
+    Return a response streaming data from an iterable, keeping the
+    request context alive while iterating.
+
+    If the client accepts it, the data is gzip-compressed on the fly,
+    one chunk at a time.
+    """
+
+    headers = {'Vary': 'Accept-Encoding'}
+    if request.accept_encodings['gzip']:
+        chunks = gzip_stream(chunks, compress_level)
+        headers['Content-Encoding'] = 'gzip'
+    return current_app.response_class(
+        stream_with_context(chunks), mimetype=mimetype, headers=headers)
+
+
+def gzip_stream(chunks, compress_level=6):
+    """
+    Generator compressing data from an iterable to the gzip format,
+    without holding more than a chunk in memory.
+    """
+
+    compressor = zlib.compressobj(
+        compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
 def _get_json_from_request():
     if request.headers.get('Content-type') != 'application/json':
         raise BadRequest(
@@ -31,3 +99,110 @@ def _get_json_from_request():
         return json.loads(request.data)
     except:
         raise BadRequest('Error decoding json')
+
+
+def select_page(cur, table, fields=None, table_key='id'):
+    """
+    Select a page of records from a table, according to the ``start``
+    and ``size`` request arguments, using keyset pagination on
+    ``table_key``.
+
+    ``start`` is the (inclusive) key of the first record in the page,
+    ``size`` the maximum number of records to be returned (up to
+    ``PAGE_SIZE_MAX``, defaulting to ``PAGE_SIZE_DEFAULT``).
+
+    :param cur: A database cursor
+    :param table: Name of the table to select from
+    :param fields: List of field names to be selected
+    :param table_key: Name of the key field used for paging
+
+    :return:
+        A ``(rows, headers)`` tuple, where headers contain the ``Link``
+        (to the first / next pages) and ``X-page-*`` headers.
+    """
+
+    start, size = _get_page_args()
+    query = querybuilder.select_keyset(
+        table, fields=fields, table_key=table_key, limit=size + 1)
+    cur.execute(query, {table_key: start})
+    rows = cur.fetchall()
+
+    # We asked for one more record, to know the start of the next page
+    next_start = None
+    if len(rows) > size:
+        next_start = rows[size][table_key]
+        rows = rows[:size]
+
+    return rows, _make_page_headers(start, size, next_start)
+
+
+def is_export_request():
+    """
+    Check whether the client asked for all the records
+    (passing ``size=all``) instead of a single page.
+    """
+
+    return request.args.get('size') == 'all'
+
+
+def select_all(table, fields=None, table_key='id'):
+    """
+    Return an iterator over all the records from a table (with key
+    greater or equal to the ``start`` request argument), ordered by key.
+
+    A server-side cursor is used, fetching ``EXPORT_BATCH_SIZE``
+    records at a time, so memory usage does not depend on the
+    number of records.
+
+    .. note:: Meant to be used from views returning a generator,
+              as the request connection is used while iterating.
+    """
+
+    # Arguments are checked right away, not once the response
+    # has started streaming.
+    try:
+        start = int(request.args.get('start', 0))
+    except ValueError:
+        raise BadRequest('Invalid paging arguments')
+
+    query = querybuilder.select_keyset(
+        table, fields=fields, table_key=table_key, limit=None)
+    itersize = current_app.config['EXPORT_BATCH_SIZE']
+
+    def _iter_rows():
+        with db, db.cursor(name='datacat_select_all') as cur:
+            cur.itersize = itersize
+            cur.execute(query, {table_key: start})
+            for row in cur:
+                yield row
+
+    return _iter_rows()
+
+
+def _get_page_args():
+    try:
+        start = int(request.args.get('start', 0))
+        size = int(request.args.get(
+            'size', current_app.config['PAGE_SIZE_DEFAULT']))
+    except ValueError:
+        raise BadRequest('Invalid paging arguments')
+    if start < 0 or size < 1:
+        raise BadRequest('Invalid paging arguments')
+    return start, min(size, current_app.config['PAGE_SIZE_MAX'])
+
+
+def _make_page_headers(start, size, next_start):
+    def _link(_start, rel):
+        url = url_for(request.endpoint, start=_start, size=size,
+                      **(request.view_args or {}))
+        return '<{0}>; rel="{1}"'.format(url, rel)
+
+    links = [_link(0, 'first')]
+    if next_start is not None:
+        links.append(_link(next_start, 'next'))
+
+    return {
+        'Link': ', '.join(links),
+        'X-page-start': str(start),
+        'X-page-size': str(size),
+    }
@@ -1,5 +1,8 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
 import os
 import random
+import threading
 import time
 from urlparse import urlparse
 import shutil
@@ -187,3 +190,84 @@ def redis_instance(request):
 @pytest.fixture
 def data_dir():
     return TESTS_DATA_DIR
+
+
+class _StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections alive
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_HEAD(self):
+        self._respond(send_body=False)
+
+    def do_GET(self):
+        self._respond(send_body=True)
+
+    def _respond(self, send_body):
+        server = self.server
+        server.requests.append((self.command, self.path, dict(self.headers)))
+
+        if server.failures.get(self.path, 0) > 0:
+            server.failures[self.path] -= 1
+            return self._send(503, {}, b'')
+
+        if self.path not in server.resources:
+            return self._send(404, {}, b'')
+
+        data, headers = server.resources[self.path]
+        etag = headers.get('ETag')
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            return self._send(304, {'ETag': etag}, b'')
+
+        self._send(200, headers, data if send_body else b'',
+                   content_length=len(data))
+
+    def _send(self, status, headers, body, content_length=None):
+        self.send_response(status)
+        for key, value in headers.iteritems():
+            self.send_header(key, value)
+        self.send_header('Content-length', str(
+            len(body) if content_length is None else content_length))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *a):
+        pass
+
+
+class StandInHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    Local HTTP server standing in for remote resources.
+
+    - ``resources`` maps paths to ``(data, headers)`` tuples
+    - ``failures`` maps paths to the number of ``503`` errors to be
+      returned before actually serving the resource
+    - ``requests`` records ``(method, path, headers)`` of all requests
+    - ``connections`` counts the accepted connections
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInRequestHandler)
+        self.resources = {}
+        self.failures = {}
+        self.requests = []
+        self.connections = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_port)
+
+
+@pytest.yield_fixture
+def http_server():
+    server = StandInHTTPServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
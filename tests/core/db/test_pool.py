@@ -0,0 +1,109 @@
+import threading
+import time
+
+import mock
+import pytest
+
+from datacat.db.pool import ConnectionPool, PoolTimeout
+
+
+def _make_connection():
+    conn = mock.Mock()
+    conn.closed = 0
+
+    def _close():
+        conn.closed = 1
+
+    conn.close.side_effect = _close
+    return conn
+
+
+def test_pool_reuses_connections():
+    connect = mock.Mock(side_effect=_make_connection)
+    pool = ConnectionPool(connect, minconn=1, maxconn=3)
+    assert connect.call_count == 1
+    assert pool.stats()['idle'] == 1
+
+    conn1 = pool.getconn()
+    assert connect.call_count == 1
+    assert conn1.autocommit is False
+    assert pool.stats()['in_use'] == 1
+    assert pool.stats()['idle'] == 0
+
+    conn2 = pool.getconn(autocommit=True)
+    assert connect.call_count == 2
+    assert conn2 is not conn1
+    assert conn2.autocommit is True
+
+    pool.putconn(conn1)
+    assert conn1.rollback.call_count == 1
+    assert pool.stats()['in_use'] == 1
+    assert pool.stats()['idle'] == 1
+
+    assert pool.getconn() is conn1
+    assert connect.call_count == 2
+
+
+def test_pool_discards_broken_connections():
+    connect = mock.Mock(side_effect=_make_connection)
+    pool = ConnectionPool(connect, minconn=0, maxconn=3)
+
+    conn = pool.getconn()
+    conn.rollback.side_effect = Exception('Connection lost')
+    pool.putconn(conn)
+    assert conn.closed
+    assert pool.stats()['in_use'] == 0
+    assert pool.stats()['idle'] == 0
+
+    conn = pool.getconn()
+    pool.putconn(conn, close=True)
+    assert conn.closed
+    assert pool.stats()['idle'] == 0
+
+
+def test_pool_waits_when_full():
+    connect = mock.Mock(side_effect=_make_connection)
+    pool = ConnectionPool(connect, minconn=0, maxconn=1, timeout=5)
+
+    conn = pool.getconn()
+    got = []
+
+    def _worker():
+        got.append(pool.getconn())
+
+    thread = threading.Thread(target=_worker)
+    thread.start()
+    time.sleep(.2)
+    assert got == []
+    assert pool.stats()['waiting'] == 1
+
+    pool.putconn(conn)
+    thread.join(5)
+    assert got == [conn]
+
+    stats = pool.stats()
+    assert stats['waiting'] == 0
+    assert stats['wait_count'] == 1
+    assert stats['wait_time'] >= .2
+    assert stats['max_wait_time'] >= .2
+    assert connect.call_count == 1
+
+
+def test_pool_timeout():
+    pool = ConnectionPool(_make_connection, minconn=0, maxconn=1,
+                          timeout=.1)
+    pool.getconn()
+
+    with pytest.raises(PoolTimeout):
+        pool.getconn()
+
+    assert pool.stats()['waiting'] == 0
+    assert pool.stats()['wait_count'] == 1
+
+
+def test_pool_invalid_size():
+    with pytest.raises(ValueError):
+        ConnectionPool(_make_connection, minconn=0, maxconn=0)
+
+    with pytest.raises(ValueError):
+        ConnectionPool(_make_connection, minconn=5, maxconn=2)
@@ -38,6 +38,27 @@ def test_querybuilder_select_paged():
                      'OFFSET 40 LIMIT 20')
 
 
+def test_querybuilder_select_keyset():
+    query = querybuilder.select_keyset('mytable')
+    assert query == ('SELECT * FROM "mytable" WHERE "id">=%(id)s '
+                     'ORDER BY "id" ASC LIMIT 10')
+
+    query = querybuilder.select_keyset('mytable', fields='one, two',
+                                       table_key='my_id', limit=20)
+    assert query == ('SELECT one, two FROM "mytable" WHERE "my_id">=%(my_id)s '
+                     'ORDER BY "my_id" ASC LIMIT 20')
+
+    query = querybuilder.select_keyset('mytable', limit=None)
+    assert query == ('SELECT * FROM "mytable" WHERE "id">=%(id)s '
+                     'ORDER BY "id" ASC')
+
+    with pytest.raises(ValueError):
+        querybuilder.select_keyset('Invalid table name')
+
+    with pytest.raises(ValueError):
+        querybuilder.select_keyset('mytable', table_key='Invalid field name')
+
+
 def test_querybuilder_insert():
     data = {'foo': 'FOO', 'bar': 'BAR'}
     query = querybuilder.insert('mytable', sorted(data.keys()))
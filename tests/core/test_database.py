@@ -1,7 +1,10 @@
+import time
+
 import pytest
 import psycopg2
 
-from datacat.db import create_tables, drop_tables, DbInfoDict
+from datacat.db import (
+    connect, create_tables, drop_tables, DbInfoDict, DbInfoCache)
 
 
 def test_table_create_drop(postgres_user_db_ac):
@@ -107,3 +110,74 @@ def test_db_info_table(postgres_user_db):
     assert sorted(list(db_info.iteritems())) == [
         ('foo', 'FOO'),
     ]
+
+
+def test_db_info_cache_coherence(request, postgres_user_conf):
+    def _connect(autocommit=False):
+        conn = connect(**postgres_user_conf)
+        conn.autocommit = autocommit
+        request.addfinalizer(lambda: conn.close())
+        return conn
+
+    # Two "processes", each with its own cache
+    info1 = DbInfoDict(_connect(), DbInfoCache(_connect(autocommit=True)))
+    info2 = DbInfoDict(_connect(), DbInfoCache(_connect(autocommit=True)))
+
+    info1['spam'] = 'SPAM'
+    assert info1['spam'] == 'SPAM'
+    assert info2['spam'] == 'SPAM'  # Populates the cache
+
+    info1['spam'] = 'EGGS'
+    info1['bacon'] = 'BACON'
+    assert info1['spam'] == 'EGGS'
+
+    def _wait_for(func):
+        # Notifications are delivered asynchronously
+        for _ in xrange(50):
+            if func():
+                return True
+            time.sleep(.1)
+        return False
+
+    assert _wait_for(lambda: info2.get('spam') == 'EGGS')
+    assert info2['bacon'] == 'BACON'
+
+    del info2['spam']
+    assert _wait_for(lambda: 'spam' not in info1)
+    assert info1['bacon'] == 'BACON'
+
+
+def test_db_info_cache_reconnect(request, postgres_user_conf):
+    def _connect(autocommit=False):
+        conn = connect(**postgres_user_conf)
+        conn.autocommit = autocommit
+        request.addfinalizer(lambda: conn.close())
+        return conn
+
+    cache = DbInfoCache(connect_func=lambda: _connect(autocommit=True))
+    info1 = DbInfoDict(_connect())
+    info2 = DbInfoDict(_connect(), cache)
+
+    info1['spam'] = 'SPAM'
+    assert info2['spam'] == 'SPAM'  # Populates the cache
+
+    # Lose the listening connection (along with the notification)
+    listen_pid = cache._listen_conn.get_backend_pid()
+    with info1._db, info1._db.cursor() as cur:
+        cur.execute("SELECT pg_terminate_backend(%s);", (listen_pid,))
+    info1['spam'] = 'EGGS'
+
+    for _ in xrange(50):
+        if info2['spam'] == 'EGGS':
+            break
+        time.sleep(.1)
+    assert info2['spam'] == 'EGGS'
+
+    # Listening again, on a new connection
+    assert cache._listen_conn.get_backend_pid() != listen_pid
+    info1['bacon'] = 'BACON'
+    for _ in xrange(50):
+        if 'bacon' in info2:
+            break
+        time.sleep(.1)
+    assert info2['bacon'] == 'BACON'
@@ -123,3 +123,72 @@ def test_dataset_crud_errors(configured_app):
 
     resp = apptc.delete('/api/1/admin/dataset/12345')
     assert resp.status_code == 200
+
+
+def test_dataset_listing_paging(configured_app):
+    apptc = configured_app.test_client()
+
+    dataset_ids = []
+    for i in xrange(5):
+        resp = apptc.post('/api/1/admin/dataset/',
+                          headers={'Content-type': 'application/json'},
+                          data=json.dumps({'num': i}))
+        assert resp.status_code == 201
+        path = urlparse.urlparse(resp.headers['Location']).path
+        match = re.match('/api/1/admin/dataset/([0-9]+)', path)
+        dataset_ids.append(int(match.group(1)))
+
+    # ------------------------------------------------------------
+    # Walk the pages by following the "next" links
+
+    found = []
+    url = '/api/1/admin/dataset/?size=2'
+    while url is not None:
+        resp = apptc.get(url)
+        assert resp.status_code == 200
+        assert resp.headers['X-page-size'] == '2'
+        data = json.loads(resp.data)
+        assert len(data) <= 2
+        found.extend(x['id'] for x in data)
+
+        match = re.search(r'<([^>]+)>; rel="next"', resp.headers['Link'])
+        url = match.group(1) if match else None
+
+    assert found == dataset_ids
+
+    # The start key is inclusive
+    resp = apptc.get('/api/1/admin/dataset/?start={0}&size=2'
+                     .format(dataset_ids[3]))
+    assert resp.status_code == 200
+    assert [x['id'] for x in json.loads(resp.data)] == dataset_ids[3:]
+    assert 'rel="next"' not in resp.headers['Link']
+
+    # The public API is paged too
+    resp = apptc.get('/api/1/data/?start={0}&size=3'.format(dataset_ids[0]))
+    assert resp.status_code == 200
+    assert [x['id'] for x in json.loads(resp.data)] == dataset_ids[:3]
+
+    # Export everything at once
+    resp = apptc.get('/api/1/admin/dataset/?size=all')
+    assert resp.status_code == 200
+    assert resp.headers['Content-type'] == 'application/json'
+    data = json.loads(resp.data)
+    assert [x['id'] for x in data] == dataset_ids
+    assert [x['configuration'] for x in data] == [
+        {'num': i} for i in xrange(5)]
+
+    resp = apptc.get('/api/1/data/?size=all&start={0}'
+                     .format(dataset_ids[2]))
+    assert resp.status_code == 200
+    assert [x['id'] for x in json.loads(resp.data)] == dataset_ids[2:]
+
+    # Invalid arguments
+    resp = apptc.get('/api/1/admin/dataset/?size=foo')
+    assert resp.status_code == 400
+
+    resp = apptc.get('/api/1/admin/dataset/?size=0')
+    assert resp.status_code == 400
+
+    for dataset_id in dataset_ids:
+        resp = apptc.delete('/api/1/admin/dataset/{0}'.format(dataset_id))
+        assert resp.status_code == 200
@@ -1,7 +1,14 @@
+import hashlib
 import json
+import os
 import re
 import urlparse
 
+import psycopg2
+import pytest
+
+from datacat.db import db
+
 
 def test_resource_empty_listing(configured_app):
     apptc = configured_app.test_client()
@@ -125,6 +132,179 @@ def test_resource_create_default_mime(configured_app):
     assert resp.headers['Content-type'] == 'application/octet-stream'
 
 
+def test_resource_upload_large(configured_app):
+    apptc = configured_app.test_client()
+
+    # Make sure the payload spans a lot of upload blocks
+    blocksize = configured_app.config['RESOURCE_UPLOAD_BLOCK_SIZE']
+    configured_app.config['RESOURCE_UPLOAD_BLOCK_SIZE'] = 1024
+    DATA_PAYLOAD = os.urandom(5 * 1024 * 1024 + 123)
+    DATA_HASH = 'sha1:' + hashlib.sha1(DATA_PAYLOAD).hexdigest()
+
+    try:
+        resp = apptc.post('/api/1/admin/resource/',
+                          headers={'Content-type': 'application/zip'},
+                          data=DATA_PAYLOAD)
+        assert resp.status_code == 201
+        path = urlparse.urlparse(resp.headers['Location']).path
+        match = re.match('/api/1/admin/resource/([0-9]+)', path)
+        resource_id = int(match.group(1))
+
+        resp = apptc.get('/api/1/data/resource/{0}'.format(resource_id))
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] == DATA_HASH
+        assert resp.data == DATA_PAYLOAD
+
+        # Now replace with another payload, smaller than the first one
+        DATA_PAYLOAD = DATA_PAYLOAD[:3 * 1024 * 1024 + 7]
+        DATA_HASH = 'sha1:' + hashlib.sha1(DATA_PAYLOAD).hexdigest()
+
+        resp = apptc.put('/api/1/admin/resource/{0}'.format(resource_id),
+                         headers={'Content-type': 'application/zip'},
+                         data=DATA_PAYLOAD)
+        assert resp.status_code == 200
+
+        resp = apptc.get('/api/1/data/resource/{0}'.format(resource_id))
+        assert resp.status_code == 200
+        assert resp.headers['ETag'] == DATA_HASH
+        assert resp.data == DATA_PAYLOAD
+
+    finally:
+        configured_app.config['RESOURCE_UPLOAD_BLOCK_SIZE'] = blocksize
+
+
+def test_resource_deduplication(configured_app):
+    apptc = configured_app.test_client()
+
+    def _create(payload):
+        resp = apptc.post('/api/1/admin/resource/', data=payload)
+        assert resp.status_code == 201
+        path = urlparse.urlparse(resp.headers['Location']).path
+        match = re.match('/api/1/admin/resource/([0-9]+)', path)
+        return int(match.group(1))
+
+    def _get_blob(resource_id):
+        with configured_app.app_context():
+            with db, db.cursor() as cur:
+                cur.execute('SELECT blob_store, blob_key FROM "resource"'
+                            ' WHERE id=%s;', (resource_id,))
+                return tuple(cur.fetchone())
+
+    def _get_data(resource_id):
+        resp = apptc.get('/api/1/data/resource/{0}'.format(resource_id))
+        assert resp.status_code == 200
+        return resp.data
+
+    DATA_PAYLOAD = os.urandom(1024)
+    res1 = _create(DATA_PAYLOAD)
+    res2 = _create(DATA_PAYLOAD)
+    res3 = _create(DATA_PAYLOAD[::-1])
+
+    # Same data is stored only once
+    assert res1 != res2
+    assert _get_blob(res1) == _get_blob(res2)
+    assert _get_blob(res1) != _get_blob(res3)
+
+    # Updating a resource doesn't affect the ones sharing its data
+    resp = apptc.put('/api/1/admin/resource/{0}'.format(res2),
+                     data=DATA_PAYLOAD[::-1])
+    assert resp.status_code == 200
+    assert _get_blob(res2) == _get_blob(res3)
+    assert _get_data(res1) == DATA_PAYLOAD
+    assert _get_data(res2) == DATA_PAYLOAD[::-1]
+
+    # Data is kept until the last reference is deleted
+    shared_blob = _get_blob(res2)
+    assert shared_blob[0] == 'lo'
+    resp = apptc.delete('/api/1/admin/resource/{0}'.format(res2))
+    assert resp.status_code == 200
+    assert _get_data(res3) == DATA_PAYLOAD[::-1]
+
+    resp = apptc.delete('/api/1/admin/resource/{0}'.format(res3))
+    assert resp.status_code == 200
+    with configured_app.app_context():
+        with pytest.raises(psycopg2.OperationalError):
+            db.lobject(oid=int(shared_blob[1]), mode='rb')
+        db.rollback()
+
+    assert _get_data(res1) == DATA_PAYLOAD
+
+    resp = apptc.delete('/api/1/admin/resource/{0}'.format(res3))
+    assert resp.status_code == 404
+
+
+def test_resource_range_requests(configured_app):
+    apptc = configured_app.test_client()
+    DATA_PAYLOAD = ''.join(chr(x % 256) for x in xrange(100000))
+
+    resp = apptc.post('/api/1/admin/resource/',
+                      headers={'Content-type': 'application/octet-stream'},
+                      data=DATA_PAYLOAD)
+    assert resp.status_code == 201
+    path = urlparse.urlparse(resp.headers['Location']).path
+    match = re.match('/api/1/admin/resource/([0-9]+)', path)
+    resource_id = int(match.group(1))
+    url = '/api/1/data/resource/{0}'.format(resource_id)
+
+    # ------------------------------------------------------------
+    # Plain requests advertise range support
+
+    resp = apptc.get(url)
+    assert resp.status_code == 200
+    assert resp.headers['Accept-Ranges'] == 'bytes'
+    assert resp.headers['Content-Length'] == '100000'
+    assert resp.data == DATA_PAYLOAD
+    etag = resp.headers['ETag']
+
+    resp = apptc.head(url)
+    assert resp.status_code == 200
+    assert resp.headers['Content-Length'] == '100000'
+    assert resp.data == ''
+
+    # ------------------------------------------------------------
+    # Partial content
+
+    resp = apptc.get(url, headers={'Range': 'bytes=1000-1999'})
+    assert resp.status_code == 206
+    assert resp.headers['Content-Range'] == 'bytes 1000-1999/100000'
+    assert resp.headers['Content-Length'] == '1000'
+    assert resp.data == DATA_PAYLOAD[1000:2000]
+
+    resp = apptc.get(url, headers={'Range': 'bytes=99000-'})
+    assert resp.status_code == 206
+    assert resp.headers['Content-Range'] == 'bytes 99000-99999/100000'
+    assert resp.data == DATA_PAYLOAD[99000:]
+
+    resp = apptc.get(url, headers={'Range': 'bytes=-10'})
+    assert resp.status_code == 206
+    assert resp.data == DATA_PAYLOAD[-10:]
+
+    resp = apptc.head(url, headers={'Range': 'bytes=0-99'})
+    assert resp.status_code == 206
+    assert resp.headers['Content-Length'] == '100'
+    assert resp.data == ''
+
+    # ------------------------------------------------------------
+    # If-Range with the current ETag is honored, otherwise
+    # the whole body is returned
+
+    resp = apptc.get(url, headers={'Range': 'bytes=0-9', 'If-Range': etag})
+    assert resp.status_code == 206
+    assert resp.data == DATA_PAYLOAD[:10]
+
+    resp = apptc.get(url, headers={'Range': 'bytes=0-9',
+                                   'If-Range': 'sha1:outdated'})
+    assert resp.status_code == 200
+    assert resp.data == DATA_PAYLOAD
+
+    # ------------------------------------------------------------
+    # Unsatisfiable range
+
+    resp = apptc.get(url, headers={'Range': 'bytes=200000-'})
+    assert resp.status_code == 416
+    assert resp.headers['Content-Range'] == 'bytes */100000'
+
+
 def test_resource_error_404(configured_app):
     apptc = configured_app.test_client()
 
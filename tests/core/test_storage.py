@@ -0,0 +1,171 @@
+import hashlib
+import io
+import os
+import re
+import urlparse
+
+import pytest
+
+from datacat.db import db
+from datacat.storage import (
+    FilesystemBlobStore, get_blob_store, migrate_blobs, purge_blobs,
+    release_blob)
+
+
+def _hash(data):
+    return 'sha1:' + hashlib.sha1(data).hexdigest()
+
+
+def test_filesystem_blob_store(tmpdir):
+    store = FilesystemBlobStore(path=str(tmpdir))
+
+    key = store.create(None, io.BytesIO(b'Some data'), _hash(b'Some data'))
+    assert key == 'sha1/{0}/{1}'.format(_hash(b'Some data')[5:7],
+                                        _hash(b'Some data')[5:])
+    assert os.path.isfile(store.get_filename(key))
+
+    with store.open(None, key) as fp:
+        assert fp.read() == b'Some data'
+
+    # Content-addressed: the same data is stored only once
+    assert store.create(None, io.BytesIO(b'Some data'),
+                        _hash(b'Some data')) == key
+
+    store.delete(None, key)
+    assert not os.path.exists(store.get_filename(key))
+    store.delete(None, key)  # Deleting twice is fine
+
+    with pytest.raises(ValueError):
+        FilesystemBlobStore()
+
+
+@pytest.yield_fixture
+def fs_blob_store(configured_app, tmpdir):
+    stores = configured_app.config['BLOB_STORES']
+    configured_app.config['BLOB_STORES'] = dict(stores)
+    configured_app.config['BLOB_STORES']['fs'] = {
+        'class': 'datacat.storage:FilesystemBlobStore',
+        'path': str(tmpdir)}
+    configured_app.config['BLOB_STORE_DEFAULT'] = 'fs'
+    yield configured_app
+    configured_app.config['BLOB_STORES'] = stores
+    configured_app.config['BLOB_STORE_DEFAULT'] = 'lo'
+    configured_app.config['USE_X_SENDFILE'] = False
+    configured_app.use_x_sendfile = False
+
+
+def _create_resource(apptc, payload):
+    resp = apptc.post('/api/1/admin/resource/', data=payload)
+    assert resp.status_code == 201
+    path = urlparse.urlparse(resp.headers['Location']).path
+    match = re.match('/api/1/admin/resource/([0-9]+)', path)
+    return int(match.group(1))
+
+
+def test_resource_filesystem_store(fs_blob_store):
+    app = fs_blob_store
+    apptc = app.test_client()
+    DATA_PAYLOAD = os.urandom(100 * 1024)
+
+    resource_id = _create_resource(apptc, DATA_PAYLOAD)
+
+    resp = apptc.get('/api/1/data/resource/{0}'.format(resource_id))
+    assert resp.status_code == 200
+    assert resp.data == DATA_PAYLOAD
+    assert resp.headers['ETag'] == _hash(DATA_PAYLOAD)
+
+    resp = apptc.get('/api/1/data/resource/{0}'.format(resource_id),
+                     headers={'Range': 'bytes=10-19'})
+    assert resp.status_code == 206
+    assert resp.data == DATA_PAYLOAD[10:20]
+
+    # Let the front-end server transfer the file
+    app.use_x_sendfile = True
+    resp = apptc.get('/api/1/data/resource/{0}'.format(resource_id))
+    assert resp.status_code == 200
+    assert resp.data == ''
+    with open(resp.headers['X-Sendfile'], 'rb') as fp:
+        assert fp.read() == DATA_PAYLOAD
+    assert resp.headers['Content-Length'] == str(len(DATA_PAYLOAD))
+    app.use_x_sendfile = False
+
+    filename = resp.headers['X-Sendfile']
+    resp = apptc.delete('/api/1/admin/resource/{0}'.format(resource_id))
+    assert resp.status_code == 200
+    assert not os.path.exists(filename)
+
+
+def test_release_blob_after_commit(fs_blob_store):
+    app = fs_blob_store
+    apptc = app.test_client()
+    DATA_PAYLOAD = os.urandom(1024)
+
+    resource_id = _create_resource(apptc, DATA_PAYLOAD)
+
+    with app.app_context():
+        with db.cursor() as cur:
+            cur.execute("""
+            DELETE FROM "resource" WHERE id = %s
+            RETURNING blob_store, blob_key, hash;
+            """, (resource_id,))
+            row = cur.fetchone()
+            released = release_blob(cur, *row)
+        filename = get_blob_store('fs').get_filename(row['blob_key'])
+
+        # Files are not deleted until the transaction is committed..
+        assert released == ('fs', row['blob_key'], row['hash'])
+        assert os.path.exists(filename)
+
+        # ..and never if it's rolled back
+        db.rollback()
+        purge_blobs([released])
+        assert os.path.exists(filename)
+
+    resp = apptc.get('/api/1/data/resource/{0}'.format(resource_id))
+    assert resp.data == DATA_PAYLOAD
+
+    resp = apptc.delete('/api/1/admin/resource/{0}'.format(resource_id))
+    assert resp.status_code == 200
+    assert not os.path.exists(filename)
+
+
+def test_migrate_blobs(fs_blob_store):
+    app = fs_blob_store
+    apptc = app.test_client()
+
+    app.config['BLOB_STORE_DEFAULT'] = 'lo'
+    payloads = [os.urandom(1024) for _ in xrange(3)]
+    resources = [_create_resource(apptc, payload) for payload in payloads]
+    resources.append(_create_resource(apptc, payloads[0]))  # Shared
+
+    def _get_stores():
+        with app.app_context():
+            with db, db.cursor() as cur:
+                cur.execute('SELECT blob_store FROM "resource"'
+                            ' WHERE id = ANY(%s);', (resources,))
+                return set(row[0] for row in cur.fetchall())
+
+    def _check_data():
+        for resource_id, payload in zip(resources, payloads + payloads[:1]):
+            resp = apptc.get('/api/1/data/resource/{0}'.format(resource_id))
+            assert resp.data == payload
+
+    assert _get_stores() == set(['lo'])
+
+    with app.app_context():
+        moved = list(migrate_blobs('lo', 'fs'))
+    assert len(moved) >= 3  # Including resources from other tests
+    assert _get_stores() == set(['fs'])
+    _check_data()
+
+    # Large objects have been deleted
+    with app.app_context():
+        store = get_blob_store('lo')
+        with pytest.raises(Exception):
+            store.open(db, moved[0])
+        db.rollback()
+
+        # ..and back
+        list(migrate_blobs('fs', 'lo'))
+    assert _get_stores() == set(['lo'])
+    _check_data()
@@ -0,0 +1,10 @@
+import zlib
+
+from datacat.web.utils import gzip_stream
+
+
+def test_gzip_stream():
+    chunks = ['{"features": [', u'"\xe8"', ', '.join(['1'] * 10000), ']}']
+    data = b''.join(gzip_stream(iter(chunks)))
+    assert zlib.decompress(data, 16 + zlib.MAX_WBITS) == (
+        u''.join(chunks).encode('utf-8'))
@@ -1,6 +1,12 @@
+import io
 import itertools
+import os
+import tarfile
+import zipfile
 
-from datacat.utils.archives import open_archive, ZipArchive
+import pytest
+
+from datacat.utils.archives import open_archive, TarArchive, ZipArchive
 
 
 def test_archive_zip(data_dir):
@@ -20,9 +26,82 @@ def test_archive_zip(data_dir):
         == b'\x00\x00\x27\x0a'
 
 
-def test_archive_tar_builtin(data_dir):
+def test_archive_zip_extract_to(tmpdir):
+    data = os.urandom(1024 * 1024 + 3)
+    archive_path = str(tmpdir.join('archive.zip'))
+    with zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr('folder/data.bin', data)
+
+    archive = open_archive(archive_path)
+    dest = str(tmpdir.join('extracted.bin'))
+    archive.get('folder/data.bin').extract_to(dest, blocksize=4096)
+    with open(dest, 'rb') as fp:
+        assert fp.read() == data
+
+
+@pytest.mark.parametrize('ext,mode', [
+    ('tar', 'w'),
+    ('tar.gz', 'w:gz'),
+    ('tar.bz2', 'w:bz2'),
+    ('tgz', 'w:gz'),  # Compression is not guessed from the name
+])
+def test_archive_tar_builtin(tmpdir, ext, mode):
     # .tar .tar.gz .tar.bz2
-    pass
+    contents = {
+        'roads/roads.shp': os.urandom(200 * 1024),
+        'roads/roads.dbf': b'dbf data',
+        'roads/roads.prj': b'',
+    }
+    archive_path = str(tmpdir.join('archive.' + ext))
+    tar = tarfile.open(archive_path, mode)
+    for name in sorted(contents):
+        info = tarfile.TarInfo(name)
+        info.size = len(contents[name])
+        tar.addfile(info, io.BytesIO(contents[name]))
+    tar.close()
+
+    # Members are accessible before listing the archive
+    archive = open_archive(archive_path)
+    assert isinstance(archive, TarArchive)
+    assert archive.get('roads/roads.dbf').open().read() == b'dbf data'
+    with pytest.raises(KeyError):
+        archive.get('roads/roads.shx')
+
+    archive = open_archive(archive_path)
+    members = list(archive)
+    assert [x.name for x in members] == sorted(contents)
+    assert [x.size for x in members] == [
+        len(contents[name]) for name in sorted(contents)]
+    assert [x.name for x in archive] == sorted(contents)
+
+    # Read members out of order
+    for member in reversed(members):
+        assert member.open().read() == contents[member.name]
+
+    dest = str(tmpdir.join('extracted.shp'))
+    archive.get('roads/roads.shp').extract_to(dest, blocksize=4096)
+    with open(dest, 'rb') as fp:
+        assert fp.read() == contents['roads/roads.shp']
+
+
+def test_archive_extract(tmpdir):
+    archive_path = str(tmpdir.join('archive.zip'))
+    with zipfile.ZipFile(archive_path, 'w') as zf:
+        zf.writestr('folder/', b'')
+        zf.writestr('folder/data.txt', b'Hello')
+        zf.writestr('../outside.txt', b'Evil')
+
+    dest = tmpdir.mkdir('extracted')
+    open_archive(archive_path).extract(str(dest))
+    assert dest.join('folder/data.txt').read() == 'Hello'
+    assert not tmpdir.join('outside.txt').exists()
+
+
+def test_archive_tar_not_an_archive(tmpdir):
+    path = tmpdir.join('archive.tar')
+    path.write('This is not a tar archive' * 100)
+    with pytest.raises(ValueError):
+        open_archive(str(path))
 
 
 def test_archive_tar_xz(data_dir):
@@ -1,4 +1,11 @@
-from datacat.utils.data_extraction import find_shapefiles
+import io
+import tarfile
+import zipfile
+
+import pytest
+
+from datacat.utils.data_extraction import (
+    find_shapefiles, DumpCopyReader, ArchiveBudgetExceeded)
 
 
 def test_find_shapefiles(data_dir):
@@ -13,3 +20,107 @@ def test_find_shapefiles(data_dir):
         assert item['shx'].open().read(4) == b'\x00\x00\x27\x0a'
         assert item['dbf'].open().read(4) == b'\x03\x5f\x07\x1a'
         assert item['prj'].open().read(4) == b'PROJ'
+
+
+def _make_nested_archive(tmpdir):
+    """
+    Build ``outer.zip``, containing ``top/top.shp``, ``inner.zip``
+    (containing ``a/a.shp`` and ``deep.tar.gz``, containing ``b.shp``)
+    and ``other.tar.gz``, containing ``c.shp``.
+    """
+
+    def make_zip(members):
+        fp = io.BytesIO()
+        with zipfile.ZipFile(fp, 'w') as zf:
+            for name, data in members:
+                zf.writestr(name, data)
+        return fp.getvalue()
+
+    def make_tar_gz(members):
+        fp = io.BytesIO()
+        tar = tarfile.open(fileobj=fp, mode='w:gz')
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        tar.close()
+        return fp.getvalue()
+
+    deep = make_tar_gz([('b.shp', b'B'), ('b.dbf', b'B')])
+    inner = make_zip([('a/a.shp', b'A'), ('deep.tar.gz', deep)])
+    other = make_tar_gz([('c.shp', b'C' * 1000)])
+
+    outer = tmpdir.join('outer.zip')
+    outer.write(make_zip([
+        ('top/top.shp', b'TOP'),
+        ('top/', b''),
+        ('inner.zip', inner),
+        ('data/other.tar.gz', other),
+    ]), 'wb')
+    return str(outer)
+
+
+def test_find_shapefiles_nested(tmpdir):
+    outer = _make_nested_archive(tmpdir)
+    tempdir = tmpdir.mkdir('extracted')
+
+    found = find_shapefiles(outer, tempdir=str(tempdir), threads=2)
+    assert sorted(found.keys()) == [
+        'data/other.tar.gz/c',
+        'inner.zip/a/a',
+        'inner.zip/deep.tar.gz/b',
+        'top/top',
+    ]
+    assert sorted(found['inner.zip/deep.tar.gz/b'].keys()) == ['dbf', 'shp']
+    assert found['inner.zip/deep.tar.gz/b']['shp'].open().read() == b'B'
+    assert found['data/other.tar.gz/c']['shp'].open().read() == b'C' * 1000
+    assert found['top/top']['shp'].open().read() == b'TOP'
+
+    # Nested archives are only extracted if a directory is provided
+    assert sorted(find_shapefiles(outer).keys()) == ['top/top']
+
+
+def test_find_shapefiles_nested_limits(tmpdir):
+    outer = _make_nested_archive(tmpdir)
+    tempdir = str(tmpdir.mkdir('extracted'))
+
+    found = find_shapefiles(outer, tempdir=tempdir, max_depth=1)
+    assert sorted(found.keys()) == [
+        'data/other.tar.gz/c', 'inner.zip/a/a', 'top/top']
+
+    found = find_shapefiles(outer, tempdir=tempdir, max_depth=0)
+    assert sorted(found.keys()) == ['top/top']
+
+    with pytest.raises(ArchiveBudgetExceeded):
+        find_shapefiles(outer, tempdir=tempdir, max_size=100)
+
+
+SHP2PGSQL_DUMP = b"""\
+SET CLIENT_ENCODING TO UTF8;
+SET STANDARD_CONFORMING_STRINGS TO ON;
+BEGIN;
+COPY "geodata_1" ("name",geom) FROM stdin;
+Road 1\t0105000020E6100000
+Road\\\\.2\t0105000020E6100001
+\\.
+COMMIT;
+ANALYZE "geodata_1";
+"""
+
+
+def test_dump_copy_reader():
+    reader = DumpCopyReader(io.BytesIO(SHP2PGSQL_DUMP))
+    assert reader.copy_statement == \
+        b'COPY "geodata_1" ("name",geom) FROM stdin;'
+
+    # Small reads still return whole lines
+    assert reader.read(4) == b'Road 1\t0105000020E6100000\n'
+    assert reader.read() == b'Road\\\\.2\t0105000020E6100001\n'
+    assert reader.read() == b''
+    assert reader.read(8192) == b''
+
+
+def test_dump_copy_reader_no_data():
+    reader = DumpCopyReader(io.BytesIO(b'BEGIN;\nCOMMIT;\n'))
+    assert reader.copy_statement is None
+    assert reader.read() == b''
@@ -0,0 +1,65 @@
+import io
+import os
+
+import pytest
+
+from datacat.utils.files import file_copy
+
+DATA = os.urandom(300 * 1024 + 17)
+
+
+@pytest.mark.parametrize('blocksize', [4096, 1000, 1024 * 1024])
+def test_file_copy_between_files(tmpdir, blocksize):
+    src_path = str(tmpdir.join('src'))
+    dest_path = str(tmpdir.join('dest'))
+    with open(src_path, 'wb') as fp:
+        fp.write(DATA)
+
+    with open(src_path, 'rb') as src, open(dest_path, 'wb') as dest:
+        # Buffered data must be taken into account on both sides
+        assert src.read(10) == DATA[:10]
+        dest.write(b'header')
+        file_copy(src, dest, blocksize=blocksize)
+        assert src.read() == b''
+        dest.write(b'footer')
+
+    with open(dest_path, 'rb') as fp:
+        assert fp.read() == b'header' + DATA[10:] + b'footer'
+
+
+@pytest.mark.parametrize('blocksize', [4096, 1000])
+def test_file_copy_file_likes(tmpdir, blocksize):
+    dest_path = str(tmpdir.join('dest'))
+
+    # readinto() from a BytesIO, into a real file
+    with io.open(dest_path, 'wb') as dest:
+        file_copy(io.BytesIO(DATA), dest, blocksize=blocksize)
+    with open(dest_path, 'rb') as fp:
+        assert fp.read() == DATA
+
+    # From a real file, into a BytesIO
+    dest = io.BytesIO()
+    with open(dest_path, 'rb') as src:
+        file_copy(src, dest, blocksize=blocksize)
+    assert dest.getvalue() == DATA
+
+
+def test_file_copy_read_write_only():
+    class Reader(object):
+        def __init__(self, data):
+            self._fp = io.BytesIO(data)
+
+        def read(self, size):
+            return self._fp.read(size)
+
+    class Writer(object):
+        def __init__(self):
+            self.chunks = []
+
+        def write(self, data):
+            self.chunks.append(data)
+
+    dest = Writer()
+    file_copy(Reader(DATA), dest, blocksize=4096)
+    assert b''.join(dest.chunks) == DATA
+    assert all(len(chunk) <= 4096 for chunk in dest.chunks)
@@ -5,7 +5,10 @@ import urlparse
 
 import pytest
 
-from datacat.utils.resource_access import open_resource, ResourceAccessFailure
+from datacat.core import make_flask_app
+from datacat.utils.resource_access import (
+    open_resource, prefetch_resources, get_http_session,
+    ResourceAccessFailure, ResourceNotFound)
 
 
 def test_open_internal_resource(configured_app_ctx):
@@ -61,3 +64,56 @@ def test_save_resource_to_file(configured_app_ctx, tmpdir):
 def test_open_unsupported_url(configured_app_ctx):
     with pytest.raises(ResourceAccessFailure):
         open_resource('invalid://foobar')
+
+
+def _make_http_app():
+    return make_flask_app({
+        'RESOURCE_CACHE': None,
+        'HTTP_SESSION': {'pool_maxsize': 4, 'retries': 3,
+                         'backoff_factor': 0, 'timeout': 10},
+    })
+
+
+def test_prefetch_resources(tmpdir, http_server):
+    for i in xrange(10):
+        http_server.resources['/resource/{0}'.format(i)] = (
+            'Resource #{0}'.format(i), {'Content-type': 'text/plain'})
+    urls = [http_server.url + '/resource/{0}'.format(i) for i in xrange(10)]
+
+    with _make_http_app().app_context():
+        filenames = prefetch_resources(urls, str(tmpdir), threads=4)
+
+    assert len(filenames) == 10
+    for i, filename in enumerate(filenames):
+        assert os.path.dirname(filename) == str(tmpdir)
+        with open(filename, 'rb') as fp:
+            assert fp.read() == 'Resource #{0}'.format(i)
+
+    # Connections are reused across downloads
+    assert http_server.connections <= 4
+
+    with _make_http_app().app_context():
+        with pytest.raises(ResourceNotFound):
+            prefetch_resources([http_server.url + '/missing'], str(tmpdir))
+
+
+def test_http_session_retry(http_server):
+    http_server.resources['/flaky'] = ('Data', {'Content-type': 'text/plain'})
+    http_server.failures['/flaky'] = 2
+
+    with _make_http_app().app_context():
+        resource = open_resource(http_server.url + '/flaky')
+        assert resource.open_resource().read() == 'Data'
+        assert len(http_server.requests) == 3
+
+        http_server.failures['/flaky'] = 5
+        with pytest.raises(ResourceAccessFailure):
+            open_resource(http_server.url + '/flaky').open_resource()
+
+
+def test_http_session_shared(http_server):
+    app = _make_http_app()
+    with app.app_context():
+        session = get_http_session()
+    with app.app_context():
+        assert get_http_session() is session
@@ -0,0 +1,134 @@
+import io
+import os
+
+import pytest
+
+from datacat.core import make_flask_app
+from datacat.utils.resource_access import open_resource, ResourceNotFound
+from datacat.utils.resource_cache import ResourceCache
+
+
+def _object_files(path):
+    return [name for dirpath, dirnames, filenames
+            in os.walk(os.path.join(path, 'objects'))
+            for name in filenames]
+
+
+def test_resource_cache_store(tmpdir):
+    cache = ResourceCache(str(tmpdir), max_size=1024)
+
+    assert cache.get_entry('http://example.com/foo') is None
+
+    entry = cache.store('http://example.com/foo', io.BytesIO(b'Foo data'),
+                        {'etag': '"abc"', 'content-type': 'text/plain'})
+    assert entry['size'] == 8
+    assert entry['headers'] == {'etag': '"abc"', 'content-type': 'text/plain'}
+
+    entry = cache.get_entry('http://example.com/foo')
+    assert entry['url'] == 'http://example.com/foo'
+    with cache.open(entry) as fp:
+        assert fp.read() == b'Foo data'
+
+    # Same content is stored only once
+    cache.store('http://example.com/bar', io.BytesIO(b'Foo data'), {})
+    assert len(_object_files(str(tmpdir))) == 1
+    assert cache.get_entry('http://example.com/bar')['hash'] == entry['hash']
+
+    cache.update_headers(entry, {'etag': '"def"'})
+    entry = cache.get_entry('http://example.com/foo')
+    assert entry['headers'] == {'etag': '"def"', 'content-type': 'text/plain'}
+
+
+def test_resource_cache_eviction(tmpdir):
+    cache = ResourceCache(str(tmpdir), max_size=250)
+
+    for i in xrange(3):
+        cache.store('http://example.com/{0}'.format(i),
+                    io.BytesIO(str(i) * 100), {})
+        # Make sure files have different mtimes
+        path = cache._object_path(
+            cache.get_entry('http://example.com/{0}'.format(i))['hash'])
+        os.utime(path, (1000 + i, 1000 + i))
+
+    # Storing the third one evicted the least recently used
+    assert cache.get_entry('http://example.com/0') is None
+    assert cache.get_entry('http://example.com/1') is not None
+    assert cache.get_entry('http://example.com/2') is not None
+
+    # Use the first remaining one, then add some more data
+    cache.open(cache.get_entry('http://example.com/1')).close()
+    cache.store('http://example.com/3', io.BytesIO(b'3' * 100), {})
+
+    assert cache.get_entry('http://example.com/1') is not None
+    assert cache.get_entry('http://example.com/2') is None
+    assert cache.get_entry('http://example.com/3') is not None
+    assert len(os.listdir(str(tmpdir.join('index')))) == 2
+
+
+def test_resource_cache_keeps_stored_object(tmpdir):
+    cache = ResourceCache(str(tmpdir), max_size=250)
+
+    # Too large to be cached at all
+    assert cache.store('http://example.com/big',
+                       io.BytesIO(b'X' * 251), {}) is None
+    assert cache.get_entry('http://example.com/big') is None
+    assert _object_files(str(tmpdir)) == []
+    assert os.listdir(str(tmpdir.join('tmp'))) == []
+
+    hashes = []
+    for i in xrange(2):
+        entry = cache.store('http://example.com/{0}'.format(i),
+                            io.BytesIO(str(i) * 100), {})
+        os.utime(cache._object_path(entry['hash']), (1000 + i, 1000 + i))
+        hashes.append(entry['hash'])
+
+    # The object being stored is never evicted, even if the oldest one
+    cache.max_size = 100
+    cache.evict(keep=hashes[0])
+    assert cache.get_entry('http://example.com/0') is not None
+    assert cache.get_entry('http://example.com/1') is None
+
+
+def test_http_resource_cache(tmpdir, http_server):
+    app = make_flask_app({
+        'RESOURCE_CACHE': {'path': str(tmpdir), 'max_size': 1024}})
+    http_server.resources['/resource'] = (
+        b'Resource data', {'ETag': '"v1"', 'Content-type': 'text/plain'})
+    requests = http_server.requests
+    base_url = http_server.url
+
+    with app.app_context():
+        # Metadata-only access uses HEAD requests
+        resource = open_resource(base_url + '/resource')
+        assert resource.etag == '"v1"'
+        assert resource.content_type == 'text/plain'
+        assert [x[0] for x in requests] == ['HEAD']
+
+        # First download: the whole resource is retrieved
+        resource = open_resource(base_url + '/resource')
+        assert resource.open_resource().read() == b'Resource data'
+        assert 'if-none-match' not in requests[-1][2]
+
+        # Second download: served from the cache
+        resource = open_resource(base_url + '/resource')
+        assert resource.open_resource().read() == b'Resource data'
+        assert requests[-1][2]['if-none-match'] == '"v1"'
+        assert resource.etag == '"v1"'
+        assert resource.content_type == 'text/plain'
+        assert [x[0] for x in requests] == ['HEAD', 'GET', 'GET']
+
+        with pytest.raises(ResourceNotFound):
+            open_resource(base_url + '/missing').open_resource()
+
+
+def test_http_resource_cache_too_large(tmpdir, http_server):
+    app = make_flask_app({
+        'RESOURCE_CACHE': {'path': str(tmpdir), 'max_size': 8}})
+    http_server.resources['/resource'] = (
+        b'Resource data', {'ETag': '"v1"', 'Content-type': 'text/plain'})
+
+    with app.app_context():
+        resource = open_resource(http_server.url + '/resource')
+        assert resource.open_resource().read() == b'Resource data'
+
+    assert _object_files(str(tmpdir)) == []
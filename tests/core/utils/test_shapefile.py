@@ -0,0 +1,342 @@
+import datetime
+import struct
+
+import pytest
+
+from datacat.utils.data_extraction import (
+    BinaryCopyReader, shapefile_table_sql, _get_pg_type)
+from datacat.utils.shapefile import (
+    Field, ShapefileReader, ShapefileWriter, ShapefileError, NULL_SHAPE,
+    POINT_Z, POLYLINE, POLYLINE_Z, POLYGON)
+
+
+def write_shapefile(base, shape_type, shapes, fields, records,
+                    deleted=(), shx=True):
+    """
+    Write a shapefile; ``shapes`` are the record contents (after the
+    shape type), or ``None`` for null shapes; ``fields`` are
+    ``(name, type, length, decimals)`` tuples.
+    """
+
+    contents = [struct.pack('<i', NULL_SHAPE) if shape is None
+                else struct.pack('<i', shape_type) + shape
+                for shape in shapes]
+    offsets, body = [], []
+    offset = 100
+    for i, content in enumerate(contents):
+        offsets.append((offset, len(content)))
+        body.append(struct.pack('>ii', i + 1, len(content) // 2) + content)
+        offset += 8 + len(content)
+
+    def header(length):
+        return (struct.pack('>i', 9994) + b'\x00' * 20 +
+                struct.pack('>i', length // 2) +
+                struct.pack('<ii', 1000, shape_type) +
+                struct.pack('<8d', 0, 0, 1, 1, 0, 0, 0, 0))
+
+    with open(base + '.shp', 'wb') as fp:
+        fp.write(header(offset) + b''.join(body))
+    if shx:
+        with open(base + '.shx', 'wb') as fp:
+            fp.write(header(100 + 8 * len(offsets)) + b''.join(
+                struct.pack('>ii', off // 2, length // 2)
+                for off, length in offsets))
+
+    record_length = 1 + sum(field[2] for field in fields)
+    header_length = 32 + 32 * len(fields) + 1
+    with open(base + '.dbf', 'wb') as fp:
+        fp.write(struct.pack('<B3BIHH20x', 3, 115, 1, 1, len(records),
+                             header_length, record_length))
+        for name, field_type, length, decimals in fields:
+            fp.write(struct.pack('<11sc4xBB14x', name, field_type,
+                                 length, decimals))
+        fp.write(b'\r')
+        for i, record in enumerate(records):
+            fp.write(b'*' if i in deleted else b' ')
+            for value, field in zip(record, fields):
+                fp.write(value.ljust(field[2]))
+
+
+def polyline(parts, points, extra=b''):
+    return (struct.pack('<4d', 0, 0, 1, 1) +
+            struct.pack('<ii', len(parts), len(points)) +
+            struct.pack('<{0}i'.format(len(parts)), *parts) +
+            b''.join(struct.pack('<2d', *point) for point in points) + extra)
+
+
+def wkb_header(wkb_type, count=None):
+    data = struct.pack('<BI', 1, wkb_type)
+    if count is not None:
+        data += struct.pack('<I', count)
+    return data
+
+
+def wkb_points(points):
+    return b''.join(struct.pack('<{0}d'.format(len(point)), *point)
+                    for point in points)
+
+
+FIELDS = [
+    (b'NAME', b'C', 10, 0),
+    (b'LANES', b'N', 4, 0),
+    (b'LENGTH', b'N', 12, 3),
+    (b'TOLL', b'L', 1, 0),
+    (b'BUILT', b'D', 8, 0),
+]
+
+
+def test_shapefile_reader_polylines(tmpdir):
+    base = str(tmpdir.join('roads'))
+    line1 = [(0, 0), (1, 1), (2, 0)]
+    line2 = [(5, 5), (6, 6)]
+    write_shapefile(base, POLYLINE, [
+        polyline([0], line1),
+        None,
+        polyline([0, 3], line1 + line2),
+        polyline([0], line2),
+    ], FIELDS, [
+        [b'Main St', b'2', b'1.500', b'T', b'20140825'],
+        [b'', b'', b'', b'?', b''],
+        [b'Deleted', b'1', b'0.000', b'F', b'20000101'],
+        [b'\xc3\x88 road', b'**', b'12.250', b'n', b'00000000'],
+    ], deleted=[2])
+
+    with ShapefileReader(base + '.shp') as reader:
+        assert reader.geometry_type == 'MULTILINESTRING'
+        assert reader.dimensions == 2
+        assert [field.name for field in reader.fields] == [
+            'NAME', 'LANES', 'LENGTH', 'TOLL', 'BUILT']
+        records = list(reader)
+
+    assert [values for wkb, values in records] == [
+        [u'Main St', 2, 1.5, True, datetime.date(2014, 8, 25)],
+        [None, None, None, None, None],
+        [u'\xc8 road', None, 12.25, False, None],
+    ]
+    assert records[0][0] == (wkb_header(5, 1) + wkb_header(2, 3) +
+                             wkb_points(line1))
+    assert records[1][0] is None
+    assert records[2][0] == (wkb_header(5, 1) + wkb_header(2, 2) +
+                             wkb_points(line2))
+
+
+def test_shapefile_reader_no_shx(tmpdir):
+    base = str(tmpdir.join('roads'))
+    write_shapefile(base, POLYLINE, [
+        polyline([0], [(0, 0), (1, 1)]),
+        polyline([0], [(2, 2), (3, 3)]),
+    ], FIELDS[:1], [[b'a'], [b'b']], shx=False)
+
+    with ShapefileReader(base + '.shp') as reader:
+        assert [values for wkb, values in reader] == [[u'a'], [u'b']]
+
+
+def test_shapefile_reader_polygons(tmpdir):
+    base = str(tmpdir.join('areas'))
+    outer1 = [(0, 0), (0, 10), (10, 10), (10, 0), (0, 0)]  # Clockwise
+    outer2 = [(20, 0), (20, 10), (30, 10), (30, 0), (20, 0)]
+    hole = [(2, 2), (4, 2), (4, 4), (2, 4), (2, 2)]  # Counter-clockwise
+    write_shapefile(base, POLYGON, [
+        polyline([0, 5, 10], outer1 + outer2 + hole),
+    ], FIELDS[:1], [[b'a']])
+
+    with ShapefileReader(base + '.shp', srid=4326) as reader:
+        assert reader.geometry_type == 'MULTIPOLYGON'
+        (wkb, values), = list(reader)
+
+    # The hole goes in the first polygon; SRID is only in the outer header
+    assert wkb == (
+        struct.pack('<BII', 1, 6 | 0x20000000, 4326) +
+        struct.pack('<I', 2) +
+        wkb_header(3, 2) +
+        struct.pack('<I', 5) + wkb_points(outer1) +
+        struct.pack('<I', 5) + wkb_points(hole) +
+        wkb_header(3, 1) +
+        struct.pack('<I', 5) + wkb_points(outer2))
+
+
+def test_shapefile_reader_z_m(tmpdir):
+    base = str(tmpdir.join('points'))
+    write_shapefile(base, POINT_Z, [
+        struct.pack('<4d', 1, 2, 3, 4),
+        struct.pack('<3d', 5, 6, 7),  # M is optional
+    ], FIELDS[:1], [[b'a'], [b'b']])
+
+    with ShapefileReader(base + '.shp') as reader:
+        assert reader.geometry_type == 'POINTZM'
+        records = list(reader)
+
+    assert [wkb for wkb, values in records] == [
+        wkb_header(1 | 0xc0000000) + wkb_points([(1, 2, 3, 4)]),
+        wkb_header(1 | 0xc0000000) + wkb_points([(5, 6, 7, 0)]),
+    ]
+
+    base = str(tmpdir.join('lines'))
+    zs = struct.pack('<4d', 0, 1, 10, 20)  # Range, then values
+    write_shapefile(base, POLYLINE_Z, [
+        polyline([0], [(0, 0), (1, 1)], zs),
+    ], FIELDS[:1], [[b'a']])
+
+    with ShapefileReader(base + '.shp') as reader:
+        (wkb, values), = list(reader)
+    assert wkb == (wkb_header(5 | 0xc0000000, 1) +
+                   wkb_header(2 | 0xc0000000, 2) +
+                   wkb_points([(0, 0, 10, 0), (1, 1, 20, 0)]))
+
+
+def test_shapefile_reader_errors(tmpdir):
+    path = tmpdir.join('bad.shp')
+    path.write(b'\x00' * 200, 'wb')
+    with pytest.raises(ShapefileError):
+        ShapefileReader(str(path))
+
+    base = str(tmpdir.join('nodbf'))
+    write_shapefile(base, POLYLINE, [], FIELDS, [])
+    tmpdir.join('nodbf.dbf').remove()
+    with pytest.raises(ShapefileError):
+        ShapefileReader(base + '.shp')
+
+
+def test_shapefile_writer_roundtrip(tmpdir):
+    base = str(tmpdir.join('roads'))
+    line1 = [(0, 0), (1, 1), (2, 0)]
+    line2 = [(5, 5), (6, 6)]
+    write_shapefile(base, POLYLINE, [
+        polyline([0], line1),
+        None,
+        polyline([0, 3], line1 + line2),
+    ], FIELDS, [
+        [b'Main St', b'2', b'1.500', b'T', b'20140825'],
+        [b'', b'', b'', b'?', b''],
+        [b'\xc3\x88 road', b'**', b'12.250', b'n', b'00000000'],
+    ])
+
+    with ShapefileReader(base + '.shp') as reader:
+        fields, records = reader.fields, list(reader)
+
+    copy = str(tmpdir.join('copy.shp'))
+    with ShapefileWriter(copy, fields, encoding='cp1252') as writer:
+        for wkb, values in records:
+            writer.write(wkb, values)
+
+    with ShapefileReader(copy) as reader:
+        assert reader.shape_type == POLYLINE
+        assert reader.bbox == (0, 0, 6, 6)
+        assert reader.encoding == 'cp1252'
+        assert reader.fields == fields
+        assert list(reader) == records
+
+    # Without the index
+    tmpdir.join('copy.shx').remove()
+    with ShapefileReader(copy) as reader:
+        assert list(reader) == records
+
+
+def test_shapefile_writer_geometries(tmpdir):
+    # Counter-clockwise outer ring, clockwise hole (big-endian WKB)
+    outer = [(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)]
+    hole = [(2, 2), (2, 4), (4, 4), (4, 2), (2, 2)]
+    polygon = (struct.pack('>BII', 0, 3, 2) +
+               struct.pack('>I', 5) + struct.pack('>10d', *sum(outer, ())) +
+               struct.pack('>I', 5) + struct.pack('>10d', *sum(hole, ())))
+
+    path = str(tmpdir.join('areas.shp'))
+    with ShapefileWriter(path, [Field(u'NAME', b'C', 10, 0)]) as writer:
+        writer.write(polygon, [u'a'])
+        writer.write(wkb_header(6, 0), [u'empty'])
+    with ShapefileReader(path) as reader:
+        assert reader.shape_type == POLYGON
+        records = list(reader)
+
+    assert records == [
+        (wkb_header(6, 1) + wkb_header(3, 2) +
+         struct.pack('<I', 5) + wkb_points(outer[::-1]) +
+         struct.pack('<I', 5) + wkb_points(hole[::-1]), [u'a']),
+        (None, [u'empty']),
+    ]
+
+    # ISO WKB, with Z values: M values are added
+    path = str(tmpdir.join('points.shp'))
+    with ShapefileWriter(path, []) as writer:
+        writer.write(wkb_header(1001) + wkb_points([(1, 2, 3)]), [])
+    with ShapefileReader(path) as reader:
+        assert reader.shape_type == POINT_Z
+        assert [wkb for wkb, values in reader] == [
+            wkb_header(1 | 0xc0000000) + wkb_points([(1, 2, 3, 0)])]
+
+    # Geometries must match the shape type
+    with ShapefileWriter(str(tmpdir.join('lines.shp')), [],
+                         shape_type=POLYLINE) as writer:
+        with pytest.raises(ShapefileError):
+            writer.write(polygon, [])
+
+
+def test_shapefile_writer_fields(tmpdir):
+    path = str(tmpdir.join('fields.shp'))
+    fields = [
+        Field(u'LONG_NAME_1', b'C', 300, 0),
+        Field(u'LONG_NAME_2', b'N', 6, 0),
+        Field(u'VALUE', b'N', 8, 3),
+    ]
+    with ShapefileWriter(path, fields) as writer:
+        point = wkb_header(1) + wkb_points([(0, 0)])
+        writer.write(point, [u'\xe8' * 200, 1234567, 12345.6789])
+        writer.write(point, [None, -12, 1e20])
+
+    with ShapefileReader(path) as reader:
+        assert [tuple(field) for field in reader.fields] == [
+            (u'LONG_NAME_', b'C', 254, 0),
+            (u'LONG_NAM_1', b'N', 6, 0),
+            (u'VALUE', b'N', 8, 3),
+        ]
+        assert [values for wkb, values in reader] == [
+            [u'\xe8' * 127, None, 12345.68],
+            [None, -12, 1e20],
+        ]
+
+
+def test_shapefile_table_sql(tmpdir):
+    base = str(tmpdir.join('roads'))
+    write_shapefile(base, POLYLINE_Z, [], FIELDS + [
+        (b'GID', b'C', 5, 0), (b'name', b'C', 5, 0),
+        (b'POP', b'N', 12, 0), (b'HUGE', b'N', 20, 0),
+    ], [])
+
+    with ShapefileReader(base + '.shp') as reader:
+        sql = shapefile_table_sql(reader, 'geodata_1', schema='geo')
+
+    assert sql == (
+        'CREATE TABLE "geo"."geodata_1" ('
+        'gid serial PRIMARY KEY, "name" text, "lanes" integer, '
+        '"length" double precision, "toll" boolean, "built" date, '
+        '"__gid" text, "name_1" text, "pop" bigint, '
+        '"huge" double precision, '
+        '"geom" geometry(MULTILINESTRINGZM, 0));')
+
+    with ShapefileReader(base + '.shp') as reader:
+        sql = shapefile_table_sql(reader, 'geodata_1', primary_key=False)
+    assert sql.startswith('CREATE TABLE "geodata_1" (gid serial, "name" ')
+
+
+def test_binary_copy_reader():
+    encoders = [_get_pg_type(Field(*field))[1] for field in FIELDS]
+    encoders.append(lambda value, encoding: value)
+    rows = [
+        [u'\xc8', 2, 1.5, True, datetime.date(2000, 1, 2), b'WKB'],
+        [None, None, None, None, None, None],
+    ]
+
+    reader = BinaryCopyReader(rows, encoders, encoding='utf-8')
+    data = b''.join(iter(lambda: reader.read(10), b''))
+
+    assert data[:19] == b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8
+    assert data[19:] == (
+        struct.pack('>h', 6) +
+        struct.pack('>i', 2) + b'\xc3\x88' +
+        struct.pack('>ii', 4, 2) +
+        struct.pack('>id', 8, 1.5) +
+        struct.pack('>i', 1) + b'\x01' +
+        struct.pack('>ii', 4, 1) +
+        struct.pack('>i', 3) + b'WKB' +
+        struct.pack('>h', 6) + struct.pack('>i', -1) * 6 +
+        struct.pack('>h', -1))
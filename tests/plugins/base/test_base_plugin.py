@@ -3,6 +3,7 @@ import re
 import urlparse
 
 import mock
+import pytest
 
 
 # @mock.patch('datacat.utils.testing.plugins.on_dataset_delete')
@@ -32,6 +33,9 @@ def test_dataset_hooks_are_called(
     })
 
     with mock_patching:
+        # Hook handlers are looked up in a table built at load time
+        configured_app.plugins.build_hooks_table()
+
         assert 'datacat.utils.testing.plugins:dummy_plugin' \
             in configured_app.config['PLUGINS']
 
@@ -94,3 +98,183 @@ def test_dataset_hooks_are_called(
 
         for x in on_dataset_delete_mocks:
             x.assert_called_once_with(dataset_id)
+
+    configured_app.plugins.build_hooks_table()
+
+
+def test_deferred_hooks(configured_app):
+    from datacat.db import db
+
+    apptc = configured_app.test_client()
+    resp = apptc.post('/api/1/admin/dataset/',
+                      headers={'Content-type': 'application/json'},
+                      data=json.dumps({'Hello': 'World'}))
+    assert resp.status_code == 201
+    path = urlparse.urlparse(resp.headers['Location']).path
+    match = re.match('/api/1/admin/dataset/([0-9]+)', path)
+    dataset_id = int(match.group(1))
+
+    # The (eagerly-run) deferred handler did its job
+    with configured_app.app_context():
+        with db, db.cursor() as cur:
+            cur.execute("SELECT foo FROM dummy_plugin WHERE dataset_id=%s",
+                        (dataset_id,))
+            assert cur.fetchone()['foo'] == 'FOO data'
+
+    # ..and its execution was recorded
+    resp = apptc.get('/api/1/admin/hook-execution/?size=all')
+    assert resp.status_code == 200
+    executions = [
+        x for x in json.loads(resp.data)
+        if x['hook_type'] == 'dataset_create' and
+        x['arguments']['args'][0] == dataset_id]
+    assert len(executions) == 1
+    assert executions[0]['plugin'] == \
+        'datacat.utils.testing.plugins:dummy_plugin'
+    assert executions[0]['handler'] == \
+        'datacat.utils.testing.plugins.on_dataset_create'
+    assert executions[0]['status'] == 'success'
+    assert executions[0]['exception'] is None
+
+    resp = apptc.get('/api/1/admin/hook-execution/{0}'
+                     .format(executions[0]['id']))
+    assert resp.status_code == 200
+    assert json.loads(resp.data) == executions[0]
+
+
+def test_deferred_hooks_broker_failure(configured_app):
+    from datacat.tasks import run_deferred_hook
+
+    apptc = configured_app.test_client()
+    with mock.patch.object(run_deferred_hook, 'delay',
+                           side_effect=IOError('Broker unreachable')):
+        resp = apptc.post('/api/1/admin/dataset/',
+                          headers={'Content-type': 'application/json'},
+                          data=json.dumps({'Hello': 'World'}))
+
+    # The dataset was created anyways..
+    assert resp.status_code == 201
+    path = urlparse.urlparse(resp.headers['Location']).path
+    match = re.match('/api/1/admin/dataset/([0-9]+)', path)
+    dataset_id = int(match.group(1))
+
+    # ..and the failure recorded in the execution
+    resp = apptc.get('/api/1/admin/hook-execution/?size=all')
+    assert resp.status_code == 200
+    executions = [
+        x for x in json.loads(resp.data)
+        if x['hook_type'] == 'dataset_create' and
+        x['arguments']['args'][0] == dataset_id]
+    assert len(executions) == 1
+    assert executions[0]['status'] == 'failure'
+    assert 'Broker unreachable' in executions[0]['exception']
+
+
+def test_plugin_manager_hooks_table():
+    from datacat.ext.base import Plugin
+    from datacat.utils.plugin_manager import PluginManager
+
+    plugin1 = Plugin('plugin1')
+    plugin2 = Plugin('plugin2')
+    plugin3 = Plugin('plugin3')
+
+    @plugin1.hook(['hook_a', 'hook_b'])
+    def handler1(value):
+        return 'handler1-{0}'.format(value)
+
+    @plugin3.hook('hook_a')
+    def handler3(value):
+        raise ValueError(value)
+
+    @plugin1.hook('hook_a')
+    def handler1_bis(value):
+        return 'handler1_bis-{0}'.format(value)
+
+    manager = PluginManager([plugin1, plugin2, plugin3])
+
+    assert manager.get_hook_handlers('hook_a') == (
+        (plugin1, handler1), (plugin1, handler1_bis), (plugin3, handler3))
+    assert manager.get_hook_handlers('hook_b') == ((plugin1, handler1),)
+    assert manager.get_hook_handlers('hook_c') == ()
+
+    results = manager.call_hook('hook_a', 'X')
+    assert [x.plugin for x in results] == [plugin1, plugin1, plugin3]
+    assert [x.result for x in results] == [
+        'handler1-X', 'handler1_bis-X', None]
+    assert results[0].exception is None
+    assert isinstance(results[2].exception, ValueError)
+
+    assert list(manager.call_hook_async('hook_b', 'Y')) \
+        == manager.call_hook('hook_b', 'Y')
+    assert manager.call_hook('hook_c', 'Z') == []
+    assert list(manager.call_hook_async('hook_c', 'Z')) == []
+
+    result = manager.call_handler('hook_a', plugin1, handler1_bis, 'W')
+    assert result == (plugin1, 'handler1_bis-W', None)
+
+    assert manager.find_hook_handler(
+        'hook_a', 'plugin3', __name__ + '.handler3') == (plugin3, handler3)
+    with pytest.raises(LookupError):
+        manager.find_hook_handler('hook_b', 'plugin3', __name__ + '.handler3')
+
+
+def test_plugin_manager_call_hook_parallel():
+    import threading
+    import time
+    from datacat.ext.base import Plugin
+    from datacat.utils.plugin_manager import PluginManager
+
+    plugins = [Plugin('plugin{0}'.format(i)) for i in xrange(6)]
+    threads = {}
+
+    for i, plugin in enumerate(plugins):
+        # Only even plugins are thread-safe
+        @plugin.hook('slow_hook', thread_safe=(i % 2 == 0))
+        def handler(value, _i=i):
+            threads[_i] = threading.current_thread()
+            time.sleep(.2)
+            if _i == 4:
+                raise ValueError(value)
+            return '{0}-{1}'.format(value, _i)
+
+    manager = PluginManager(plugins, hook_threads=3)
+
+    start = time.time()
+    results = manager.call_hook_parallel('slow_hook', 'X')
+    elapsed = time.time() - start
+
+    # Three handlers run in the calling thread, the other three
+    # concurrently on the thread pool, at the same time.
+    assert elapsed < 1.0
+    assert [x.plugin for x in results] == plugins
+    assert [x.result for x in results] == [
+        'X-0', 'X-1', 'X-2', 'X-3', None, 'X-5']
+    assert isinstance(results[4].exception, ValueError)
+
+    main_thread = threading.current_thread()
+    assert [threads[i] is main_thread for i in xrange(6)] == [
+        False, True, False, True, False, True]
+
+    assert manager.call_hook_parallel('no_handlers', 'X') == []
+
+
+def test_plugin_manager_call_hook_parallel_deferred():
+    from datacat.ext.base import Plugin
+    from datacat.utils.plugin_manager import (
+        HookExecutionResult, PluginManager)
+
+    plugin = Plugin('plugin')
+    handler = mock.Mock(__name__='handler', return_value='called')
+    plugin.hook('hook', deferred=True, thread_safe=True)(handler)
+    manager = PluginManager([plugin])
+
+    deferred_result = HookExecutionResult(plugin, 42, None)
+    with mock.patch('datacat.utils.plugin_manager._defer_handler',
+                    return_value=deferred_result) as defer_handler:
+        results = manager.call_hook_parallel('hook', 'X')
+
+    # Deferred handlers are scheduled, not run on the thread pool
+    assert results == [deferred_result]
+    defer_handler.assert_called_once_with(
+        plugin, handler, 'hook', ('X',), {})
+    assert handler.call_count == 0
@@ -1,9 +1,17 @@
+import datetime
+import io
 import json
 import re
 import time
 import urlparse
+import zipfile
+import zlib
+
+import mock
+import pytest
 
 from datacat.db import db
+from datacat.ext.geo import ImportInProgress, import_geo_dataset
 
 
 def test_geo_import_shapefile(configured_app, data_dir):
@@ -64,3 +72,265 @@ def test_geo_import_shapefile(configured_app, data_dir):
         with db, db.cursor() as cur:
             cur.execute("""SELECT * FROM "geodata_{0}";""".format(dataset_id))
             assert len(list(cur)) == 40  # 10 items, 4 shapefiles
+
+    # Then, check the import progress was recorded
+
+    resp = apptc.get('/api/1/data/{0}/geo/import'.format(dataset_id))
+    assert resp.status_code == 200
+    status = json.loads(resp.data)
+    assert status['status'] == 'done'
+    assert status['parts_total'] == 4
+    assert status['parts_done'] == 4
+    assert status['error'] is None
+
+    # Shapefile tables are the ones of the import
+    def _get_part_tables():
+        with configured_app.app_context():
+            with db, db.cursor() as cur:
+                cur.execute("""
+                SELECT table_name FROM information_schema.tables
+                WHERE table_name LIKE %s;
+                """, ('geodata\\_{0}\\_part\\_%'.format(dataset_id),))
+                return sorted(row[0] for row in cur.fetchall())
+
+    def _get_import_tables(import_id):
+        with configured_app.app_context():
+            with db, db.cursor() as cur:
+                cur.execute("SELECT parts FROM geo_import WHERE id = %s;",
+                            (import_id,))
+                return sorted(part['table'] for part in cur.fetchone()[0])
+
+    part_tables = _get_part_tables()
+    assert len(part_tables) == 4
+    assert part_tables == _get_import_tables(status['id'])
+
+    # ------------------------------------------------------------
+    # Metadata-only updates don't trigger a new import
+    # ------------------------------------------------------------
+
+    resp = apptc.patch('/api/1/admin/dataset/{0}'.format(dataset_id),
+                       headers={'Content-type': 'application/json'},
+                       data=json.dumps({'metadata': {'title': 'Roads'}}))
+    assert resp.status_code == 200
+    time.sleep(1)
+
+    resp = apptc.get('/api/1/data/{0}/geo/import'.format(dataset_id))
+    assert json.loads(resp.data)['id'] == status['id']
+
+    # ------------------------------------------------------------
+    # Re-imports reuse the tables of unchanged shapefiles
+    # ------------------------------------------------------------
+
+    with configured_app.app_context():
+        import_geo_dataset(dataset_id)
+
+    resp = apptc.get('/api/1/data/{0}/geo/import'.format(dataset_id))
+    new_status = json.loads(resp.data)
+    assert new_status['id'] != status['id']
+    assert new_status['status'] == 'done'
+    assert new_status['parts_reused'] == 4
+
+    # Only the tables of the current import are left
+    assert _get_part_tables() == _get_import_tables(new_status['id'])
+    assert _get_part_tables() == part_tables
+
+    with configured_app.app_context():
+        with db, db.cursor() as cur:
+            cur.execute("""SELECT * FROM "geodata_{0}";""".format(dataset_id))
+            assert len(list(cur)) == 40
+
+    # The table replacing the dataset one has been renamed
+    with configured_app.app_context():
+        with db, db.cursor() as cur:
+            cur.execute("""
+            SELECT count(*) FROM information_schema.tables
+            WHERE table_name = %s;
+            """, ('geodata_{0}_new'.format(dataset_id),))
+            assert cur.fetchone()[0] == 0
+
+    # ------------------------------------------------------------
+    # Export to GeoJSON, plain and gzip-compressed
+    # ------------------------------------------------------------
+
+    url = '/api/1/data/{0}/export/geojson'.format(dataset_id)
+    resp = apptc.get(url)
+    assert resp.status_code == 200
+    assert resp.headers.get('Content-Encoding') is None
+    collection = json.loads(resp.data)
+    assert collection['type'] == 'FeatureCollection'
+    assert len(collection['features']) == 40
+    assert all(feature['type'] == 'Feature'
+               for feature in collection['features'])
+
+    resp = apptc.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    data = zlib.decompress(resp.data, 16 + zlib.MAX_WBITS)
+    assert json.loads(data) == collection
+
+    # ------------------------------------------------------------
+    # Other formats are rendered once, then served as resources
+    # ------------------------------------------------------------
+
+    for export_format in ('shp', 'csv', 'kml', 'gml'):
+        url = '/api/1/data/{0}/export/{1}'.format(dataset_id, export_format)
+        resp = apptc.get(url)
+        assert resp.status_code == 202
+        assert resp.headers['Retry-After'] == '5'
+
+        # Tasks are run eagerly
+        resp = apptc.get(url)
+        assert resp.status_code == 200
+        assert resp.headers['ETag'].startswith('sha1:')
+
+        resp2 = apptc.get(url, headers={
+            'If-Modified-Since': resp.headers['Last-Modified']})
+        assert resp2.status_code == 304
+
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert len(resp.data.splitlines()) == 41  # Header + rows
+
+    resp = apptc.get('/api/1/data/{0}/export/shp'.format(dataset_id))
+    archive = zipfile.ZipFile(io.BytesIO(resp.data))
+    assert sorted(archive.namelist()) == [
+        'geodata_{0}.{1}'.format(dataset_id, ext)
+        for ext in ('cpg', 'dbf', 'shp', 'shx')]
+
+    # Exports are kept by imports leaving the data unchanged..
+    with configured_app.app_context():
+        import_geo_dataset(dataset_id)
+
+        with db, db.cursor() as cur:
+            cur.execute("""
+            SELECT count(*) FROM geo_export WHERE dataset_id = %s;
+            """, (dataset_id,))
+            assert cur.fetchone()[0] == 4
+
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 200
+
+    # ..otherwise, they're deleted along with the old data
+    # (and shapefile tables no import refers to are dropped)
+    with configured_app.app_context():
+        with db, db.cursor() as cur:
+            cur.execute("""
+            UPDATE geo_import SET status = 'failed'
+            WHERE dataset_id = %s;
+            CREATE TABLE "geodata_{0}_part_stale" (gid INTEGER);
+            """.format(dataset_id), (dataset_id,))
+        import_id = import_geo_dataset(dataset_id)
+
+        with db, db.cursor() as cur:
+            cur.execute("""
+            SELECT count(*) FROM geo_export WHERE dataset_id = %s;
+            """, (dataset_id,))
+            assert cur.fetchone()[0] == 0
+
+    assert _get_part_tables() == _get_import_tables(import_id)
+
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 202
+
+    # Long renders are not started again..
+    def _set_csv_export(status, age):
+        with configured_app.app_context():
+            with db, db.cursor() as cur:
+                cur.execute("""
+                UPDATE geo_export SET status = %s, mtime = %s
+                WHERE dataset_id = %s AND format = 'csv';
+                """, (status, datetime.datetime.utcnow() - age, dataset_id))
+
+    _set_csv_export('rendering', datetime.timedelta(hours=1))
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 202
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 202
+
+    # ..unless lost
+    _set_csv_export('rendering', datetime.timedelta(days=1))
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 202
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 200
+
+    # Details of failures are not disclosed
+    with configured_app.app_context():
+        with db, db.cursor() as cur:
+            cur.execute("""
+            UPDATE geo_export SET error = 'Traceback: secret'
+            WHERE dataset_id = %s AND format = 'csv';
+            """, (dataset_id,))
+    _set_csv_export('failed', datetime.timedelta(minutes=1))
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 500
+    assert json.loads(resp.data) == {
+        'status': 'failed', 'error': 'Rendering the export failed'}
+
+    # Renders that can't be scheduled are marked as failed
+    _set_csv_export('failed', datetime.timedelta(days=1))
+    with mock.patch('datacat.ext.geo.render_geo_export.delay',
+                    side_effect=IOError('Broker unreachable')):
+        resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 500
+    resp = apptc.get('/api/1/data/{0}/export/csv'.format(dataset_id))
+    assert resp.status_code == 500
+
+    # ------------------------------------------------------------
+    # Imports of the same dataset are run one at a time
+    # ------------------------------------------------------------
+
+    now = datetime.datetime.utcnow()
+    with configured_app.app_context():
+        with db, db.cursor() as cur:
+            cur.execute("""
+            INSERT INTO geo_import
+            (dataset_id, status, parts_total, parts_done, ctime, mtime)
+            VALUES (%s, 'importing', 0, 0, %s, %s)
+            RETURNING id;
+            """, (dataset_id, now, now))
+            in_progress_id = cur.fetchone()[0]
+
+        with pytest.raises(ImportInProgress):
+            import_geo_dataset(dataset_id)
+
+        # ..unless the one in progress was lost
+        with db, db.cursor() as cur:
+            cur.execute("""
+            UPDATE geo_import SET mtime = %s WHERE id = %s;
+            """, (now - datetime.timedelta(days=1), in_progress_id))
+        import_geo_dataset(dataset_id)
+
+        with db, db.cursor() as cur:
+            cur.execute("""
+            SELECT status FROM geo_import WHERE id = %s;
+            """, (in_progress_id,))
+            assert cur.fetchone()[0] == 'failed'
+
+
+def test_geo_export_geojson_no_attributes(configured_app):
+    apptc = configured_app.test_client()
+    dataset_id = 999999
+
+    resp = apptc.get('/api/1/data/{0}/export/geojson'.format(dataset_id))
+    assert resp.status_code == 404
+
+    with configured_app.app_context():
+        with db, db.cursor() as cur:
+            cur.execute("""
+            CREATE TABLE "geodata_{0}" (gid INTEGER, geom GEOMETRY);
+            INSERT INTO "geodata_{0}"
+            VALUES (1, ST_GeomFromText('POINT(1 2)'));
+            """.format(dataset_id))
+
+    try:
+        resp = apptc.get('/api/1/data/{0}/export/geojson'.format(dataset_id))
+        assert resp.status_code == 200
+        collection = json.loads(resp.data)
+        assert collection['features'] == [{
+            'type': 'Feature', 'id': 1, 'properties': {},
+            'geometry': {'type': 'Point', 'coordinates': [1, 2]}}]
+
+    finally:
+        with configured_app.app_context():
+            with db, db.cursor() as cur:
+                cur.execute('DROP TABLE "geodata_{0}";'.format(dataset_id))